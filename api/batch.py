@@ -0,0 +1,251 @@
+"""Batch runner: critique many screens (e.g. RICO screenshots) from a manifest.
+
+Runs the full step1-step7 pipeline and the baseline for every manifest entry
+in-process, without the HTTP layer, and appends one JSON line per screen to
+the output file. Rerunning with the same output resumes: screens that already
+have an "ok" record are skipped and failed ones are retried.
+
+The manifest is JSONL (``{"id", "image", "task", "guidelines"}`` per line) or
+CSV with the same columns; ``id`` defaults to the image file name and
+``guidelines`` to --guidelines-file. Image paths are resolved against the
+manifest's directory, then public/stores.
+
+    cd api
+    python batch.py manifest.jsonl --guidelines-file guidelines.txt --output results.jsonl \\
+        --concurrency 8 --llm-concurrency 16
+"""
+import argparse
+import asyncio
+import base64
+import csv
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+STORES_DIR = os.path.join(os.path.dirname(HERE), "public", "stores")
+RESULT_STEPS = ("step1", "step2", "step3", "step4", "step5", "step6", "step7")
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description="Run the critique pipeline over a manifest of screens.")
+    parser.add_argument("manifest", help="JSONL or CSV with image, task and optional id/guidelines columns")
+    parser.add_argument("--output", default="batch-results.jsonl", help="JSONL results; also the resume checkpoint")
+    parser.add_argument("--guidelines-file", default=None, help="guidelines for entries that do not carry their own")
+    parser.add_argument("--concurrency", type=int, default=4, help="screens in flight per process")
+    parser.add_argument("--llm-concurrency", type=int, default=16, help="LLM calls in flight across all processes")
+    parser.add_argument("--processes", type=int, default=1, help="worker processes (at most --llm-concurrency); the manifest is sharded across them")
+    parser.add_argument("--no-baseline", action="store_true", help="skip the single-shot baseline")
+    parser.add_argument("--skip-failed", action="store_true", help="on resume, do not retry screens that failed")
+    parser.add_argument("--limit", type=int, default=None, help="only the first N manifest entries")
+    parser.add_argument("--parquet", default=None, help="also write a flattened table here (needs pandas + pyarrow)")
+    parser.add_argument("--fake", action="store_true", help="use the offline fake LLM backend (dry run)")
+    return parser.parse_args()
+
+
+def _llm_shares(llm_concurrency: int, processes: int) -> list:
+    """Per-process LLM slots that add up to exactly ``llm_concurrency``."""
+    base, extra = divmod(llm_concurrency, processes)
+    return [base + (1 if i < extra else 0) for i in range(processes)]
+
+
+def _configure_env(args, llm_slots: int):
+    # Must happen before index is imported; it reads its knobs at import time.
+    # This process's share of the global LLM cap: the pool size and the admission limit.
+    os.environ["LLM_WORKER_THREADS"] = str(llm_slots)
+    os.environ["LLM_MAX_IN_FLIGHT"] = str(llm_slots)
+    os.environ.setdefault("JOB_WORKERS", "0")
+    if args.fake:
+        os.environ["LLM_BACKEND"] = "fake"
+    for path in (HERE, os.path.dirname(HERE)):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+
+
+def _resolve_image(image: str, manifest_dir: str) -> str:
+    for candidate in (image, os.path.join(manifest_dir, image), os.path.join(STORES_DIR, image)):
+        if os.path.isfile(candidate):
+            return os.path.abspath(candidate)
+    raise FileNotFoundError(f"Image not found: {image}")
+
+
+def _load_manifest(path: str, default_guidelines: str = None, limit: int = None) -> list:
+    """Validated entries, resolving images for the first ``limit`` rows only."""
+    with open(path, encoding="utf-8") as f:
+        if path.lower().endswith(".csv"):
+            rows = list(itertools.islice(csv.DictReader(f), limit))
+        else:
+            rows = [json.loads(line) for line in itertools.islice((line for line in f if line.strip()), limit)]
+    manifest_dir = os.path.dirname(os.path.abspath(path))
+    entries, seen = [], set()
+    for n, row in enumerate(rows, 1):
+        if not row.get("image") or not row.get("task"):
+            raise ValueError(f"{path}:{n}: every entry needs 'image' and 'task'")
+        guidelines = row.get("guidelines") or default_guidelines
+        if not guidelines:
+            raise ValueError(f"{path}:{n}: no guidelines (add a 'guidelines' column or --guidelines-file)")
+        entry_id = str(row.get("id") or os.path.splitext(os.path.basename(row["image"]))[0])
+        if entry_id in seen:
+            raise ValueError(f"{path}:{n}: duplicate id '{entry_id}'")
+        seen.add(entry_id)
+        entries.append({
+            "id": entry_id,
+            "image": _resolve_image(row["image"], manifest_dir),
+            "task": row["task"],
+            "guidelines": guidelines,
+        })
+    return entries
+
+
+def _load_checkpoint(path: str) -> dict:
+    """Latest record status per id in an existing output file."""
+    status = {}
+    if not os.path.exists(path):
+        return status
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # a line cut short by an interrupted run
+            status[record.get("id")] = record.get("status")
+    return status
+
+
+def _append_record(path: str, record: dict):
+    # One write() on an O_APPEND descriptor, so lines from several processes never interleave
+    line = (json.dumps(record, ensure_ascii=False, default=str) + "\n").encode("utf-8")
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+async def _critique(index, entry: dict, include_baseline: bool) -> dict:
+    summary = index._UsageSummary()
+    index._request_usage.set(summary)
+    index._llm_user.set("batch")
+    with open(entry["image"], "rb") as f:
+        data = f.read()
+    image = index._image_ref(base64.b64encode(data).decode("utf-8"), os.path.basename(entry["image"]))
+
+    pipeline = index._run_full_critique(entry["task"], entry["guidelines"], image)
+    if include_baseline:
+        results, baseline = await asyncio.gather(pipeline, index._run_baseline(entry["task"], entry["guidelines"], image))
+    else:
+        results, baseline = await pipeline, None
+    usage = summary.summary()
+    usage.pop("calls", None)
+    return {
+        **{step: results[step] for step in RESULT_STEPS},
+        "baseline": baseline["parsed"] if baseline else None,
+        "usage": usage,
+    }
+
+
+async def _run_shard(entries: list, args) -> tuple:
+    import index
+
+    if index.user_proxy is None or not index.llm_config:
+        raise SystemExit("❌ LLM config missing: set OPENAI_API_KEY or OAI_CONFIG_LIST_JSON (or pass --fake)")
+    semaphore = asyncio.Semaphore(max(1, args.concurrency))
+    done = failed = 0
+
+    async def _one(entry):
+        nonlocal done, failed
+        async with semaphore:
+            start = time.perf_counter()
+            record = {"id": entry["id"], "image": entry["image"], "task": entry["task"]}
+            try:
+                record.update(status="ok", **await _critique(index, entry, not args.no_baseline))
+            except Exception as e:
+                failed += 1
+                record.update(status="error", error=f"{type(e).__name__}: {e}")
+            record["seconds"] = round(time.perf_counter() - start, 2)
+            record["finished_at"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+            _append_record(args.output, record)
+            done += 1
+            icon = "✅" if record["status"] == "ok" else "❌"
+            print(f"{icon} [{os.getpid()}] {entry['id']} ({record['seconds']}s) {record.get('error', '')}", flush=True)
+
+    await asyncio.gather(*(_one(entry) for entry in entries))
+    return done, failed
+
+
+def _shard_main(entries: list, args, llm_slots: int) -> tuple:
+    _configure_env(args, llm_slots)
+    return asyncio.run(_run_shard(entries, args))
+
+
+def _write_parquet(output: str, path: str):
+    try:
+        import pandas as pd
+    except ImportError:
+        print("⚠️ --parquet needs pandas and pyarrow (pip install pandas pyarrow); skipped")
+        return
+    latest = {}
+    with open(output, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            latest[record["id"]] = record
+    rows = []
+    for record in latest.values():
+        usage = record.get("usage") or {}
+        rows.append({
+            "id": record["id"],
+            "image": record["image"],
+            "task": record["task"],
+            "status": record["status"],
+            "error": record.get("error"),
+            "seconds": record.get("seconds"),
+            "prompt_tokens": usage.get("prompt_tokens"),
+            "completion_tokens": usage.get("completion_tokens"),
+            "cost_usd": usage.get("cost_usd"),
+            # Nested step results stay JSON strings so the schema is flat and stable
+            **{name: json.dumps(record.get(name), ensure_ascii=False) for name in RESULT_STEPS + ("baseline",)},
+        })
+    pd.DataFrame(rows).to_parquet(path, index=False)
+    print(f"📄 Parquet written to {path}")
+
+
+def main():
+    args = _parse_args()
+    default_guidelines = None
+    if args.guidelines_file:
+        with open(args.guidelines_file, encoding="utf-8") as f:
+            default_guidelines = f.read()
+    entries = _load_manifest(args.manifest, default_guidelines, args.limit)
+
+    checkpoint = _load_checkpoint(args.output)
+    skip = {"ok", "error"} if args.skip_failed else {"ok"}
+    todo = [entry for entry in entries if checkpoint.get(entry["id"]) not in skip]
+    print(f"▶️ {len(entries)} screens in manifest, {len(entries) - len(todo)} already done, {len(todo)} to run")
+
+    start = time.perf_counter()
+    llm_concurrency = max(1, args.llm_concurrency)
+    # Every process needs at least one LLM slot, so never more processes than the cap
+    processes = max(1, min(args.processes, len(todo) or 1, llm_concurrency))
+    shares = _llm_shares(llm_concurrency, processes)
+    if processes == 1:
+        done, failed = _shard_main(todo, args, shares[0])
+    else:
+        shards = [todo[i::processes] for i in range(processes)]
+        with multiprocessing.get_context("spawn").Pool(processes) as pool:
+            counts = pool.starmap(_shard_main, [(shard, args, share) for shard, share in zip(shards, shares)])
+        done, failed = sum(c[0] for c in counts), sum(c[1] for c in counts)
+
+    print(f"\n🏁 {done} screens in {time.perf_counter() - start:.1f}s, {failed} failed; results in {args.output}")
+    if args.parquet:
+        _write_parquet(args.output, args.parquet)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
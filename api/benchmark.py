@@ -0,0 +1,278 @@
+"""Offline benchmark for the critique pipeline.
+
+Drives /api/step1 ... /api/step7 and /api/baseline through the FastAPI app
+in-process, with the fake LLM backend replaying bench/responses.json, and
+reports per-step p50/p95 latency, throughput at N concurrent users and peak
+RSS. Results are written to JSON so runs can be compared:
+
+    cd api
+    python benchmark.py --users 8 --iterations 3 --latency-ms 300 --output before.json
+    python benchmark.py --users 8 --iterations 3 --latency-ms 300 --compare before.json
+
+``--jitter-ms`` and ``--failure-rate`` make the fake backend slow down and fail
+at random, to see what the call policy (LLM_MAX_RETRIES, LLM_HEDGE) does to
+tail latency:
+
+    LLM_HEDGE=1 python benchmark.py --users 8 --latency-ms 200 --jitter-ms 300 --failure-rate 0.05
+
+``--decode`` instead times payload decoding (step results posted as JSON, LLM
+replies as YAML) with index._load_yaml against plain yaml.safe_load:
+
+    python benchmark.py --decode --sections 40
+"""
+import argparse
+import asyncio
+import copy
+import json
+import os
+import platform
+import sys
+import time
+from collections import defaultdict
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+STEPS = ("step1", "step2", "step3", "step4", "step5_6", "step7", "baseline")
+
+GUIDELINES = """1. **Visibility of system status**
+The design should always keep users informed about what is going on, through appropriate feedback within a reasonable amount of time.
+
+2. **Match between system and the real world**
+The design should speak the users' language, using words, phrases and concepts familiar to the user.
+
+3. **Consistency and standards**
+Users should not have to wonder whether different words, situations or actions mean the same thing."""
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the step pipeline against a fake LLM backend.")
+    parser.add_argument("--users", type=int, default=4, help="concurrent simulated users")
+    parser.add_argument("--iterations", type=int, default=2, help="full step1-7 + baseline sessions per user")
+    parser.add_argument("--latency-ms", type=float, default=0, help="simulated latency of every LLM call")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="mean of extra, exponentially distributed latency")
+    parser.add_argument("--failure-rate", type=float, default=0, help="share of LLM calls that fail with a connection error")
+    parser.add_argument("--responses", default=None, help="recorded replies (default: bench/responses.json)")
+    parser.add_argument("--task", default="Select music video to play")
+    parser.add_argument("--cache", action="store_true", help="keep the persistent step cache enabled")
+    parser.add_argument("--output", default="bench-results.json")
+    parser.add_argument("--compare", default=None, help="previous results JSON to diff against")
+    parser.add_argument("--decode", action="store_true", help="only benchmark payload decoding and exit")
+    parser.add_argument("--sections", type=int, default=40, help="sections in the --decode payload")
+    return parser.parse_args()
+
+
+def _configure_env(args):
+    # Must happen before index is imported; it reads its knobs at import time
+    os.environ["LLM_BACKEND"] = "fake"
+    os.environ["FAKE_LLM_LATENCY_MS"] = str(args.latency_ms)
+    os.environ["FAKE_LLM_JITTER_MS"] = str(args.jitter_ms)
+    os.environ["FAKE_LLM_FAILURE_RATE"] = str(args.failure_rate)
+    if args.responses:
+        os.environ["FAKE_LLM_RESPONSES"] = os.path.abspath(args.responses)
+    if not args.cache:
+        os.environ["STEP_CACHE_ENABLED"] = "0"
+    os.environ.setdefault("JOB_WORKERS", "0")
+    here = os.path.dirname(os.path.abspath(__file__))
+    # index.py lives here; the repo root makes src.utils logging importable
+    for path in (here, os.path.dirname(here)):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+
+
+def _percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+def _peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is bytes on macOS, kilobytes elsewhere
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+async def _session(client, task, timings, errors):
+    async def _call(step, path, **kwargs):
+        start = time.perf_counter()
+        resp = await client.post(path, **kwargs)
+        timings[step].append(time.perf_counter() - start)
+        if resp.status_code >= 400:
+            errors[step] += 1
+            raise RuntimeError(f"{step} returned {resp.status_code}: {resp.text[:200]}")
+        return resp.json()
+
+    step1 = await _call("step1", "/api/step1", data={"task": task})
+    run_id, app_ui = step1["run_id"], step1["app_ui"]
+    step2 = await _call("step2", "/api/step2", json={"task": task, "app_ui": app_ui, "run_id": run_id})
+    step3 = await _call("step3", "/api/step3", json={
+        "task": task, "app_ui": app_ui, "app_ui_components": step2["result"], "run_id": run_id,
+    })
+    await _call("step4", "/api/step4", json={
+        "task": task, "app_ui": app_ui, "step3_results": step3["result"], "run_id": run_id,
+    })
+    await _call("step5_6", "/api/step5_6", data={"run_id": run_id, "guidelines_str": GUIDELINES})
+    await _call("step7", "/api/step7", data={"run_id": run_id})
+    await _call("baseline", "/api/baseline", data={"task": task, "guidelines_str": GUIDELINES})
+
+
+async def _run(args):
+    import httpx
+    import index
+
+    timings = defaultdict(list)
+    errors = defaultdict(int)
+    failed_sessions = 0
+    transport = httpx.ASGITransport(app=index.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        async def _user():
+            nonlocal failed_sessions
+            for _ in range(args.iterations):
+                try:
+                    await _session(client, args.task, timings, errors)
+                except Exception as e:
+                    failed_sessions += 1
+                    print(f"❌ Session failed: {e}")
+
+        start = time.perf_counter()
+        await asyncio.gather(*(_user() for _ in range(args.users)))
+        wall = time.perf_counter() - start
+
+    sessions = args.users * args.iterations
+    requests = sum(len(v) for v in timings.values())
+    return {
+        "config": {
+            "users": args.users,
+            "iterations": args.iterations,
+            "latency_ms": args.latency_ms,
+            "jitter_ms": args.jitter_ms,
+            "failure_rate": args.failure_rate,
+            "llm_hedge": index.LLM_HEDGE,
+            "llm_max_retries": index.LLM_MAX_RETRIES,
+            "step_cache": args.cache,
+            "responses": index.FAKE_LLM_RESPONSES,
+            "llm_worker_threads": index.LLM_WORKER_THREADS,
+            "section_concurrency": index.SECTION_CONCURRENCY,
+            "python": platform.python_version(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "steps": {
+            step: {
+                "count": len(timings[step]),
+                "errors": errors[step],
+                "p50_ms": round(_percentile(timings[step], 50) * 1000, 2) if timings[step] else None,
+                "p95_ms": round(_percentile(timings[step], 95) * 1000, 2) if timings[step] else None,
+                "mean_ms": round(sum(timings[step]) / len(timings[step]) * 1000, 2) if timings[step] else None,
+            }
+            for step in STEPS
+        },
+        "wall_seconds": round(wall, 3),
+        "sessions": sessions,
+        "failed_sessions": failed_sessions,
+        "sessions_per_second": round((sessions - failed_sessions) / wall, 3) if wall else None,
+        "requests_per_second": round(requests / wall, 3) if wall else None,
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+
+
+def _decode_payload(responses_path, sections):
+    """step3/step6-shaped results for ``sections`` sections, built from the recorded replies."""
+    import yaml
+
+    with open(responses_path, encoding="utf-8") as f:
+        responses = json.load(f)
+
+    def _recorded(agent):
+        entry = next(e for e in responses[agent] if "reply" in e)
+        return yaml.safe_load(entry["reply"].removeprefix("```yaml").removesuffix("```"))
+
+    components, issues = _recorded("UIComponentAnalyzer"), _recorded("UIComponentEvaluator")
+    # Distinct copies, or yaml.dump would collapse the repeats into anchors
+    return {
+        "step3": {f"Section {i}": copy.deepcopy(components) for i in range(sections)},
+        "step6": {f"Section {i}": copy.deepcopy(issues) for i in range(sections)},
+    }
+
+
+def _time_per_call(fn, text, min_seconds=0.5):
+    calls, start = 0, time.perf_counter()
+    while True:
+        fn(text)
+        calls += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_seconds:
+            return elapsed / calls
+
+
+def _run_decode(args):
+    import yaml
+    import index
+
+    payload = _decode_payload(index.FAKE_LLM_RESPONSES, args.sections)
+    cases = {
+        # navigationUtils.ts posts step results with JSON.stringify
+        "step results (JSON)": json.dumps(payload, ensure_ascii=False),
+        "LLM reply (YAML)": yaml.dump(payload, allow_unicode=True, sort_keys=False),
+    }
+    results = {"config": {"sections": args.sections, "libyaml": getattr(yaml, "__with_libyaml__", False)}, "cases": {}}
+    print(f"\n{'payload':<22}{'KB':>8}{'safe_load ms':>15}{'_load_yaml ms':>15}{'speedup':>10}")
+    for name, text in cases.items():
+        assert index._load_yaml(text) == yaml.safe_load(text) == payload
+        before = _time_per_call(yaml.safe_load, text) * 1000
+        after = _time_per_call(index._load_yaml, text) * 1000
+        size_kb = len(text.encode("utf-8")) / 1024
+        results["cases"][name] = {"kb": round(size_kb, 1), "safe_load_ms": round(before, 3), "load_yaml_ms": round(after, 3)}
+        print(f"{name:<22}{size_kb:>8.1f}{before:>15.3f}{after:>15.3f}{before / after:>9.1f}x")
+    return results
+
+
+def _print_report(results, previous=None):
+    def _delta(new, old):
+        if new is None or not old:
+            return ""
+        return f" ({(new - old) / old * 100:+.1f}%)"
+
+    prev_steps = (previous or {}).get("steps", {})
+    print(f"\n{'step':<10}{'count':>7}{'errors':>8}{'p50 ms':>22}{'p95 ms':>22}")
+    for step, stats in results["steps"].items():
+        old = prev_steps.get(step, {})
+        p50 = f"{stats['p50_ms']}{_delta(stats['p50_ms'], old.get('p50_ms'))}"
+        p95 = f"{stats['p95_ms']}{_delta(stats['p95_ms'], old.get('p95_ms'))}"
+        print(f"{step:<10}{stats['count']:>7}{stats['errors']:>8}{p50:>22}{p95:>22}")
+    prev = previous or {}
+    print(
+        f"\nsessions/s: {results['sessions_per_second']}{_delta(results['sessions_per_second'], prev.get('sessions_per_second'))}"
+        f"  requests/s: {results['requests_per_second']}{_delta(results['requests_per_second'], prev.get('requests_per_second'))}"
+        f"  peak RSS: {results['peak_rss_mb']} MB{_delta(results['peak_rss_mb'], prev.get('peak_rss_mb'))}"
+    )
+
+
+def main():
+    args = _parse_args()
+    _configure_env(args)
+    if args.decode:
+        results = _run_decode(args)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"\n📄 Results written to {args.output}")
+        return 0
+    results = asyncio.run(_run(args))
+    previous = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            previous = json.load(f)
+    _print_report(results, previous)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"\n📄 Results written to {args.output}")
+    return 1 if results["failed_sessions"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
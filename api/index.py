@@ -4,15 +4,37 @@ app = FastAPI()
 api = APIRouter(prefix="/api")
 
 import base64
+import copy
+import io
 import shutil
 import uuid
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 import yaml
 import os
 import json
+import asyncio
+import functools
+import gzip
+import hashlib
+import hmac
+import inspect
+import logging
+import random
+import re
+import sqlite3
+import sys
+import textwrap
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from contextvars import ContextVar, copy_context
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 load_dotenv(".env.local")
 
@@ -29,17 +51,32 @@ except Exception as e:
     UserProxyAgent = None  # type: ignore
     AUTOGEN_AVAILABLE = False
 
+# Pillow is optional: without it images are sent as uploaded (no checks,
+# downscaling or section crops)
+try:
+    from PIL import Image
+except ImportError:
+    Image = None  # type: ignore
+
+# --- 운영 로그 ---
+# Retries, cache hits, batching, disconnects and jobs go through this logger
+# rather than print(). Per-section traces are DEBUG, so on the hot path they
+# cost a level check unless CRITIQUE_LOG_LEVEL=DEBUG.
+logger = logging.getLogger("critique")
+logger.setLevel(os.getenv("CRITIQUE_LOG_LEVEL", "INFO").upper())
+if not logger.handlers:
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(logging.Formatter("%(levelname)s %(name)s: %(message)s"))
+    logger.addHandler(_log_handler)
+    logger.propagate = False
+
 # --------- 헬스체크/진단 ----------
 @api.get("/healthz")
 def healthz():
     return {"ok": True}
 
 def _try_import_pil():
-    try:
-        import PIL  # noqa
-        return True
-    except Exception:
-        return False
+    return Image is not None
 
 @api.get("/diag")
 def diag():
@@ -58,6 +95,34 @@ def diag():
         "autogen_available": AUTOGEN_AVAILABLE,
         "config_4v_count": c4,
         "config_o3_count": co3,
+        "llm_backend": LLM_BACKEND,
+        "llm_worker_threads": LLM_WORKER_THREADS,
+        "section_concurrency": SECTION_CONCURRENCY,
+        "llm_policy": {
+            "request_timeout_seconds": LLM_REQUEST_TIMEOUT_SECONDS,
+            "deadline_seconds": {"default": LLM_DEADLINE_SECONDS, **LLM_STEP_DEADLINES},
+            "max_retries": LLM_MAX_RETRIES,
+            "hedge": LLM_HEDGE,
+            "hedge_delay_seconds": {step: _hedge_delay(step) for step in sorted(_call_latencies)},
+        },
+        "llm_admission": _admission.stats(),
+        "active_runs": len(_runs),
+        "jobs": _jobs.stats(),
+        "action_log": _log_writer_stats(),
+        "image_cache": _image_cache.stats(),
+        "image_preprocess": {"variant": _IMAGE_VARIANT, "cache": _processed_images.stats()},
+        "section_crops": {"enabled": SECTION_CROPS, "cache": _section_crops.stats()},
+        "section_batching": {
+            "steps": sorted(SINGLE_CONTEXT_STEPS),
+            "max_sections": SECTION_BATCH_MAX,
+            "max_tokens": SECTION_BATCH_TOKENS,
+        },
+        "step_cache": _step_cache.stats() if _step_cache is not None else {"enabled": False},
+        "slowest_requests": _slowest_requests(),
+        "guideline_cache": {
+            "memory": guideline_update_cache.stats(),
+            "shared": _shared_guideline_cache.stats() if _shared_guideline_cache is not None else {"enabled": False},
+        },
     }
 
 
@@ -73,8 +138,427 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing", "X-Profile-Id"],
 )
 
+# --- 요청 프로파일링 ---
+# Every request times its named phases (fetch_image, build_prompt, llm, parse,
+# log) and reports them in a Server-Timing header; the slowest recent requests
+# are listed on /api/diag. With PROFILE_REQUESTS=1, or an "X-Profile: 1"
+# header, a sampling profiler also records the stacks of the threads working
+# for that request (event loop and its LLM/pool workers) as folded stacks for
+# flamegraph.pl / speedscope, saved under PROFILE_DIR and served from
+# /api/profiles/{id}. The header is only honoured with PROFILE_HEADER_ENABLED=1
+# and a matching X-Admin-Token (ADMIN_TOKEN); downloading a profile needs the
+# token as well.
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+PROFILE_REQUESTS = os.getenv("PROFILE_REQUESTS", "0") != "0"
+PROFILE_HEADER_ENABLED = os.getenv("PROFILE_HEADER_ENABLED", "0") != "0"
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(os.getcwd(), ".cache", "profiles"))
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "50"))
+SLOW_REQUEST_WINDOW = int(os.getenv("SLOW_REQUEST_WINDOW", "500"))
+
+def _is_admin(request: Request) -> bool:
+    """True when ADMIN_TOKEN is configured and the request carries it."""
+    supplied = request.headers.get("x-admin-token", "")
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(supplied.encode("utf-8"), ADMIN_TOKEN.encode("utf-8"))
+
+def _admin_required() -> JSONResponse:
+    return JSONResponse(status_code=403, content={"error": "Requires a valid X-Admin-Token (set ADMIN_TOKEN on the server)"})
+
+# {phase: {"seconds", "count"}} of the request being served
+_request_phases: ContextVar = ContextVar("request_phases", default=None)
+# The profiled request's _StackSampler, if any
+_request_sampler: ContextVar = ContextVar("request_sampler", default=None)
+_recent_requests: deque = deque(maxlen=SLOW_REQUEST_WINDOW)
+# Phases are also timed in asyncio.to_thread workers
+_phases_lock = threading.Lock()
+
+@contextmanager
+def _profiled_thread(sampler=None):
+    """Include the current thread in the request's profile while the block runs.
+
+    ``sampler`` is for plain pool threads, which do not inherit the request context.
+    """
+    sampler = sampler or _request_sampler.get()
+    if sampler is None:
+        yield
+        return
+    ident = threading.get_ident()
+    sampler.attach(ident)
+    try:
+        yield
+    finally:
+        sampler.detach(ident)
+
+@contextmanager
+def _phase(name: str):
+    phases = _request_phases.get()
+    if phases is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        with _profiled_thread():
+            yield
+    finally:
+        elapsed = time.perf_counter() - start
+        with _phases_lock:
+            stats = phases.setdefault(name, {"seconds": 0.0, "count": 0})
+            stats["seconds"] += elapsed
+            stats["count"] += 1
+
+def _phase_snapshot(phases: dict) -> dict:
+    with _phases_lock:
+        return {name: dict(stats) for name, stats in phases.items()}
+
+def _profile_phase(name: str):
+    """Decorator: attribute the (sync or async) function's time to a request phase."""
+    def _decorate(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def _async(*args, **kwargs):
+                with _phase(name):
+                    return await fn(*args, **kwargs)
+            return _async
+
+        @functools.wraps(fn)
+        def _sync(*args, **kwargs):
+            with _phase(name):
+                return fn(*args, **kwargs)
+        return _sync
+    return _decorate
+
+class _StackSampler:
+    """Samples one request's thread stacks every ``interval`` seconds into folded-stack counts.
+
+    Only attached threads are sampled: the event loop thread that started the
+    sampler, plus pool threads while they work for the request (see
+    _profiled_thread). The loop thread is shared, so its samples can still
+    include other requests' coroutines.
+    """
+
+    # A leaf frame in these modules means the thread is parked, not working
+    # (thread.py: an idle ThreadPoolExecutor worker blocked on its work queue)
+    _IDLE_MODULES = ("threading.py", "selectors.py", "queue.py", "thread.py")
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.samples = 0
+        self.counts: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._threads: Counter = Counter()  # ident -> nesting depth
+        self._threads_lock = threading.Lock()
+
+    def start(self) -> "_StackSampler":
+        self.attach(threading.get_ident())
+        self._thread.start()
+        return self
+
+    def attach(self, ident: int):
+        with self._threads_lock:
+            self._threads[ident] += 1
+
+    def detach(self, ident: int):
+        with self._threads_lock:
+            self._threads[ident] -= 1
+            if self._threads[ident] <= 0:
+                del self._threads[ident]
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            with self._threads_lock:
+                attached = set(self._threads)
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident not in attached:
+                    continue
+                name = names.get(ident, str(ident))
+                if os.path.basename(frame.f_code.co_filename) in self._IDLE_MODULES:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(name)
+                self.counts[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self) -> str:
+        self._stop.set()
+        self._thread.join()
+        return "".join(f"{stack} {count}\n" for stack, count in self.counts.most_common())
+
+def _save_profile(profile_id: str, record: dict, folded: str):
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        with open(os.path.join(PROFILE_DIR, f"{profile_id}.folded"), "w", encoding="utf-8") as f:
+            f.write(folded)
+        with open(os.path.join(PROFILE_DIR, f"{profile_id}.json"), "w", encoding="utf-8") as f:
+            json.dump(record, f, ensure_ascii=False, indent=2)
+        # Keep only the newest PROFILE_KEEP profiles
+        folded_files = sorted(
+            (os.path.join(PROFILE_DIR, name) for name in os.listdir(PROFILE_DIR) if name.endswith(".folded")),
+            key=os.path.getmtime,
+        )
+        for path in folded_files[:-PROFILE_KEEP]:
+            for stale in (path, path[: -len(".folded")] + ".json"):
+                if os.path.exists(stale):
+                    os.remove(stale)
+    except OSError as e:
+        logger.warning("Could not save profile %s: %s", profile_id, e)
+
+def _slowest_requests(limit: int = 10) -> list:
+    return sorted(list(_recent_requests), key=lambda r: r["seconds"], reverse=True)[:limit]
+
+@app.middleware("http")
+async def _profile_request(request: Request, call_next):
+    phases: dict = {}
+    _request_phases.set(phases)
+    wants_profile = PROFILE_REQUESTS or (
+        PROFILE_HEADER_ENABLED
+        and request.headers.get("x-profile", "").lower() in ("1", "true", "yes")
+        and _is_admin(request)
+    )
+    profile_id = uuid.uuid4().hex if wants_profile else None
+    sampler = _StackSampler(PROFILE_INTERVAL_MS / 1000).start() if wants_profile else None
+    _request_sampler.set(sampler)
+    start = time.perf_counter()
+    try:
+        response = await call_next(request)
+    except Exception:
+        if sampler is not None:
+            sampler.stop()
+        raise
+
+    response.headers["Server-Timing"] = ", ".join(
+        [f"{name};dur={stats['seconds'] * 1000:.1f}" for name, stats in _phase_snapshot(phases).items()]
+        + [f"total;dur={(time.perf_counter() - start) * 1000:.1f}"]
+    )
+    if profile_id:
+        response.headers["X-Profile-Id"] = profile_id
+
+    # Streaming bodies (SSE) do their work while iterating, so finish the record afterwards
+    body = response.body_iterator
+
+    async def _finish():
+        try:
+            async for chunk in body:
+                yield chunk
+        finally:
+            record = {
+                "method": request.method,
+                "path": request.url.path,
+                "status": response.status_code,
+                "seconds": round(time.perf_counter() - start, 4),
+                "phases": {name: {"seconds": round(s["seconds"], 4), "count": s["count"]} for name, s in _phase_snapshot(phases).items()},
+                "at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "profile_id": profile_id,
+            }
+            _recent_requests.append(record)
+            if sampler is not None:
+                folded = await asyncio.to_thread(sampler.stop)
+                record["samples"] = sampler.samples
+                await asyncio.to_thread(_save_profile, profile_id, record, folded)
+
+    response.body_iterator = _finish()
+    return response
+
+@api.get("/profiles/{profile_id}")
+def get_profile(request: Request, profile_id: str):
+    """Folded stacks of a profiled request (flamegraph.pl / speedscope input)."""
+    if not _is_admin(request):
+        return _admin_required()
+    if not profile_id.isalnum():
+        return JSONResponse(status_code=400, content={"error": "Invalid profile_id"})
+    path = os.path.join(PROFILE_DIR, f"{profile_id}.folded")
+    if not os.path.exists(path):
+        return JSONResponse(status_code=404, content={"error": f"Unknown or pruned profile_id: {profile_id}"})
+    with open(path, encoding="utf-8") as f:
+        return Response(f.read(), media_type="text/plain; charset=utf-8")
+
+# --- 페이로드 디코딩 ---
+# Step results posted by the frontend are JSON.stringify output and go through
+# json.loads; everything else (LLM replies) is YAML, parsed with libyaml's
+# CSafeLoader when PyYAML was built with it. Both give the same values as
+# yaml.safe_load, several times faster (see benchmark.py --decode).
+_YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+@_profile_phase("parse")
+def _load_yaml(text):
+    if isinstance(text, str):
+        stripped = text.lstrip()
+        if stripped[:1] in ("{", "["):
+            try:
+                return json.loads(stripped)
+            except ValueError:
+                pass  # YAML flow style, e.g. {a: 1}
+    return yaml.load(text, Loader=_YamlLoader)
+
+@_profile_phase("build_prompt")
+def _dump_yaml(data) -> str:
+    return yaml.dump(data, allow_unicode=True, sort_keys=False)
+
+# --- 구조화 출력 추출/복구 ---
+# Every step asks for a YAML block and replies drift from it: prose around the
+# fence, ```yml, tab indentation, unquoted "key: a: b" values, replies cut off
+# at the token limit. _parse_structured finds the block, repairs those defects
+# and, when the whole still does not parse, keeps every mapping entry that does
+# (recursing into the ones that do not), reporting the key paths it lost.
+# _structured_reply then asks for just those entries instead of redoing the
+# whole call.
+STRUCTURED_RETRY = os.getenv("STRUCTURED_RETRY", "1") != "0"
+
+_YAML_FENCE_RE = re.compile(r"```[ \t]*ya?ml\b[^\n]*\n", re.IGNORECASE)
+_ANY_FENCE_RE = re.compile(r"```[^\n]*\n")
+_YAML_KEY_RE = re.compile(r"""^(\s*(?:-[ \t]+)?)("[^"\n]*"|'[^'\n]*'|[^\s"'#?:\-][^:\n]*?):(?:[ \t]+(\S.*?))?\s*$""")
+
+def _extract_yaml_block(raw: str) -> tuple:
+    """``(yaml_text, truncated)`` from an LLM reply.
+
+    Takes the first ```yaml / ```yml block, else the first fenced block; an
+    opening fence with no closing one means the reply was cut off inside it.
+    Without fences the whole reply is the payload.
+    """
+    text = (raw or "").strip()
+    match = _YAML_FENCE_RE.search(text) or _ANY_FENCE_RE.search(text)
+    if match is None:
+        return textwrap.dedent(text), False
+    end = text.find("```", match.end())
+    if end == -1:
+        return textwrap.dedent(text[match.end():]).rstrip(), True
+    return textwrap.dedent(text[match.end():end]).strip("\n"), False
+
+def _yaml_value_ok(value: str) -> bool:
+    try:
+        yaml.load(f"k: {value}", Loader=_YamlLoader)
+        return True
+    except yaml.YAMLError:
+        return False
+
+def _repair_yaml(text: str) -> str:
+    """Line-by-line fixes: tabs in indentation, and inline values that are not
+    valid scalars (``a: b: c``, ``"quoted" tail``) become double-quoted strings."""
+    lines = []
+    for line in text.splitlines():
+        body = line.lstrip(" \t")
+        line = line[: len(line) - len(body)].replace("\t", "    ") + body
+        match = _YAML_KEY_RE.match(line)
+        value = match.group(3) if match else None
+        # Block scalars, flow collections and anchors are left alone, as are
+        # quoted strings that continue on the next line
+        if value and value[0] not in "|>[{&*!" and not (value[0] in "\"'" and value.count(value[0]) < 2):
+            if not _yaml_value_ok(value):
+                line = f"{match.group(1)}{match.group(2)}: {json.dumps(value, ensure_ascii=False)}"
+        lines.append(line)
+    return "\n".join(lines)
+
+def _yaml_entries(text: str):
+    """``[(key, inline_value, lines)]`` per top-level mapping entry, or None when
+    the text is not a mapping. Unkeyed top-level lines (stray prose) are dropped."""
+    entries = []
+    for line in text.splitlines():
+        if line[:1] not in ("", " ", "#"):
+            if line.startswith("-"):
+                return None
+            match = _YAML_KEY_RE.match(line)
+            if match is None:
+                continue
+            try:
+                key = yaml.load(match.group(2), Loader=_YamlLoader)
+            except yaml.YAMLError:
+                key = match.group(2).strip("\"'")
+            entries.append((key, match.group(3), [line]))
+        elif entries:
+            entries[-1][2].append(line)
+    return entries or None
+
+def _salvage_yaml(text: str, truncated: bool, path: tuple = ()) -> tuple:
+    """``(data, lost)``: the mapping entries of ``text`` that parse on their own
+    and the key paths of those that do not. When ``truncated``, the last entry
+    at each level is never trusted whole, since its tail may be missing."""
+    entries = _yaml_entries(text)
+    if entries is None:
+        return None, [path]
+    data, lost = {}, []
+    for i, (key, inline_value, lines) in enumerate(entries):
+        cut = truncated and i == len(entries) - 1
+        if not cut:
+            try:
+                value = _load_yaml("\n".join(lines))
+            except yaml.YAMLError:
+                value = None
+            if isinstance(value, dict):
+                data.update(value)
+                continue
+        body = textwrap.dedent("\n".join(lines[1:]))
+        sub, sub_lost = None, []
+        if not inline_value and body.strip():
+            sub, sub_lost = _salvage_yaml(body, cut, path + (key,))
+        if sub:
+            data[key] = sub
+            lost.extend(sub_lost)
+        else:
+            lost.append(path + (key,))
+    return data, lost
+
+def _yaml_error_at_end(error: yaml.YAMLError, text: str) -> bool:
+    mark = getattr(error, "problem_mark", None) or getattr(error, "context_mark", None)
+    last_line = len(text.rstrip().splitlines()) - 1
+    return mark is not None and mark.line >= last_line
+
+def _parse_structured(raw: str) -> SimpleNamespace:
+    """Parse the YAML in an LLM reply as far as possible.
+
+    Returns ``data`` (None when nothing parsed), ``lost`` (key paths that could
+    not be recovered), ``truncated`` and ``outcome``: clean, repaired, salvaged
+    or failed.
+    """
+    text, truncated = _extract_yaml_block(raw)
+    if not truncated:
+        try:
+            return SimpleNamespace(data=_load_yaml(text), lost=[], truncated=False, outcome="clean")
+        except yaml.YAMLError as e:
+            # An error on the last line of an unfenced reply is a cut-off tail
+            truncated = _yaml_error_at_end(e, text)
+    repaired = _repair_yaml(text)
+    if not truncated and repaired != text:
+        try:
+            return SimpleNamespace(data=_load_yaml(repaired), lost=[], truncated=False, outcome="repaired")
+        except yaml.YAMLError:
+            pass
+    data, lost = _salvage_yaml(repaired, truncated)
+    return SimpleNamespace(data=data or None, lost=lost, truncated=truncated, outcome="salvaged" if data else "failed")
+
+def _merge_structured(data: dict, extra: dict) -> dict:
+    """Fill entries missing from ``data`` with those from ``extra``; existing values win."""
+    for key, value in extra.items():
+        if key not in data:
+            data[key] = value
+        elif isinstance(data[key], dict) and isinstance(value, dict):
+            _merge_structured(data[key], value)
+    return data
+
+def _has_path(data, path: tuple) -> bool:
+    for key in path:
+        if not isinstance(data, dict) or key not in data:
+            return False
+        data = data[key]
+    return True
+
+def _remainder_instructions(parsed: SimpleNamespace) -> str:
+    lost = [" > ".join(str(key) for key in path) for path in parsed.lost if path]
+    problem = "was cut off" if parsed.truncated else "contained malformed YAML"
+    return (
+        f"\n\nYour previous reply to this request {problem}. Reply with ONLY the YAML for these entries: "
+        f"{json.dumps(lost, ensure_ascii=False)}"
+        + (", and for every entry after them that the reply did not reach" if parsed.truncated else "")
+        + ". Nest them under the same parent keys as in the required structure, and do not repeat any other entry."
+    )
+
 # Serve Next.js public/stores images from the backend as well (for Render domain)
 stores_dir = os.path.join(os.getcwd(), "public", "stores")
 if os.path.isdir(stores_dir):
@@ -87,6 +571,10 @@ try:
         log_guideline_edit_prompt as _log_guideline_edit_prompt,
         log_guideline_updated as _log_guideline_updated,
         log_user_action as _log_user_action,
+        log_user_actions as _log_user_actions,
+        query_user_actions as _query_user_actions,
+        shutdown_log_writer as _shutdown_log_writer,
+        log_writer_stats as _log_writer_stats,
     )
 except Exception:
     def _log_step_result(**kwargs):
@@ -97,12 +585,26 @@ except Exception:
         return None
     def _log_user_action(*args, **kwargs):
         return None
+    def _log_user_actions(*args, **kwargs):
+        return None
+    def _query_user_actions(**kwargs):
+        raise RuntimeError("Action log index unavailable (src.utils.log_user_action not importable)")
+    def _shutdown_log_writer():
+        return None
+    def _log_writer_stats():
+        return {"queued": 0, "max_queued": 0, "dropped": 0}
 
 # Expose unified names used below
-log_step_result = _log_step_result
-log_guideline_edit_prompt = _log_guideline_edit_prompt
-log_guideline_updated = _log_guideline_updated
-log_user_action = _log_user_action
+log_step_result = _profile_phase("log")(_log_step_result)
+log_guideline_edit_prompt = _profile_phase("log")(_log_guideline_edit_prompt)
+log_guideline_updated = _profile_phase("log")(_log_guideline_updated)
+log_user_action = _profile_phase("log")(_log_user_action)
+log_user_actions = _profile_phase("log")(_log_user_actions)
+query_user_actions = _query_user_actions
+
+@app.on_event("shutdown")
+def _drain_action_logs():
+    _shutdown_log_writer()
 
 # Safe import for constants (fallback to env/defaults if missing)
 try:
@@ -117,8 +619,6 @@ except Exception:
 from fastapi import Request
 import httpx
 
-guideline_update_cache: dict = {}
-
 # Support both /api/log-user-action and legacy path
 @api.post("/log-user-action")
 async def log_user_action_api(request: Request):
@@ -128,7 +628,13 @@ async def log_user_action_api(request: Request):
         step_info = (data or {}).get('content', '')
         details = (data or {}).get('details', {})
         # Call project logger (no-op if unavailable)
-        log_user_action(action_type, step_info, details)
+        log_user_action(
+            action_type,
+            step_info,
+            details,
+            user_id=(data or {}).get('userId'),
+            session_id=(data or {}).get('sessionId'),
+        )
         return {"status": "ok"}
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": str(e)})
@@ -137,28 +643,277 @@ async def log_user_action_api(request: Request):
 @api.post("/log-user-action/")
 async def log_user_action_api_slash(request: Request):
     return await log_user_action_api(request)
+
+# Batch ingestion: the frontend buffers actions and posts them together, either
+# as a JSON array or {"events": [...]}, optionally gzip-compressed.
+LOG_BATCH_MAX_EVENTS = int(os.getenv("LOG_BATCH_MAX_EVENTS", "5000"))
+
+@api.post("/log-user-actions")
+async def log_user_actions_api(request: Request):
+    try:
+        body = await request.body()
+        if request.headers.get("content-encoding", "").lower() == "gzip":
+            body = gzip.decompress(body)
+        data = json.loads(body or b"[]")
+        events = data.get("events", []) if isinstance(data, dict) else data
+        defaults = data if isinstance(data, dict) else {}
+        if not isinstance(events, list) or not all(isinstance(e, dict) for e in events):
+            return JSONResponse(status_code=400, content={"error": "Expected a JSON array of events or {\"events\": [...]}"})
+        if len(events) > LOG_BATCH_MAX_EVENTS:
+            return JSONResponse(status_code=413, content={"error": f"Too many events in one batch (max {LOG_BATCH_MAX_EVENTS})"})
+        log_user_actions(events, user_id=defaults.get("userId"), session_id=defaults.get("sessionId"))
+        return {"status": "ok", "count": len(events)}
+    except (OSError, EOFError, ValueError) as e:
+        return JSONResponse(status_code=400, content={"error": f"Invalid log batch: {e}"})
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"error": str(e)})
+
+@api.post("/log-user-actions/")
+async def log_user_actions_api_slash(request: Request):
+    return await log_user_actions_api(request)
+
+def _parse_log_time(value: str = None):
+    """Epoch seconds or an ISO-8601 timestamp (naive means UTC)."""
+    if value is None or value == "":
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo=timezone.utc)
+        return parsed.timestamp()
+
+@api.get("/logs/query")
+async def query_action_logs(
+    request: Request,
+    user_id: str = None,
+    session_id: str = None,
+    action_type: str = None,
+    step: str = None,
+    since: str = None,
+    until: str = None,
+    limit: int = 100,
+):
+    """Indexed lookup over the sharded action logs; no full-file scans. Needs X-Admin-Token."""
+    if not _is_admin(request):
+        return _admin_required()
+    try:
+        since_ts, until_ts = _parse_log_time(since), _parse_log_time(until)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": f"Invalid since/until: {e}"})
+    try:
+        events = await asyncio.to_thread(
+            query_user_actions,
+            user_id=user_id,
+            session_id=session_id,
+            action_type=action_type,
+            step=step,
+            since=since_ts,
+            until=until_ts,
+            limit=max(1, min(limit, 1000)),
+        )
+    except RuntimeError as e:
+        return JSONResponse(status_code=503, content={"error": str(e)})
+    return {"count": len(events), "events": events}
     
 from pydantic import BaseModel
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional
 
 
 # Pydantic 모델 정의
 class Step2Request(BaseModel):
     task: str
-    image_base64: str
+    image_base64: str = ""
     app_ui: Dict[str, Any]
+    run_id: Optional[str] = None
 
 class Step3Request(BaseModel):
     task: str
-    image_base64: str
+    image_base64: str = ""
     app_ui: Dict[str, Any]
     app_ui_components: Dict[str, Any]
+    run_id: Optional[str] = None
 
 class Step4Request(BaseModel):
     task: str
-    image_base64: str
+    image_base64: str = ""
     app_ui: dict
-    step3_results: dict
+    step3_results: Optional[dict] = None  # defaults to the run's step3
+    run_id: Optional[str] = None
+
+
+# --- 파이프라인 세션 저장소 ---
+# A run keeps the image and every step's parsed result server-side, so later
+# steps only need the run_id instead of re-uploading the whole pipeline state.
+RUN_TTL_SECONDS = int(os.getenv("RUN_TTL_SECONDS", "7200"))
+RUN_STORE_MAX = int(os.getenv("RUN_STORE_MAX", "256"))
+
+class _RunStore:
+    """In-memory pipeline runs keyed by run_id, evicted when idle or over capacity."""
+
+    def __init__(self, ttl_seconds: int, max_runs: int):
+        self._ttl = ttl_seconds
+        self._max = max_runs
+        self._runs: "OrderedDict[str, dict]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _evict(self, now: float):
+        # Runs are kept in least-recently-used order, so expiry only checks the head
+        while self._runs:
+            oldest = next(iter(self._runs.values()))
+            if len(self._runs) > self._max or now - oldest["_touched"] > self._ttl:
+                self._runs.popitem(last=False)
+            else:
+                break
+
+    def create(self, **fields) -> str:
+        run_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._runs[run_id] = {**fields, "_created": now, "_touched": now}
+            self._evict(now)
+        return run_id
+
+    def get(self, run_id: str) -> Optional[dict]:
+        now = time.time()
+        with self._lock:
+            self._evict(now)
+            run = self._runs.get(run_id)
+            if run is not None:
+                run["_touched"] = now
+                self._runs.move_to_end(run_id)
+            return run
+
+    def update(self, run_id: str, **fields):
+        with self._lock:
+            run = self._runs.get(run_id)
+            if run is not None:
+                run.update(fields)
+                run["_touched"] = time.time()
+                self._runs.move_to_end(run_id)
+
+    def __len__(self) -> int:
+        return len(self._runs)
+
+_runs = _RunStore(RUN_TTL_SECONDS, RUN_STORE_MAX)
+
+def _unknown_run(run_id: str) -> JSONResponse:
+    return JSONResponse(status_code=404, content={"error": f"Unknown or expired run_id: {run_id}"})
+
+def _form_or_run(run: Optional[dict], key: str, raw_str: Optional[str] = None):
+    """Prefer an explicitly posted YAML/JSON string (e.g. edited tables), else the run's copy."""
+    if raw_str:
+        return _load_yaml(raw_str)
+    return (run or {}).get(key)
+
+
+# --- 오프라인 LLM 백엔드 (벤치마크/개발용) ---
+# LLM_BACKEND=fake answers every conversation from recorded replies after
+# FAKE_LLM_LATENCY_MS instead of calling OpenAI, so the pipeline's own overhead
+# can be measured offline. LLM_RECORD_PATH captures real replies in that format.
+LLM_BACKEND = os.getenv("LLM_BACKEND", "openai").lower()
+FAKE_LLM_RESPONSES = os.getenv(
+    "FAKE_LLM_RESPONSES", os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench", "responses.json")
+)
+FAKE_LLM_LATENCY_MS = float(os.getenv("FAKE_LLM_LATENCY_MS", "0"))
+# Extra exponentially distributed latency (mean, ms) and a share of calls that
+# fail with a connection error, to exercise the call policy offline
+FAKE_LLM_JITTER_MS = float(os.getenv("FAKE_LLM_JITTER_MS", "0"))
+FAKE_LLM_FAILURE_RATE = float(os.getenv("FAKE_LLM_FAILURE_RATE", "0"))
+LLM_RECORD_PATH = os.getenv("LLM_RECORD_PATH")
+_recording_lock = threading.Lock()
+
+def _prompt_signature(message: str) -> str:
+    """First non-empty prompt line; recorded replies are matched on it."""
+    for line in str(message).splitlines():
+        if line.strip():
+            return line.strip()
+    return ""
+
+def _load_recording(path: str) -> dict:
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def _record_reply(agent_name: str, message: str, reply: str):
+    """Append a real reply to LLM_RECORD_PATH unless that prompt is already recorded."""
+    signature = _prompt_signature(message)
+    with _recording_lock:
+        recording = _load_recording(LLM_RECORD_PATH)
+        entries = recording.setdefault(agent_name, [])
+        if any(entry.get("match") == signature for entry in entries):
+            return
+        entries.append({"match": signature, "reply": reply})
+        with open(LLM_RECORD_PATH, "w", encoding="utf-8") as f:
+            json.dump(recording, f, ensure_ascii=False, indent=2)
+
+class _FakeUserProxy:
+    """Stand-in for UserProxyAgent that replays recorded replies.
+
+    Recordings map an agent name to ``[{"match": ..., "reply": ...}]``; the first
+    entry whose ``match`` occurs in the prompt wins, and an entry without
+    ``match`` is the fallback, so replays are deterministic. An entry with
+    ``per_section`` instead of ``reply`` answers a batched multi-section prompt
+    by repeating that YAML under every requested section name.
+    """
+
+    _responses: Optional[dict] = None
+
+    @classmethod
+    def _replies(cls) -> dict:
+        with _recording_lock:
+            if cls._responses is None:
+                cls._responses = _load_recording(FAKE_LLM_RESPONSES)
+            return cls._responses
+
+    def initiate_chat(self, recipient, message: str = "", **kwargs):
+        entries = self._replies().get(recipient.name)
+        if not entries:
+            raise RuntimeError(f"No recorded reply for agent '{recipient.name}' in {FAKE_LLM_RESPONSES}")
+        entry = next((e for e in entries if e.get("match") and e["match"] in message), None)
+        if entry is None:
+            entry = next((e for e in entries if not e.get("match")), entries[0])
+        reply = entry["reply"] if "reply" in entry else self._per_section_reply(entry["per_section"], message)
+        latency_ms = FAKE_LLM_LATENCY_MS + (random.expovariate(1 / FAKE_LLM_JITTER_MS) if FAKE_LLM_JITTER_MS > 0 else 0)
+        if latency_ms > 0:
+            time.sleep(latency_ms / 1000)
+        if FAKE_LLM_FAILURE_RATE > 0 and random.random() < FAKE_LLM_FAILURE_RATE:
+            raise ConnectionError("fake LLM backend: simulated connection failure")
+        return SimpleNamespace(
+            chat_history=[
+                {"role": "user", "content": message},
+                {"role": "assistant", "name": recipient.name, "content": reply},
+            ],
+            summary=reply,
+            cost={},
+        )
+
+    @staticmethod
+    def _per_section_reply(body: str, message: str) -> str:
+        start = message.find(_BATCH_SECTIONS_PREFIX)
+        names = json.JSONDecoder().raw_decode(message, start + len(_BATCH_SECTIONS_PREFIX))[0] if start != -1 else []
+        indented = "\n".join("  " + line for line in body.strip().splitlines())
+        return "```yaml\n" + "".join(f"{json.dumps(name, ensure_ascii=False)}:\n{indented}\n" for name in names) + "```"
+
+
+def _new_user_proxy():
+    """Create a fresh proxy for one conversation.
+
+    Autogen keeps chat history per (sender, recipient) pair, so concurrent
+    section calls each need their own sender to avoid mixing histories.
+    """
+    if LLM_BACKEND == "fake":
+        return _FakeUserProxy()
+    return UserProxyAgent(
+        name="User_proxy",
+        system_message="A human admin.",
+        human_input_mode="NEVER",
+        max_consecutive_auto_reply=0,
+        code_execution_config={"use_docker": False},
+    )
 
 
 # === Autogen config ===
@@ -185,18 +940,16 @@ if AUTOGEN_AVAILABLE:
                     print("Config JSON load error:", e)
                     config_list_4v = []
                     config_list_o3 = []
+        if LLM_BACKEND == "fake":
+            # Agents still need a config to build; the fake proxy never calls it
+            config_list_4v = config_list_4v or [{"model": "gpt-4o", "api_key": "fake"}]
+            config_list_o3 = config_list_o3 or [{"model": "o3-mini", "api_key": "fake"}]
         if not config_list_4v or not config_list_o3:
             raise RuntimeError("LLM config missing: set OPENAI_API_KEY or OAI_CONFIG_LIST_JSON")
 
         llm_config = {"config_list": config_list_4v, "temperature": 0, "cache_seed": 42}
         eval_config = {"config_list": config_list_o3, "cache_seed": 42}
-        user_proxy = UserProxyAgent(
-            name="User_proxy",
-            system_message="A human admin.",
-            human_input_mode="NEVER",
-            max_consecutive_auto_reply=0,
-            code_execution_config={"use_docker": False},
-        )
+        user_proxy = _new_user_proxy()
     except Exception:
         config_list_4v = []
         config_list_o3 = []
@@ -210,56 +963,1506 @@ else:
     eval_config = {}
     user_proxy = None
 
-# Helper: fetch image from Next.js public URL and return base64 string
+# --- 공용 LRU 캐시 ---
+class _LRUCache:
+    """Thread-safe in-memory LRU with optional TTL and hit/miss counters."""
+
+    def __init__(self, maxsize: int, ttl_seconds: Optional[float] = None):
+        self.maxsize = max(1, maxsize)
+        self.ttl = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and self.ttl is not None and time.time() - item[1] > self.ttl:
+                del self._data[key]
+                item = None
+            if item is None:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key: str, value):
+        with self._lock:
+            self._data[key] = (value, time.time())
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return key in self._data
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        return {"size": len(self._data), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
+
+
+# --- 영구 캐시 (SQLite) ---
+class _SqliteCache:
+    """Size-bounded JSON key/value table in SQLite, shared by every worker on the host.
+
+    Falls back to a no-op (always miss) when the database cannot be opened,
+    e.g. on a read-only serverless filesystem.
+    """
+
+    def __init__(self, path: str, table: str, max_entries: int, ttl_seconds: Optional[float] = None):
+        self.path = path
+        self.table = table
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = None
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            conn = sqlite3.connect(path, timeout=5.0, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_accessed ON {table}(accessed)")
+            conn.commit()
+            self._conn = conn
+        except Exception as e:
+            logger.warning("Cache %r disabled, cannot open %s: %s", table, path, e)
+
+    def get(self, key: str):
+        if self._conn is None:
+            self.misses += 1
+            return None
+        now = time.time()
+        with self._lock:
+            try:
+                row = self._conn.execute(f"SELECT value, created FROM {self.table} WHERE key = ?", (key,)).fetchone()
+                if row is not None and self.ttl is not None and now - row[1] > self.ttl:
+                    self._conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+                    row = None
+                elif row is not None:
+                    self._conn.execute(f"UPDATE {self.table} SET accessed = ? WHERE key = ?", (now, key))
+                self._conn.commit()
+            except sqlite3.Error as e:
+                logger.warning("Cache %r read failed: %s", self.table, e)
+                row = None
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key: str, value):
+        if self._conn is None:
+            return
+        now = time.time()
+        payload = json.dumps(value, ensure_ascii=False, default=str)
+        with self._lock:
+            try:
+                self._conn.execute(
+                    f"INSERT OR REPLACE INTO {self.table} (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                    (key, payload, now, now),
+                )
+                # Evict least recently used rows beyond the bound
+                self._conn.execute(
+                    f"DELETE FROM {self.table} WHERE key IN (SELECT key FROM {self.table} "
+                    "ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,),
+                )
+                self._conn.commit()
+            except sqlite3.Error as e:
+                logger.warning("Cache %r write failed: %s", self.table, e)
+
+    def __len__(self) -> int:
+        if self._conn is None:
+            return 0
+        with self._lock:
+            return self._conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self._conn is not None,
+            "path": self.path,
+            "entries": len(self),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+# --- 이미지 저장소 (content hash 기반) ---
+# Screenshots are loaded once (local public/stores first, HTTP only as a
+# fallback), keyed by the sha256 of their bytes, and kept base64-encoded in an
+# LRU so every later step reuses them without network I/O or re-encoding.
+IMAGE_CACHE_SIZE = int(os.getenv("IMAGE_CACHE_SIZE", "32"))
+REMOTE_IMAGE_BASE = os.getenv("REMOTE_IMAGE_BASE", "https://ui-design-critique-generation.vercel.app")
+
+_api_dir = os.path.dirname(os.path.abspath(__file__))
+_image_dirs = list(dict.fromkeys([
+    os.path.dirname(str(IMAGE_PATH)),
+    os.path.join(os.getcwd(), "public", "stores"),
+    os.path.join(_api_dir, "..", "public", "stores"),
+    _api_dir,
+]))
+_image_cache = _LRUCache(IMAGE_CACHE_SIZE)  # digest -> base64
+_image_digests: Dict[str, tuple] = {}  # filename -> (source stamp, digest)
+_image_verdicts: Dict[str, tuple] = {}  # local path -> (source stamp, decodes as an image)
+_image_index_lock = threading.Lock()  # both dicts are also touched from to_thread workers
+_http_client: Optional[httpx.AsyncClient] = None
+
+def _image_mime(filename: str) -> str:
+    name = str(filename).lower()
+    if name.endswith((".jpg", ".jpeg")):
+        return "image/jpeg"
+    return "image/webp" if name.endswith(".webp") else "image/png"
+
+def _image_digest(image_base64: str) -> str:
+    """Content hash of an already-encoded image (hash of the raw bytes)."""
+    try:
+        data = base64.b64decode(image_base64)
+    except ValueError:
+        data = image_base64.encode("utf-8")
+    return hashlib.sha256(data).hexdigest()
+
+def _store_image_bytes(data: bytes) -> tuple:
+    digest = hashlib.sha256(data).hexdigest()
+    encoded = _image_cache.get(digest)
+    if encoded is None:
+        encoded = base64.b64encode(data).decode("utf-8")
+        _image_cache.set(digest, encoded)
+    return digest, encoded
+
+def _image_source_unchanged(stamp) -> bool:
+    # Local files are re-validated with a cheap stat; remote URLs are trusted
+    if isinstance(stamp, tuple):
+        path, mtime_ns, size = stamp
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        return stat.st_mtime_ns == mtime_ns and stat.st_size == size
+    return True
+
+def _is_image_bytes(data: bytes) -> bool:
+    if Image is None:
+        return True  # cannot check without Pillow
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            img.verify()
+    except Exception:
+        return False
+    return True
+
+def _read_local_image(filename: str) -> Optional[tuple]:
+    for directory in _image_dirs:
+        path = os.path.join(directory, filename)
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            stamp = (path, stat.st_mtime_ns, stat.st_size)
+            # Each version of a file is decoded once; later reads reuse the verdict
+            with _image_index_lock:
+                verdict = _image_verdicts.get(path)
+            valid = verdict[1] if verdict is not None and verdict[0] == stamp else None
+            # Placeholders (e.g. the empty api/67512.jpg) are misses, so a
+            # deployment without public/stores still falls back to HTTP
+            if stat.st_size == 0 or valid is False:
+                continue
+            with open(path, "rb") as f:
+                data = f.read()
+            if valid is None:
+                valid = _is_image_bytes(data)
+                with _image_index_lock:
+                    _image_verdicts[path] = (stamp, valid)
+                if not valid:
+                    logger.warning("Skipping unreadable image %s", path)
+                    continue
+            return stamp, data
+    return None
+
+def _get_http_client() -> httpx.AsyncClient:
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(timeout=10.0)
+    return _http_client
+
+@app.on_event("shutdown")
+async def _close_http_client():
+    if _http_client is not None:
+        await _http_client.aclose()
+
+# Helper: load image (local store first, then public URL) and return base64 string
 async def _get_public_image_base64(request: Request, filename: str) -> str:
-    base = str(request.base_url).rstrip('/')
-    # Primary URL (same-origin in production on Vercel)
-    primary_url = f"{base}/stores/{filename}"
-    candidate_urls = [primary_url]
-    # Local dev: FastAPI runs on :8000 and Next.js serves /stores on :3000
-    
-    candidate_urls = [
-        f"https://ui-design-critique-generation.vercel.app/stores/{filename}",
-        f"https://ui-design-critique-generation.vercel.app/stores/{filename}",
-        primary_url,
+    return await _load_image_base64(filename, str(request.base_url))
+
+@_profile_phase("fetch_image")
+async def _load_image_base64(filename: str, base_url: Optional[str] = None) -> str:
+    """Base64 of a public/stores image; ``base_url`` adds a same-origin HTTP fallback."""
+    filename = os.path.basename(filename)
+    with _image_index_lock:
+        known = _image_digests.get(filename)
+    if known is not None and _image_source_unchanged(known[0]):
+        cached = _image_cache.get(known[1])
+        if cached is not None:
+            return cached
+
+    local = await asyncio.to_thread(_read_local_image, filename)
+    if local is not None:
+        stamp, data = local
+        digest, encoded = _store_image_bytes(data)
+        with _image_index_lock:
+            _image_digests[filename] = (stamp, digest)
+        return encoded
+
+    candidate_urls = [f"{REMOTE_IMAGE_BASE}/stores/{filename}"]
+    if base_url:
+        candidate_urls.append(f"{base_url.rstrip('/')}/stores/{filename}")
+    candidate_urls = list(dict.fromkeys(candidate_urls))
+    last_err = None
+    for url in candidate_urls:
+        try:
+            resp = await _get_http_client().get(url)
+            resp.raise_for_status()
+            digest, encoded = _store_image_bytes(resp.content)
+            with _image_index_lock:
+                _image_digests[filename] = (url, digest)
+            return encoded
+        except Exception as e:
+            last_err = e
+    raise HTTPException(status_code=404, detail=f"Failed to fetch image from candidates: {candidate_urls}. Error: {last_err or 'Image fetch failed'}")
+
+# --- 이미지 전처리 (축소/재압축) ---
+# Screenshots are downscaled and recompressed once per image (keyed by content
+# digest) before being embedded in prompts. With the defaults the image fits
+# the same 2048px box / 768px short side that OpenAI's high-detail mode resizes
+# to server-side, so the model sees the same pixels for far fewer upload bytes.
+IMAGE_PREPROCESS = os.getenv("IMAGE_PREPROCESS", "1") != "0"
+IMAGE_MAX_DIM = int(os.getenv("IMAGE_MAX_DIM", "2048"))        # long side cap, 0 = none
+IMAGE_SHORT_SIDE = int(os.getenv("IMAGE_SHORT_SIDE", "768"))   # short side cap, 0 = none
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "jpeg").lower()       # jpeg | webp | png | original
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "85"))
+IMAGE_DETAIL = os.getenv("IMAGE_DETAIL", "auto").lower()       # OpenAI detail: auto | low | high
+# Part of the step cache key, so changing these settings never serves stale results
+_IMAGE_VARIANT = (
+    f"{IMAGE_MAX_DIM}/{IMAGE_SHORT_SIDE}/{IMAGE_FORMAT}/{IMAGE_QUALITY}/{IMAGE_DETAIL}"
+    if IMAGE_PREPROCESS else f"original/{IMAGE_DETAIL}"
+)
+_IMAGE_MIMES = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png"}
+_processed_images = _LRUCache(IMAGE_CACHE_SIZE)  # digest -> (mime, base64)
+
+def _preprocess_image_bytes(data: bytes) -> Optional[tuple]:
+    """``(mime, bytes)`` of the downscaled/recompressed image, or None to keep the original."""
+    if Image is None:
+        return None
+    with Image.open(io.BytesIO(data)) as img:
+        img.load()
+        source_format = img.format
+        width, height = img.size
+        scale = 1.0
+        if IMAGE_MAX_DIM > 0:
+            scale = min(scale, IMAGE_MAX_DIM / max(width, height))
+        if IMAGE_SHORT_SIDE > 0:
+            scale = min(scale, IMAGE_SHORT_SIDE / min(width, height))
+        if scale < 1:
+            img = img.resize((max(1, round(width * scale)), max(1, round(height * scale))), Image.LANCZOS)
+
+        fmt = source_format if IMAGE_FORMAT == "original" else IMAGE_FORMAT.upper()
+        if fmt not in _IMAGE_MIMES or (scale >= 1 and fmt == source_format):
+            return None
+        if fmt == "JPEG" and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        out = io.BytesIO()
+        if fmt == "PNG":
+            img.save(out, "PNG", optimize=True)
+        else:
+            img.save(out, fmt, quality=IMAGE_QUALITY)
+    processed = out.getvalue()
+    if scale >= 1 and len(processed) >= len(data):
+        return None
+    return _IMAGE_MIMES[fmt], processed
+
+def _processed_image(image: dict) -> tuple:
+    """``(mime, base64)`` actually sent to the vision model for an ``_image_ref`` dict."""
+    original = (_image_mime(image["filename"]), image["base64"])
+    if not IMAGE_PREPROCESS:
+        return original
+    cached = _processed_images.get(image["digest"])
+    if cached is not None:
+        return cached
+    try:
+        result = _preprocess_image_bytes(base64.b64decode(image["base64"]))
+    except Exception as e:
+        logger.warning("Image preprocessing failed, sending original: %s", e)
+        result = None
+    if result is None:
+        processed = original
+    else:
+        mime, data = result
+        processed = (mime, base64.b64encode(data).decode("utf-8"))
+        logger.debug("Image %s preprocessed: %d -> %d base64 chars", image["digest"][:12], len(image["base64"]), len(processed[1]))
+    _processed_images.set(image["digest"], processed)
+    return processed
+
+def _vision_messages(messages: list) -> list:
+    """OpenAI messages with <img> data URLs passed through as-is (plus ``detail``)."""
+    formatted = []
+    for message in messages:
+        if isinstance(message, dict) and isinstance(message.get("content"), list):
+            content = []
+            for item in message["content"]:
+                if isinstance(item, dict) and "image_url" in item:
+                    url = item["image_url"]["url"]
+                    image_url = {"url": url if isinstance(url, str) else pil_to_data_uri(url)}
+                    if IMAGE_DETAIL != "auto":
+                        image_url["detail"] = IMAGE_DETAIL
+                    item = {**item, "image_url": image_url}
+                content.append(item)
+            message = {**message, "content": content}
+        formatted.append(message)
+    return formatted
+
+if AUTOGEN_AVAILABLE:
+    from autogen._pydantic import model_dump
+    from autogen.agentchat.contrib.img_utils import gpt4v_formatter, pil_to_data_uri
+
+    class _VisionAgent(MultimodalConversableAgent):
+        """MultimodalConversableAgent that keeps <img> data URLs as they are.
+
+        The stock agent decodes every image to PIL and re-encodes it as PNG on
+        each call, which would undo the preprocessing above (and a 1080x1920
+        screenshot as PNG is several times the size of the JPEG).
+        """
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.replace_reply_func(MultimodalConversableAgent.generate_oai_reply, _VisionAgent.generate_oai_reply)
+
+        @staticmethod
+        def _message_to_dict(message):
+            if isinstance(message, str):
+                return {"content": gpt4v_formatter(message, img_format="url")}
+            if isinstance(message, dict) and isinstance(message.get("content"), str):
+                return {**message, "content": gpt4v_formatter(message["content"], img_format="url")}
+            return MultimodalConversableAgent._message_to_dict(message)
+
+        def generate_oai_reply(self, messages=None, sender=None, config=None):
+            client = self.client if config is None else config
+            if client is None:
+                return False, None
+            if messages is None:
+                messages = self._oai_messages[sender]
+            response = client.create(
+                context=messages[-1].pop("context", None),
+                messages=_vision_messages(self._oai_system_message + messages),
+            )
+            reply = client.extract_text_or_completion_object(response)[0]
+            if not isinstance(reply, str):
+                reply = model_dump(reply)
+            return True, reply
+else:
+    _VisionAgent = None  # type: ignore
+
+# --- LLM 호출 계측 (토큰/지연/비용) ---
+# Every conversation is recorded with its step, section, model, token usage,
+# cost, image payload size, wall time and cache hits. Process totals are
+# exported on /api/metrics (Prometheus text format); the calls made while
+# serving a request are summarised under "usage" in step responses, and
+# accumulated per run under "run_usage".
+LLM_USAGE_TRACKING = os.getenv("LLM_USAGE_TRACKING", "1") != "0"
+_AGENT_STEPS = {
+    "UILayoutIdentifier": "step1",
+    "UIComponentIdentifier": "step2",
+    "UIComponentAnalyzer": "step3",
+    "UILayoutAnalyzer": "step4",
+    "UILayoutEvaluator": "step5",
+    "UIComponentEvaluator": "step6",
+    "FinalEvaluator": "step7",
+    "GLEditor": "update_guidelines",
+    "BaseEvaluator": "baseline",
+}
+_LLM_SECONDS_BUCKETS = (0.5, 1, 2, 5, 10, 20, 30, 60, 120)
+_USAGE_FIELDS = ("llm_calls", "cached_calls", "prompt_tokens", "completion_tokens", "cost_usd", "llm_seconds", "image_bytes")
+
+# (step, section) of the LLM call being made; set by _memoized_call
+_trace_scope: ContextVar = ContextVar("trace_scope", default=(None, None))
+# _UsageSummary of the request or job being served
+_request_usage: ContextVar = ContextVar("request_usage", default=None)
+# Usage of the completion(s) made by the conversation running on this thread
+_llm_thread = threading.local()
+
+class _Metrics:
+    """Minimal in-process Prometheus registry: labelled counters and histograms."""
+
+    _HELP = {
+        "critique_llm_calls_total": ("counter", "LLM conversations by step, model and autogen cache hit."),
+        "critique_llm_errors_total": ("counter", "LLM conversations that raised."),
+        "critique_llm_prompt_tokens_total": ("counter", "Prompt tokens sent."),
+        "critique_llm_completion_tokens_total": ("counter", "Completion tokens received."),
+        "critique_llm_cost_usd_total": ("counter", "Estimated OpenAI cost in USD (cached replies are free)."),
+        "critique_llm_image_bytes_total": ("counter", "Base64 image payload bytes embedded in prompts."),
+        "critique_step_cache_requests_total": ("counter", "Persistent step cache lookups by result."),
+        "critique_llm_retries_total": ("counter", "LLM attempts retried after a transient error, by error type."),
+        "critique_llm_hedges_total": ("counter", "Hedged LLM requests fired, and those that answered first."),
+        "critique_client_disconnects_total": ("counter", "Requests whose remaining work was cancelled because the client left."),
+        "critique_structured_output_total": ("counter", "LLM YAML replies by parse outcome (clean, repaired, salvaged, failed)."),
+        "critique_llm_call_seconds": ("histogram", "Wall time of one LLM conversation."),
+        "critique_llm_admission_wait_seconds": ("histogram", "Time an LLM attempt queued for admission."),
+    }
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: dict = {}
+        self._histograms: dict = {}
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple:
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name: str, labels: dict, value: float = 1.0):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0.0) + value
+
+    def observe(self, name: str, labels: dict, value: float):
+        key = self._key(name, labels)
+        with self._lock:
+            hist = self._histograms.setdefault(key, [0] * len(_LLM_SECONDS_BUCKETS) + [0.0, 0])
+            for i, bound in enumerate(_LLM_SECONDS_BUCKETS):
+                if value <= bound:
+                    hist[i] += 1
+            hist[-2] += value
+            hist[-1] += 1
+
+    @staticmethod
+    def _labels(labels, extra: tuple = ()) -> str:
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+        return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+    def render(self, gauges: list = ()) -> str:
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {k: list(v) for k, v in self._histograms.items()}
+        lines = []
+        for name, (kind, help_text) in self._HELP.items():
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            if kind == "counter":
+                for (metric, labels), value in sorted(counters.items()):
+                    if metric == name:
+                        lines.append(f"{name}{self._labels(labels)} {value:g}")
+                continue
+            for (metric, labels), hist in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                for i, bound in enumerate(_LLM_SECONDS_BUCKETS):
+                    lines.append(f"{name}_bucket{self._labels(labels, (('le', f'{bound:g}'),))} {hist[i]}")
+                lines.append(f"{name}_bucket{self._labels(labels, (('le', '+Inf'),))} {hist[-1]}")
+                lines.append(f"{name}_sum{self._labels(labels)} {hist[-2]:g}")
+                lines.append(f"{name}_count{self._labels(labels)} {hist[-1]}")
+        for name, help_text, samples in gauges:
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+            lines += [f"{name}{self._labels(sorted(labels.items()))} {value:g}" for labels, value in samples]
+        return "\n".join(lines) + "\n"
+
+_metrics = _Metrics()
+
+def _empty_usage() -> dict:
+    return {field: 0 for field in _USAGE_FIELDS}
+
+def _round_usage(usage: dict) -> dict:
+    usage["cost_usd"] = round(usage["cost_usd"], 6)
+    usage["llm_seconds"] = round(usage["llm_seconds"], 3)
+    return usage
+
+class _UsageSummary:
+    """LLM calls and step cache hits while serving one request or job."""
+
+    def __init__(self):
+        self.calls: list = []
+        self.step_cache_hits = 0
+        self._lock = threading.Lock()
+
+    def add_call(self, record: dict):
+        with self._lock:
+            self.calls.append(record)
+
+    def add_cache_hit(self):
+        with self._lock:
+            self.step_cache_hits += 1
+
+    def summary(self) -> dict:
+        with self._lock:
+            calls = list(self.calls)
+        totals, by_step = _empty_usage(), {}
+        for call in calls:
+            for bucket in (totals, by_step.setdefault(call["step"], _empty_usage())):
+                bucket["llm_calls"] += 1
+                bucket["cached_calls"] += int(call["cached"])
+                bucket["prompt_tokens"] += call["prompt_tokens"]
+                bucket["completion_tokens"] += call["completion_tokens"]
+                bucket["cost_usd"] += call["cost_usd"]
+                bucket["llm_seconds"] += call["seconds"]
+                bucket["image_bytes"] += call["image_bytes"]
+        return {
+            **_round_usage(totals),
+            "step_cache_hits": self.step_cache_hits,
+            "by_step": {step: _round_usage(usage) for step, usage in by_step.items()},
+            "calls": calls,
+        }
+
+def _merge_usage(total: Optional[dict], summary: dict) -> dict:
+    """Add a request summary (minus its call list) to a run's running total."""
+    total = {**_empty_usage(), "step_cache_hits": 0, **(total or {})}
+    total["by_step"] = {step: dict(usage) for step, usage in (total.get("by_step") or {}).items()}
+    for field in _USAGE_FIELDS + ("step_cache_hits",):
+        total[field] += summary[field]
+    for step, usage in summary["by_step"].items():
+        bucket = total["by_step"].setdefault(step, _empty_usage())
+        for field in _USAGE_FIELDS:
+            bucket[field] += usage[field]
+        _round_usage(bucket)
+    return _round_usage(total)
+
+def _with_usage(response: dict, run_id: str = None) -> dict:
+    """Attach this request's LLM usage (and the run's running total) to a response."""
+    usage = _request_usage.get()
+    if usage is None:
+        return response
+    summary = usage.summary()
+    response["usage"] = summary
+    run = _runs.get(run_id) if run_id else None
+    if run is not None:
+        total = _merge_usage(run.get("usage"), summary)
+        _runs.update(run_id, usage=total)
+        response["run_usage"] = total
+    return response
+
+def _record_step_cache(step: str, hit: bool):
+    _metrics.inc("critique_step_cache_requests_total", {"step": step, "result": "hit" if hit else "miss"})
+    usage = _request_usage.get()
+    if hit and usage is not None:
+        usage.add_cache_hit()
+
+def _agent_model(agent) -> str:
+    try:
+        return agent.llm_config["config_list"][0]["model"]
+    except Exception:
+        return "unknown"
+
+def _image_payload_bytes(message: str) -> int:
+    total, start = 0, message.find("base64,")
+    while start != -1:
+        end = message.find(">", start)
+        end = len(message) if end == -1 else end
+        total += end - start - len("base64,")
+        start = message.find("base64,", end)
+    return total
+
+def _record_llm_call(step: str, section, model: str, usage: dict, image_bytes: int, seconds: float, failed: bool):
+    labels = {"step": step, "model": model}
+    cached = usage["requests"] > 0 and usage["cached"] == usage["requests"]
+    if failed:
+        _metrics.inc("critique_llm_errors_total", labels)
+    _metrics.inc("critique_llm_calls_total", {**labels, "cached": "true" if cached else "false"})
+    _metrics.inc("critique_llm_prompt_tokens_total", labels, usage["prompt_tokens"])
+    _metrics.inc("critique_llm_completion_tokens_total", labels, usage["completion_tokens"])
+    _metrics.inc("critique_llm_cost_usd_total", labels, usage["cost"])
+    _metrics.inc("critique_llm_image_bytes_total", labels, image_bytes)
+    _metrics.observe("critique_llm_call_seconds", labels, seconds)
+    summary = _request_usage.get()
+    if summary is not None:
+        summary.add_call({
+            "step": step,
+            "section": section,
+            "model": model,
+            "prompt_tokens": usage["prompt_tokens"],
+            "completion_tokens": usage["completion_tokens"],
+            "cost_usd": round(usage["cost"], 6),
+            "image_bytes": image_bytes,
+            "seconds": round(seconds, 3),
+            "cached": cached,
+            "failed": failed,
+        })
+
+if AUTOGEN_AVAILABLE and LLM_USAGE_TRACKING:
+    from autogen import runtime_logging
+    from autogen.logger.base_logger import BaseLogger
+
+    class _UsageLogger(BaseLogger):
+        """autogen runtime logger that adds each completion to the calling thread's usage."""
+
+        def start(self) -> str:
+            return "llm-usage"
+
+        def log_chat_completion(self, invocation_id, client_id, wrapper_id, source, request, response, is_cached, cost, start_time):
+            usage = getattr(_llm_thread, "usage", None)
+            if usage is None or isinstance(response, str):
+                return
+            tokens = getattr(response, "usage", None)
+            usage["requests"] += 1
+            usage["cached"] += int(bool(is_cached))
+            prompt_tokens = getattr(tokens, "prompt_tokens", 0) or 0
+            completion_tokens = getattr(tokens, "completion_tokens", 0) or 0
+            usage["prompt_tokens"] += prompt_tokens
+            usage["completion_tokens"] += completion_tokens
+            if not is_cached:
+                usage["cost"] += cost or 0.0
+                usage["billed_tokens"] += prompt_tokens + completion_tokens
+
+        def log_new_agent(self, agent, init_args):
+            pass
+
+        def log_event(self, source, name, **kwargs):
+            pass
+
+        def log_new_wrapper(self, wrapper, init_args):
+            pass
+
+        def log_new_client(self, client, wrapper, init_args):
+            pass
+
+        def log_function_use(self, source, function, args, returns):
+            pass
+
+        def stop(self):
+            pass
+
+        def get_connection(self):
+            return None
+
+    # Leave an already configured runtime logger (e.g. autogen's sqlite one) alone
+    if not runtime_logging.logging_enabled():
+        runtime_logging.start(logger=_UsageLogger())
+
+# Each request gets its own collector; child tasks (sections, SSE) share it
+@app.middleware("http")
+async def _collect_llm_usage(request: Request, call_next):
+    _request_usage.set(_UsageSummary())
+    _llm_user.set(request.headers.get("x-user-id") or (request.client.host if request.client else "anonymous"))
+    return await call_next(request)
+
+@api.get("/metrics")
+def metrics():
+    jobs = _jobs.stats()
+    admission = _admission.stats()
+    action_log = _log_writer_stats()
+    gauges = [
+        ("critique_active_runs", "Pipeline runs held in memory.", [({}, len(_runs))]),
+        ("critique_jobs", "Background jobs by status.", [({"status": s}, jobs[s]) for s in ("queued", "running", "done", "failed")]),
+        ("critique_llm_in_flight", "LLM attempts admitted and not yet finished.", [({}, admission["in_flight"])]),
+        ("critique_llm_queue_depth", "LLM attempts waiting for admission.", [({}, admission["queued"])]),
+        ("critique_llm_queued_users", "Users with LLM attempts waiting for admission.", [({}, len(admission["queued_by_user"]))]),
+        ("critique_action_log_queue_depth", "Action log submissions waiting for the writer thread.", [({}, action_log["queued"])]),
+        ("critique_action_log_dropped", "Action log entries dropped since start because the writer queue was full.", [({}, action_log["dropped"])]),
     ]
+    if admission["tokens_available"] is not None:
+        gauges.append(("critique_llm_tpm_available", "Tokens left in the per-minute bucket.", [({}, admission["tokens_available"])]))
+    return Response(_metrics.render(gauges), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+# --- LLM 호출 오프로딩 ---
+# autogen's initiate_chat is synchronous; run it on a dedicated pool so the
+# event loop keeps serving healthz, logging and other users meanwhile.
+LLM_WORKER_THREADS = max(1, int(os.getenv("LLM_WORKER_THREADS", "16")))
+_llm_executor = ThreadPoolExecutor(max_workers=LLM_WORKER_THREADS, thread_name_prefix="llm")
+
+# --- LLM 호출 정책 (deadline / retry / hedging) ---
+# Every conversation gets a per-step deadline (LLM_DEADLINE_SECONDS, overridden
+# per step by LLM_STEP_DEADLINES="step7=600,step1=90"), and each attempt is cut
+# at LLM_REQUEST_TIMEOUT_SECONDS, which is also the OpenAI client timeout so a
+# hung request frees its worker thread. Transient failures (timeouts,
+# connection errors, 408/409/429/5xx) are retried with jittered exponential
+# backoff, honouring Retry-After, each retry starting from the next
+# config_list entry. With LLM_HEDGE=1 a call still running after the step's
+# recent p95 latency fires a second request at the next entry and the first
+# answer wins; the loser is cancelled, and its usage is recorded once its
+# worker thread returns.
+LLM_REQUEST_TIMEOUT_SECONDS = float(os.getenv("LLM_REQUEST_TIMEOUT_SECONDS", "120"))
+LLM_DEADLINE_SECONDS = float(os.getenv("LLM_DEADLINE_SECONDS", "300"))
+LLM_STEP_DEADLINES = {
+    step.strip(): float(seconds)
+    for step, _, seconds in (item.partition("=") for item in os.getenv("LLM_STEP_DEADLINES", "").split(","))
+    if step.strip() and seconds.strip()
+}
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+LLM_RETRY_BASE_SECONDS = float(os.getenv("LLM_RETRY_BASE_SECONDS", "1"))
+LLM_RETRY_MAX_SECONDS = float(os.getenv("LLM_RETRY_MAX_SECONDS", "20"))
+LLM_HEDGE = os.getenv("LLM_HEDGE", "0") == "1"
+LLM_HEDGE_QUANTILE = float(os.getenv("LLM_HEDGE_QUANTILE", "0.95"))
+LLM_HEDGE_MIN_SECONDS = float(os.getenv("LLM_HEDGE_MIN_SECONDS", "2"))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "10"))
+
+# Retries are ours; the OpenAI client's own retries would multiply them
+for _entry in (*config_list_4v, *config_list_o3):
+    _entry.setdefault("timeout", LLM_REQUEST_TIMEOUT_SECONDS)
+    _entry.setdefault("max_retries", 0)
+
+_call_latencies: dict = {}  # step -> recent successful attempt seconds
+_latency_lock = threading.Lock()
+
+def _record_latency(step: str, seconds: float):
+    with _latency_lock:
+        _call_latencies.setdefault(step, deque(maxlen=200)).append(seconds)
+
+def _hedge_delay(step: str) -> Optional[float]:
+    """Seconds to wait before hedging a ``step`` call, or None without enough history."""
+    with _latency_lock:
+        samples = sorted(_call_latencies.get(step, ()))
+    if len(samples) < LLM_HEDGE_MIN_SAMPLES:
+        return None
+    return max(LLM_HEDGE_MIN_SECONDS, samples[min(len(samples) - 1, int(len(samples) * LLM_HEDGE_QUANTILE))])
+
+def _is_transient(error: BaseException) -> bool:
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    status = getattr(error, "status_code", None)
+    if status is not None:
+        return status in (408, 409, 429) or status >= 500
+    return type(error).__name__ in ("APIConnectionError", "APITimeoutError")
+
+def _retry_delay(error: BaseException, attempt: int) -> Optional[float]:
+    """Backoff before retrying ``error``, or None when it is not worth retrying."""
+    if not _is_transient(error):
+        return None
+    try:
+        retry_after = float(error.response.headers.get("retry-after"))
+    except (AttributeError, TypeError, ValueError):
+        retry_after = None
+    if retry_after is not None:
+        return min(retry_after, LLM_RETRY_MAX_SECONDS)
+    return min(LLM_RETRY_MAX_SECONDS, LLM_RETRY_BASE_SECONDS * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+def _agent_variant(agent, shift: int):
+    """``agent`` with its config_list rotated by ``shift``, so autogen tries another endpoint first."""
+    config = getattr(agent, "llm_config", None) or {}
+    entries = config.get("config_list") or []
+    if LLM_BACKEND == "fake" or len(entries) < 2 or shift % len(entries) == 0:
+        return agent
+    shift %= len(entries)
+    variant = copy.copy(agent)
+    variant.client = autogen.OpenAIWrapper(**{**config, "config_list": entries[shift:] + entries[:shift]})
+    return variant
+
+# --- LLM 호출 승인 제어 (admission control) ---
+# Every outbound attempt (retries and hedges included) is admitted here first:
+# at most LLM_MAX_IN_FLIGHT at once and, with LLM_TPM_LIMIT set, within a
+# tokens-per-minute bucket charged with an estimate of the prompt plus
+# LLM_COMPLETION_TOKEN_ESTIMATE and corrected with the real usage afterwards.
+# Waiting calls queue per user and users are served round-robin, so one
+# participant's step6 fan-out cannot starve the others. The user is the
+# X-User-Id header, which the frontend sends on every LLM-backed request
+# (participant id, else its tab session; see llmUserHeaders). The client
+# address is only a fallback for direct API callers: behind the platform proxy
+# it is the proxy's address unless uvicorn runs with --forwarded-allow-ips.
+# Background jobs and the batch runner each count as one user. Queue depth and admission wait time go to /metrics and /diag.
+LLM_MAX_IN_FLIGHT = max(1, int(os.getenv("LLM_MAX_IN_FLIGHT", str(LLM_WORKER_THREADS))))
+LLM_TPM_LIMIT = int(os.getenv("LLM_TPM_LIMIT", "0"))  # 0 = no token budget
+LLM_COMPLETION_TOKEN_ESTIMATE = int(os.getenv("LLM_COMPLETION_TOKEN_ESTIMATE", "1000"))
+LLM_IMAGE_TOKEN_ESTIMATE = int(os.getenv("LLM_IMAGE_TOKEN_ESTIMATE", "800"))
+
+_llm_user: ContextVar = ContextVar("llm_user", default="anonymous")
+
+class _AdmissionController:
+    """Round-robin admission of LLM calls across users under a concurrency cap and a TPM bucket."""
+
+    def __init__(self, max_in_flight: int, tokens_per_minute: int):
+        self._max_in_flight = max_in_flight
+        self._tpm = tokens_per_minute
+        self._tokens = float(tokens_per_minute)
+        self._refilled = time.monotonic()
+        self._in_flight = 0
+        self._queues: OrderedDict = OrderedDict()  # user -> deque[(future, cost, enqueued)]
+        self._timer = None
+        self._waits: deque = deque(maxlen=500)
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self._tpm, self._tokens + (now - self._refilled) * self._tpm / 60)
+        self._refilled = now
+
+    def _dispatch(self):
+        with self._lock:
+            while self._queues and self._in_flight < self._max_in_flight:
+                user, queue = next(iter(self._queues.items()))
+                future, cost, enqueued = queue[0]
+                if future.done():  # cancelled while queued
+                    queue.popleft()
+                else:
+                    if self._tpm:
+                        self._refill()
+                        if cost > self._tokens:
+                            # The head of the line waits for the bucket; later users do not overtake it
+                            self._schedule(future.get_loop(), (cost - self._tokens) * 60 / self._tpm)
+                            return
+                        self._tokens -= cost
+                    queue.popleft()
+                    self._in_flight += 1
+                    self._waits.append(time.monotonic() - enqueued)
+                    future.set_result(None)
+                    self._queues.move_to_end(user)
+                if not queue:
+                    del self._queues[user]
+
+    def _schedule(self, loop, delay: float):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = loop.call_later(delay, self._dispatch)
+
+    async def acquire(self, user: str, cost: int) -> int:
+        """Wait for a slot; ``cost`` is the estimated tokens of the call.
+
+        Returns the tokens actually taken from the bucket, which is what
+        ``release`` refunds against.
+        """
+        future = asyncio.get_running_loop().create_future()
+        cost = min(cost, self._tpm) if self._tpm else 0  # an oversized prompt still gets through
+        with self._lock:
+            self._queues.setdefault(user, deque()).append((future, cost, time.monotonic()))
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release(cost)  # admitted just as we were cancelled
+            else:
+                future.cancel()
+                self._discard(user, future)
+                self._dispatch()
+            raise
+        return cost
+
+    def _discard(self, user: str, future):
+        """Drop a cancelled waiter now rather than when it reaches the head of the line."""
+        with self._lock:
+            queue = self._queues.get(user)
+            if queue is None:
+                return
+            for entry in queue:
+                if entry[0] is future:
+                    queue.remove(entry)
+                    break
+            if not queue:
+                del self._queues[user]
+
+    def release(self, refund: float = 0):
+        """Free a slot; ``refund`` returns over-estimated tokens (negative charges the shortfall)."""
+        with self._lock:
+            self._in_flight -= 1
+            if self._tpm:
+                self._refill()
+                self._tokens = min(self._tpm, self._tokens + refund)
+        self._dispatch()
+
+    def stats(self) -> dict:
+        with self._lock:
+            if self._tpm:
+                self._refill()
+            waits = sorted(self._waits)
+            return {
+                "in_flight": self._in_flight,
+                "max_in_flight": self._max_in_flight,
+                "queued": sum(len(q) for q in self._queues.values()),
+                "queued_by_user": {user: len(q) for user, q in self._queues.items()},
+                "tpm_limit": self._tpm,
+                "tokens_available": round(self._tokens) if self._tpm else None,
+                "wait_p50_seconds": round(waits[len(waits) // 2], 3) if waits else None,
+                "wait_p95_seconds": round(waits[min(len(waits) - 1, int(len(waits) * 0.95))], 3) if waits else None,
+            }
+
+_admission = _AdmissionController(LLM_MAX_IN_FLIGHT, LLM_TPM_LIMIT)
+
+def _estimate_call_tokens(agent, message: str) -> int:
+    image_bytes = _image_payload_bytes(message)
+    text_chars = len(message) - image_bytes + len(str(getattr(agent, "system_message", "")))
+    return text_chars // 3 + message.count("<img ") * LLM_IMAGE_TOKEN_ESTIMATE + LLM_COMPLETION_TOKEN_ESTIMATE
+
+async def _llm_attempt(agent, message: str, kwargs: dict, step: str, section, timeout: float, deadline: float):
+    """One admitted conversation on the LLM pool, cut off after ``timeout`` seconds."""
+    usage = {"requests": 0, "cached": 0, "prompt_tokens": 0, "completion_tokens": 0, "cost": 0.0, "billed_tokens": 0}
+    estimate = _estimate_call_tokens(agent, message)
+    queued = time.perf_counter()
+    try:
+        charged = await asyncio.wait_for(_admission.acquire(_llm_user.get(), estimate), max(0.0, deadline - time.monotonic()))
+    except asyncio.TimeoutError:
+        raise TimeoutError(f"{step} LLM call not admitted before its deadline") from None
+    finally:
+        _metrics.observe("critique_llm_admission_wait_seconds", {"step": step}, time.perf_counter() - queued)
+    timeout = min(timeout, max(0.0, deadline - time.monotonic()))
+
+    sampler = _request_sampler.get()
+
+    def _call():
+        _llm_thread.usage = usage
+        try:
+            with _profiled_thread(sampler):
+                res = _new_user_proxy().initiate_chat(agent, message=message, **kwargs)
+        finally:
+            _llm_thread.usage = None
+        if LLM_RECORD_PATH and LLM_BACKEND != "fake":
+            _record_reply(agent.name, message, res.chat_history[-1]["content"])
+        return res
+
+    start = time.perf_counter()
+    try:
+        job = _llm_executor.submit(_call)
+    except BaseException:
+        _admission.release(charged)  # e.g. the pool is shut down
+        raise
+    context = copy_context()
+    loop = asyncio.get_running_loop()
+
+    def _settle():
+        # Cancelled before it ran: nothing was sent, so nothing is billed or recorded
+        if job.cancelled():
+            _admission.release(charged)
+            return
+        # Settle the bucket against what was actually billed (cache hits count
+        # zero); refund relative to the charge, which is clipped to the bucket size
+        actual = usage["billed_tokens"] if usage["requests"] else charged
+        _admission.release(charged - actual)
+        failed = job.exception() is not None
+        _record_llm_call(step, section, _agent_model(agent), usage, _image_payload_bytes(message), time.perf_counter() - start, failed)
+
+    def _settle_later(_job):
+        try:
+            loop.call_soon_threadsafe(_settle, context=context)
+        except RuntimeError:
+            pass  # event loop already closed
+
+    try:
+        res = await asyncio.wait_for(asyncio.wrap_future(job), timeout)
+    except asyncio.TimeoutError:
+        raise TimeoutError(f"{step} LLM call timed out after {timeout:.0f}s") from None
+    finally:
+        # A call abandoned mid-flight (timeout, lost hedge, client gone) keeps its
+        # admission slot until the worker thread returns; the OpenAI client
+        # timeout bounds that, and its reply still lands in autogen's cache
+        if job.done():
+            _settle()
+        else:
+            job.add_done_callback(_settle_later)
+    if not (usage["requests"] and usage["cached"] == usage["requests"]):
+        _record_latency(step, time.perf_counter() - start)
+    return res
+
+async def _hedged_attempt(agent, message: str, kwargs: dict, step: str, section, attempt: int, deadline: float):
+    remaining = deadline - time.monotonic()
+    timeout = min(remaining, LLM_REQUEST_TIMEOUT_SECONDS)
+    delay = _hedge_delay(step) if LLM_HEDGE else None
+    if delay is None or delay >= timeout:
+        return await _llm_attempt(_agent_variant(agent, attempt), message, kwargs, step, section, timeout, deadline)
+
+    primary = asyncio.ensure_future(_llm_attempt(_agent_variant(agent, attempt), message, kwargs, step, section, timeout, deadline))
+    pending = {primary}
+    try:
+        done, _ = await asyncio.wait(pending, timeout=delay)
+        if not done:
+            hedge = asyncio.ensure_future(
+                _llm_attempt(_agent_variant(agent, attempt + 1), message, kwargs, step, section, timeout - delay, deadline)
+            )
+            pending.add(hedge)
+            _metrics.inc("critique_llm_hedges_total", {"step": step, "outcome": "fired"})
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            winner = next((task for task in done if task.exception() is None), None)
+            if winner is not None:
+                if winner is not primary:
+                    _metrics.inc("critique_llm_hedges_total", {"step": step, "outcome": "won"})
+                return winner.result()
+        raise primary.exception()
+    finally:
+        for task in pending:
+            task.cancel()
+
+@_profile_phase("llm")
+async def _initiate_chat(agent, message: str, **kwargs):
+    """Run one autogen conversation on the LLM pool under the call policy and await its result."""
+    step, section = _trace_scope.get()
+    step = step or _AGENT_STEPS.get(agent.name, agent.name)
+    deadline = time.monotonic() + LLM_STEP_DEADLINES.get(step, LLM_DEADLINE_SECONDS)
+    attempt = 0
+    while True:
+        try:
+            return await _hedged_attempt(agent, message, kwargs, step, section, attempt, deadline)
+        except Exception as e:
+            delay = _retry_delay(e, attempt)
+            if delay is None or attempt >= LLM_MAX_RETRIES or time.monotonic() + delay >= deadline:
+                raise
+            _metrics.inc("critique_llm_retries_total", {"step": step, "reason": type(e).__name__})
+            logger.info("%s: %s: %s; retry %d/%d in %.1fs", step, type(e).__name__, e, attempt + 1, LLM_MAX_RETRIES, delay)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+async def _structured_reply(agent, message: str, strict: bool = False, **chat_kwargs) -> tuple:
+    """Ask ``agent`` for YAML and return ``(raw_reply, data)``.
+
+    Entries lost to malformed or truncated output are asked for once more, on
+    their own, and merged in. Raises yaml.YAMLError when nothing parses, and
+    ValueError when ``strict`` and entries are still missing after the retry.
+    Extra keyword arguments are passed on to ``_initiate_chat``.
+    """
+    res = await _initiate_chat(agent, message=message, **chat_kwargs)
+    raw = res.chat_history[-1]["content"]
+    parsed = _parse_structured(raw)
+    step = _trace_scope.get()[0] or _AGENT_STEPS.get(agent.name, agent.name)
+    if parsed.lost and isinstance(parsed.data, dict) and STRUCTURED_RETRY:
+        logger.info("%s: re-requesting %d unparsed entries", step, len(parsed.lost))
+        follow_up = await _initiate_chat(agent, message=message + _remainder_instructions(parsed), **chat_kwargs)
+        extra = _parse_structured(follow_up.chat_history[-1]["content"])
+        if isinstance(extra.data, dict):
+            _merge_structured(parsed.data, extra.data)
+        parsed.lost = [path for path in parsed.lost if not _has_path(parsed.data, path)]
+    _metrics.inc("critique_structured_output_total", {"step": step, "outcome": parsed.outcome})
+    if parsed.data is None:
+        error = yaml.YAMLError(f"No parseable YAML in reply: {raw[:200]!r}")
+        error.raw = raw
+        raise error
+    if parsed.lost:
+        if strict:
+            raise ValueError(f"Incomplete YAML in reply, missing {parsed.lost}")
+        logger.warning("%s: kept partial output, still missing %s", step, parsed.lost)
+    return raw, parsed.data
+
+@app.on_event("shutdown")
+def _shutdown_llm_executor():
+    _llm_executor.shutdown(wait=False, cancel_futures=True)
+
+# --- 섹션 단위 병렬 처리 ---
+# Max number of sections analysed at once per request (1 = sequential)
+SECTION_CONCURRENCY = max(1, int(os.getenv("SECTION_CONCURRENCY", "4")))
+
+# Set by streaming endpoints; receives an event dict per finished section
+_section_listener: ContextVar = ContextVar("section_listener", default=None)
+
+async def _notify_section(step: str, section_name, result, completed: int = 1, total: int = 1):
+    listener = _section_listener.get()
+    if listener is not None:
+        await listener({
+            "step": step,
+            "section": section_name,
+            "result": result,
+            "completed": completed,
+            "total": total,
+        })
+
+async def _fan_out_sections(items, analyze, concurrency: int = None, step: str = None) -> dict:
+    """Await ``analyze(section_name, data)`` for every section concurrently.
+
+    At most ``concurrency`` sections are in flight at once. A failing
+    section becomes ``{"error": ...}`` without affecting the others, and the
+    merged dict keeps the original section order. Each finished section is
+    also reported to the active streaming listener, if any.
+    """
+    items = list(items)
+    semaphore = asyncio.Semaphore(max(1, concurrency or SECTION_CONCURRENCY))
+    completed = 0
+
+    async def _run_one(section_name, data):
+        nonlocal completed
+        async with semaphore:
+            try:
+                result = await analyze(section_name, data)
+            except Exception as e:
+                print(f"❌ Error evaluating section '{section_name}': {type(e).__name__}: {e}")
+                result = {"error": str(e)}
+        completed += 1
+        await _notify_section(step, section_name, result, completed, len(items))
+        return result
+
+    results = await asyncio.gather(*(_run_one(name, data) for name, data in items))
+    return {name: result for (name, _), result in zip(items, results)}
+
+# --- 단계 결과 메모이제이션 ---
+# Bump PROMPT_VERSION whenever a step prompt changes so stale results are not reused.
+PROMPT_VERSION = "2025-02"
+STEP_CACHE_ENABLED = os.getenv("STEP_CACHE_ENABLED", "1") != "0"
+STEP_CACHE_PATH = os.getenv("STEP_CACHE_PATH", os.path.join(os.getcwd(), ".cache", "critique_cache.sqlite"))
+STEP_CACHE_MAX_ENTRIES = int(os.getenv("STEP_CACHE_MAX_ENTRIES", "5000"))
+
+_step_cache = _SqliteCache(STEP_CACHE_PATH, "step_results", STEP_CACHE_MAX_ENTRIES) if STEP_CACHE_ENABLED else None
+
+def _step_cache_key(step: str, image_digest: str, task: str, inputs) -> str:
+    material = json.dumps(
+        {"v": PROMPT_VERSION, "step": step, "image": image_digest, "image_variant": _IMAGE_VARIANT, "task": task, "inputs": inputs},
+        sort_keys=True, ensure_ascii=False, default=str,
+    )
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+async def _traced(step: str, inputs, compute):
+    """Await ``compute()`` with its LLM calls attributed to this step and section."""
+    section = inputs.get("section") if isinstance(inputs, dict) else None
+    token = _trace_scope.set((step, section))
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            last_err = None
-            for url in candidate_urls:
+        return await compute()
+    finally:
+        _trace_scope.reset(token)
+
+def _finish_detached(coro):
+    """Await ``coro``, but let it run to completion if the caller is cancelled.
+
+    A client disconnect cancels the endpoint; a section whose LLM call is
+    already under way still finishes and lands in the step cache instead of
+    being paid for and thrown away.
+    """
+    task = asyncio.ensure_future(coro)
+    # Retrieve the outcome so an orphaned failure is not logged as unhandled
+    task.add_done_callback(lambda t: t.cancelled() or t.exception())
+    return asyncio.shield(task)
+
+async def _memoized_call(step: str, image_digest: str, task: str, inputs, compute):
+    """Return the cached result for these inputs, or await ``compute()`` and store it.
+
+    Results carrying a top-level ``error`` key are never cached.
+    """
+    if _step_cache is None:
+        return await _traced(step, inputs, compute)
+    key = _step_cache_key(step, image_digest, task, inputs)
+    # SQLite (5 s busy timeout, commit per call) stays off the event loop
+    cached = await asyncio.to_thread(_step_cache.get, key)
+    _record_step_cache(step, cached is not None)
+    if cached is not None:
+        logger.debug("%s cache hit", step)
+        return cached
+
+    async def _compute_and_store():
+        result = await _traced(step, inputs, compute)
+        if not (isinstance(result, dict) and "error" in result):
+            await asyncio.to_thread(_step_cache.set, key, result)
+        return result
+
+    return await _finish_detached(_compute_and_store())
+
+def _memoize_sections(step: str, image_digest: str, task: str, analyze, context=None, app_ui=None):
+    """Wrap a per-section ``analyze`` coroutine with the persistent step cache.
+
+    ``app_ui`` adds the section's crop box to the key when the prompt attaches a crop.
+    """
+    async def _cached(section_name, data):
+        inputs = {"section": section_name, "data": data, "context": context}
+        bbox = _section_bbox(app_ui, section_name)
+        if bbox is not None:
+            inputs["bbox"] = bbox
+        return await _memoized_call(step, image_digest, task, inputs, lambda: analyze(section_name, data))
+    return _cached
+
+# --- 섹션 일괄 처리 (single-context / K-section batches) ---
+# Steps listed in SINGLE_CONTEXT_STEPS (e.g. "step3,step4,step6") pack several
+# sections into one request: the system prompt and the full image are sent
+# once per batch instead of once per section. Batches are filled in section
+# order up to SECTION_BATCH_TOKENS of estimated input and SECTION_BATCH_MAX
+# sections, so small screens go out as a single request and large ones are
+# split. The combined YAML is split back per section; only the sections
+# missing from a reply (or every section of a batch that raised) are retried
+# one by one.
+SINGLE_CONTEXT_STEPS = {s.strip() for s in os.getenv("SINGLE_CONTEXT_STEPS", "").split(",") if s.strip()}
+SECTION_BATCH_TOKENS = int(os.getenv("SECTION_BATCH_TOKENS", "6000"))
+SECTION_BATCH_MAX = int(os.getenv("SECTION_BATCH_MAX", "8"))  # 0 = no limit
+_BATCH_SECTIONS_PREFIX = "Cover every one of these sections: "
+
+def _batch_output_instructions(section_names: list) -> str:
+    names = json.dumps(section_names, ensure_ascii=False)
+    return (
+        f"{_BATCH_SECTIONS_PREFIX}{names}.\n"
+        "Return ONE YAML mapping whose top-level keys are exactly those section names, "
+        "and under each key give that section's result in the structure from your instructions."
+    )
+
+def _split_section_results(reply: str, section_names: list) -> dict:
+    """Per-section results of a combined reply; tolerates case/spacing drift in the keys.
+
+    Sections with entries lost to malformed or truncated YAML are left out, so
+    the per-section fallback redoes only those.
+    """
+    structured = _parse_structured(reply)
+    parsed = structured.data
+    if not isinstance(parsed, dict):
+        return {}
+    incomplete = {_normalize_text(str(path[0])) for path in structured.lost if path}
+    parsed = {key: value for key, value in parsed.items() if _normalize_text(str(key)) not in incomplete}
+    by_normalized = {_normalize_text(str(key)): value for key, value in parsed.items()}
+    found = {}
+    for name in section_names:
+        value = parsed.get(name, by_normalized.get(_normalize_text(name)))
+        if isinstance(value, dict) and value:
+            found[name] = value
+    return found
+
+def _estimate_tokens(data) -> int:
+    # Rough: ~3 characters per token for mixed Korean/English YAML
+    return len(json.dumps(data, ensure_ascii=False, default=str)) // 3 + 1
+
+def _plan_batches(items: list) -> list:
+    """Pack ``(section_name, data)`` items, in order, into batches within the batch limits."""
+    batches, current, current_tokens = [], [], 0
+    for item in items:
+        tokens = _estimate_tokens(item[1])
+        full = SECTION_BATCH_MAX > 0 and len(current) >= SECTION_BATCH_MAX
+        if current and (full or current_tokens + tokens > SECTION_BATCH_TOKENS):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(item)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+async def _fan_out_batched(step: str, items, analyze_batch, analyze_one, image_digest: str, task: str, context=None) -> dict:
+    """Run ``analyze_batch([(section_name, data), ...])`` over batches of the uncached sections.
+
+    ``analyze_batch`` returns ``{section_name: result}``; sections it leaves out
+    (or its whole batch, if it raises) go through ``analyze_one`` individually,
+    as do batches of a single section. At most SECTION_CONCURRENCY requests are
+    in flight. Batched results are cached per section, separately from
+    per-section calls.
+    """
+    items = list(items)
+    total = len(items)
+    results: dict = {}
+    semaphore = asyncio.Semaphore(max(1, SECTION_CONCURRENCY))
+
+    def _key(section_name, data):
+        return _step_cache_key(step, image_digest, task, {"section": section_name, "data": data, "context": context, "batched": True})
+
+    async def _done(section_name, result):
+        results[section_name] = result
+        await _notify_section(step, section_name, result, len(results), total)
+
+    async def _analyze_individually(section_name, data):
+        async with semaphore:
+            try:
+                result = await analyze_one(section_name, data)
+            except Exception as e:
+                print(f"❌ Error evaluating section '{section_name}': {type(e).__name__}: {e}")
+                result = {"error": str(e)}
+        await _done(section_name, result)
+
+    async def _analyze_batch_and_store(batch, names):
+        found = await _traced(step, {"sections": names}, lambda: analyze_batch(batch))
+        if _step_cache is not None:
+            for section_name, data in batch:
+                result = found.get(section_name)
+                if result is not None and not _is_error(result):
+                    await asyncio.to_thread(_step_cache.set, _key(section_name, data), result)
+        return found
+
+    async def _run_batch(batch):
+        if len(batch) > 1:
+            names = [section_name for section_name, _ in batch]
+            logger.debug("%s: %d sections in one request", step, len(batch))
+            async with semaphore:
                 try:
-                    resp = await client.get(url)
-                    resp.raise_for_status()
-                    return base64.b64encode(resp.content).decode("utf-8")
+                    found = await _finish_detached(_analyze_batch_and_store(batch, names))
                 except Exception as e:
-                    last_err = e
+                    logger.warning("%s batch failed, falling back to per-section calls: %s: %s", step, type(e).__name__, e)
+                    found = {}
+            for section_name, data in batch:
+                result = found.get(section_name)
+                if result is None or _is_error(result):
                     continue
-            raise last_err or RuntimeError("Image fetch failed")
-    except Exception as e:
-        raise HTTPException(status_code=404, detail=f"Failed to fetch image from candidates: {candidate_urls}. Error: {e}")
+                await _done(section_name, result)
+            batch = [(section_name, data) for section_name, data in batch if section_name not in results]
+            if batch:
+                logger.info("%s: retrying %d section(s) individually", step, len(batch))
+        await asyncio.gather(*(_analyze_individually(section_name, data) for section_name, data in batch))
+
+    pending = []
+    for section_name, data in items:
+        cached = None
+        if _step_cache is not None:
+            cached = await asyncio.to_thread(_step_cache.get, _key(section_name, data))
+            _record_step_cache(step, cached is not None)
+        if cached is not None:
+            await _done(section_name, cached)
+        else:
+            pending.append((section_name, data))
+
+    await asyncio.gather(*(_run_batch(batch) for batch in _plan_batches(pending)))
+    return {section_name: results[section_name] for section_name, _ in items}
+
+async def _fan_out_step(step: str, items, analyze_one, analyze_batch, image_digest: str, task: str, context=None) -> dict:
+    """Per-section fan-out, or batched requests when ``step`` is in SINGLE_CONTEXT_STEPS."""
+    if step in SINGLE_CONTEXT_STEPS:
+        return await _fan_out_batched(step, items, analyze_batch, analyze_one, image_digest, task, context)
+    return await _fan_out_sections(items, analyze_one, step=step)
+
+# --- 가이드라인 수정 캐시 ---
+# Two tiers: a per-process LRU in front of an optional SQLite table shared by
+# all workers. Keys are hashed from whitespace/case-normalized inputs.
+GUIDELINE_CACHE_SIZE = int(os.getenv("GUIDELINE_CACHE_SIZE", "256"))
+GUIDELINE_CACHE_TTL_SECONDS = float(os.getenv("GUIDELINE_CACHE_TTL_SECONDS", "86400"))
+GUIDELINE_CACHE_SHARED = os.getenv("GUIDELINE_CACHE_SHARED", "1") != "0"
+
+guideline_update_cache = _LRUCache(GUIDELINE_CACHE_SIZE, GUIDELINE_CACHE_TTL_SECONDS)
+_shared_guideline_cache = (
+    _SqliteCache(STEP_CACHE_PATH, "guideline_updates", GUIDELINE_CACHE_SIZE * 8, GUIDELINE_CACHE_TTL_SECONDS)
+    if GUIDELINE_CACHE_SHARED else None
+)
 
-# Add '/api/' prefix variants for all step endpoints to match frontend fetch paths and Vercel routing
-@api.post("/step1")
-async def step1(request: Request, task: str = Form(...), image_filename: str = Form("") ):
-    # Guard for missing LLM config
-    if user_proxy is None or not llm_config:
-        return JSONResponse(status_code=503, content={"error": "LLM config missing on server. Please configure OAI_CONFIG_LIST_JSON or environment for server deployment."})
+def _normalize_text(text: str) -> str:
+    return " ".join((text or "").split()).casefold()
 
-    effective_filename = image_filename or IMAGE_FILENAME
-    print(f"=== Using Image: /stores/{effective_filename}")
-    print(f"=== Task: {task}")
+def _guideline_cache_key(user_update: str, default_guidelines: str) -> str:
+    material = json.dumps([_normalize_text(user_update), _normalize_text(default_guidelines)], ensure_ascii=False)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
 
-    # 이미지 파일을 base64로 인코딩 (via HTTP from Next public)
+def _guideline_cache_get(key: str) -> Optional[dict]:
+    cached = guideline_update_cache.get(key)
+    if cached is None and _shared_guideline_cache is not None:
+        cached = _shared_guideline_cache.get(key)
+        if cached is not None:
+            guideline_update_cache.set(key, cached)
+    return cached
+
+def _guideline_cache_set(key: str, value: dict):
+    guideline_update_cache.set(key, value)
+    if _shared_guideline_cache is not None:
+        _shared_guideline_cache.set(key, value)
+
+# === 단계별 코어 로직 ===
+# Endpoints, SSE streams and the section pipeline all call these. An "image" is
+# the dict built by _image_ref (base64, filename, content digest).
+
+def _image_ref(image_base64: str, image_filename: str = None, image_digest: str = None) -> dict:
+    return {
+        "base64": image_base64,
+        "filename": image_filename or IMAGE_FILENAME,
+        "digest": image_digest or _image_digest(image_base64),
+    }
+
+@_profile_phase("build_prompt")
+def _image_data_url(image: dict) -> str:
+    mime, encoded = _processed_image(image)
+    return f"data:{mime};base64,{encoded}"
+
+def _run_image(run: dict) -> dict:
+    return _image_ref(run["image_base64"], run.get("image_filename"), run.get("image_digest"))
+
+async def _request_image(request: Request, run: Optional[dict]) -> dict:
+    """Image for a step request: the run's copy, else the default screen."""
+    if run:
+        return _run_image(run)
+    return _image_ref(await _get_public_image_base64(request, IMAGE_FILENAME))
+
+# --- 섹션별 이미지 크롭 ---
+# step1 returns an approximate bbox per app_ui section; section-scoped prompts
+# (step2/3/4/6) attach a crop of just that region instead of the whole screen.
+# Missing, malformed or near-full-screen boxes fall back to the full image.
+SECTION_CROPS = os.getenv("SECTION_CROPS", "1") != "0"
+SECTION_CROP_MARGIN = float(os.getenv("SECTION_CROP_MARGIN", "0.03"))      # fraction of width/height added per side
+SECTION_CROP_MAX_AREA = float(os.getenv("SECTION_CROP_MAX_AREA", "0.8"))   # larger crops send the full image
+SECTION_CROP_MIN_AREA = float(os.getenv("SECTION_CROP_MIN_AREA", "0.005")) # smaller boxes are assumed wrong
+_section_crops = _LRUCache(IMAGE_CACHE_SIZE * 8)  # "digest:bbox" -> cropped image ref
+
+def _section_bbox(app_ui: Optional[dict], section_name: str) -> Optional[tuple]:
+    """Normalized ``(x0, y0, x1, y1)`` of a section from step1's ``bbox``, or None."""
+    if not SECTION_CROPS or not isinstance(app_ui, dict):
+        return None
+    info = app_ui.get(section_name)
+    bbox = info.get("bbox") if isinstance(info, dict) else None
+    if not isinstance(bbox, (list, tuple)) or len(bbox) != 4:
+        return None
     try:
-        image_base64 = await _get_public_image_base64(request, effective_filename)
-    except HTTPException as e:
-        return JSONResponse(status_code=e.status_code, content={"error": str(e.detail)})
+        box = [float(v) for v in bbox]
+    except (TypeError, ValueError):
+        return None
+    if max(box) > 1:
+        # Percentages instead of fractions
+        box = [v / 100 for v in box]
+    x0, y0, x1, y1 = (min(1.0, max(0.0, v)) for v in box)
+    if x1 <= x0 or y1 <= y0:
+        return None
+    return round(x0, 4), round(y0, 4), round(x1, 4), round(y1, 4)
 
-    mime = "image/jpeg" if str(effective_filename).lower().endswith((".jpg", ".jpeg")) else "image/png"
-    image_data_url = f"data:{mime};base64,{image_base64}"
+def _with_run_bboxes(app_ui: Optional[dict], run: Optional[dict]) -> Optional[dict]:
+    """Posted ``app_ui`` with step1's ``bbox`` filled back in from the run.
 
+    The perception table on the frontend only round-trips position/size_shape,
+    so an edited app_ui would otherwise drop every crop box.
+    """
+    stored = (run or {}).get("app_ui")
+    if not isinstance(app_ui, dict) or not isinstance(stored, dict):
+        return app_ui
+    merged = {}
+    for name, info in app_ui.items():
+        box = stored.get(name)
+        box = box.get("bbox") if isinstance(box, dict) else None
+        if isinstance(info, dict) and "bbox" not in info and box is not None:
+            info = {**info, "bbox": box}
+        merged[name] = info
+    return merged
+
+_CROP_EXTENSIONS = {"JPEG": "jpg", "WEBP": "webp", "PNG": "png"}
+
+def _crop_image(image: dict, bbox: tuple) -> Optional[dict]:
+    if Image is None:
+        return None
+    x0, y0, x1, y1 = bbox
+    x0, y0 = max(0.0, x0 - SECTION_CROP_MARGIN), max(0.0, y0 - SECTION_CROP_MARGIN)
+    x1, y1 = min(1.0, x1 + SECTION_CROP_MARGIN), min(1.0, y1 + SECTION_CROP_MARGIN)
+    area = (x1 - x0) * (y1 - y0)
+    if area > SECTION_CROP_MAX_AREA or area < SECTION_CROP_MIN_AREA:
+        return None
+    with Image.open(io.BytesIO(base64.b64decode(image["base64"]))) as img:
+        width, height = img.size
+        # Same format/quality the preprocessing would pick, so cached crops stay
+        # about as small as the image actually sent (a lossless PNG of a
+        # full-resolution region is several times larger)
+        fmt = IMAGE_FORMAT.upper() if IMAGE_PREPROCESS and IMAGE_FORMAT != "original" else img.format
+        if fmt not in _CROP_EXTENSIONS:
+            fmt = "PNG"
+        region = img.crop((round(x0 * width), round(y0 * height), round(x1 * width), round(y1 * height)))
+        if fmt == "JPEG" and region.mode not in ("RGB", "L"):
+            region = region.convert("RGB")
+        out = io.BytesIO()
+        if fmt == "PNG":
+            region.save(out, "PNG", optimize=True)
+        else:
+            region.save(out, fmt, quality=IMAGE_QUALITY)
+    data = out.getvalue()
+    name = os.path.splitext(os.path.basename(image["filename"]))[0]
+    filename = f"{name}-section.{_CROP_EXTENSIONS[fmt]}"
+    return _image_ref(base64.b64encode(data).decode("utf-8"), filename, hashlib.sha256(data).hexdigest())
+
+def _section_image(image: dict, app_ui: Optional[dict], section_name: str) -> tuple:
+    """``(image, cropped)``: the crop of ``section_name`` when step1 boxed it, else the full image."""
+    bbox = _section_bbox(app_ui, section_name)
+    if bbox is None:
+        return image, False
+    key = f"{image['digest']}:{bbox}"
+    crop = _section_crops.get(key)
+    if crop is None:
+        try:
+            crop = _crop_image(image, bbox) or image
+        except Exception as e:
+            logger.warning("Section crop failed for %r, sending full image: %s", section_name, e)
+            crop = image
+        _section_crops.set(key, crop)
+    return crop, crop is not image
+
+async def _section_image_prompt(image: dict, app_ui: Optional[dict], section_name: str) -> str:
+    """The ``- Image: <img ...>`` prompt line for a section-scoped call."""
+    section_image, cropped = await asyncio.to_thread(_section_image, image, app_ui, section_name)
+    image_data_url = await asyncio.to_thread(_image_data_url, section_image)
+    if cropped:
+        return f"- Image (cropped to the '{section_name}' section): <img {image_data_url}>"
+    return f"- Image: <img {image_data_url}>"
+
+
+@_profile_phase("build_prompt")
+def _step1_agent():
     # Autogen Agent 정의
-    step1_agent = MultimodalConversableAgent(
+    return _VisionAgent(
     name="UILayoutIdentifier",
     system_message=f'''
         Based on the provided UI image, identify all high-level structural sections of the UI rather than focusing on fine-grained elements.
@@ -281,6 +2484,7 @@ async def step1(request: Request, task: str = Form(...), image_filename: str = F
             - **Section Type**: Classify the section based on its primary functional role. If the section serves multiple roles, identify its dominant function.
             - **Position**: Describe the section's relative spatial location within the UI.
             - **Size & Shape**: Specify the **section's dimensions and shape** in relation to the UI layout, **using quantifiable or relative terms** such as percentage-based dimensions or dominant proportions.
+            - **Bounding Box**: Give the section's approximate bounding box as [x_min, y_min, x_max, y_max], each a fraction (0-1) of the image width or height, measured from the top-left corner.
         </instructions>
 
         Output Requirements:
@@ -299,64 +2503,39 @@ async def step1(request: Request, task: str = Form(...), image_filename: str = F
             "<section_name>":
                 position: "<Korean description with English technical terms kept as-is. Spatial relationship relative to others>"
                 size_shape: "<Korean description with English technical terms kept as-is. Overall size and shape description>"
+                bbox: [<x_min>, <y_min>, <x_max>, <y_max>]
         </formatting_example>
         ''',
         llm_config=llm_config,
     )
 
-    # Autogen 호출
-    step1_res = user_proxy.initiate_chat(
-        step1_agent,
-        message=f"""
+async def _run_step1(task: str, image: dict) -> dict:
+    """Segment the screen. Returns ``{"raw", "parsed"}`` or ``{"error", "raw_output"}``."""
+    image_data_url = await asyncio.to_thread(_image_data_url, image)
+    step1_agent = _step1_agent()
+
+    async def _identify_sections():
+        # Autogen 호출 + 결과 파싱
+        message = f"""
         Identify and delineate the major UI sections in the given UI, **ensuring clear segmentation that aligns with the task's objectives**.
         - Task: {task}
         - Image: <img {image_data_url}>
         """
-    )
-
-    # 결과 파싱
-    raw_content = step1_res.chat_history[1]['content']
-    content_stripped = raw_content.strip("```yaml").strip("```").strip()
-    print("===== RAW YAML =====")
-    print(repr(content_stripped))
-    try:
-        parsed_yaml = yaml.safe_load(content_stripped)
-    except yaml.YAMLError:
-        return JSONResponse(status_code=500, content={"error": "YAML parsing failed", "raw_output": raw_content})
-
-    return {
-        "non_app_ui": parsed_yaml.get("non_app_ui", []),
-        "app_ui": parsed_yaml.get("app_ui", {}),
-        "raw": raw_content,
-        "task": task,
-        "image_path": f"/stores/{effective_filename}",
-        "image_url": f"/stores/{effective_filename}",
-        "image_base64": image_base64,
-        # 로그 기록
-        "_log": log_step_result(
-            # user_id removed
-            step="step1",
-            task=task,
-            image_path=f"/stores/{effective_filename}",
-            result=parsed_yaml,
-        )
-    }
+        try:
+            raw_content, parsed_yaml = await _structured_reply(step1_agent, message)
+        except yaml.YAMLError as e:
+            return {"error": "YAML parsing failed", "raw_output": getattr(e, "raw", str(e))}
+        print("===== RAW YAML =====")
+        print(repr(raw_content))
+        return {"raw": raw_content, "parsed": parsed_yaml}
 
+    return await _memoized_call("step1", image["digest"], task, {}, _identify_sections)
 
-@api.post("/step2")
-async def step2(request: Request, request_body: Step2Request):
-    if user_proxy is None or not llm_config:
-        return JSONResponse(status_code=503, content={"error": "LLM config missing on server."})
-    task = request_body.task
-    app_ui = request_body.app_ui
-    try:
-        image_base64 = await _get_public_image_base64(request, IMAGE_FILENAME)
-    except HTTPException as e:
-        return JSONResponse(status_code=e.status_code, content={"error": str(e.detail)})
-    image_data_url = f"data:image/jpeg;base64,{image_base64}"
 
+@_profile_phase("build_prompt")
+def _step2_agent():
     # step2 에이전트 정의
-    step2_agent = MultimodalConversableAgent(
+    return _VisionAgent(
         name="UIComponentIdentifier",
         system_message=f''' 
         Based on the provided UI image and overall structure, identify **ALL UI components within the target section**, ensuring **exhaustive detection without omission, or duplication**.
@@ -401,56 +2580,29 @@ async def step2(request: Request, request_body: Step2Request):
         llm_config=llm_config,
     )
 
-    # step2 실행 (섹션별 반복)
-    sections = list(app_ui.keys())
-    step2_results = {}
+def _step2_analyzer(task: str, app_ui: dict, image: dict):
+    """Per-section component identification (memoized)."""
+    step2_agent = _step2_agent()
 
-    for section_name in sections:
-        try:
-            print(f"▶ Analyzing section: {section_name}")
-            res = user_proxy.initiate_chat(
-                step2_agent,
-                message=f"""
+    async def _analyze_section(section_name, _section_info):
+        print(f"▶ Analyzing section: {section_name}")
+        image_line = await _section_image_prompt(image, app_ui, section_name)
+        _, parsed = await _structured_reply(
+            step2_agent,
+            f"""
 Identify all UI components within the '{section_name}' section from the given UI, ensuring completeness without omissions.
 - Overall Structure: {app_ui}
-- Image: <img {image_data_url}>
+{image_line}
 """
-            )
+        )
+        return parsed.get(section_name, parsed)
 
-            raw = res.chat_history[1]['content']
-            cleaned = raw.strip("```yaml").strip("```").strip()
-            parsed = yaml.safe_load(cleaned)
-            step2_results[section_name] = parsed.get(section_name, parsed)
+    return _memoize_sections("step2", image["digest"], task, _analyze_section, context=app_ui, app_ui=app_ui)
 
-        except Exception as e:
-            step2_results[section_name] = {"error": str(e)}
 
-    # 로그 기록
-    log_step_result(
-        # user_id removed
-        step="step2",
-        task=task,
-        image_path=None,
-        result=step2_results,
-    )
-    return {"result": step2_results}
-
-
-
-@api.post("/step3")
-async def step3(request: Request, request_body: Step3Request):
-    if user_proxy is None or not llm_config:
-        return JSONResponse(status_code=503, content={"error": "LLM config missing on server."})
-    task = request_body.task
-    app_ui = request_body.app_ui
-    app_ui_components = request_body.app_ui_components
-    try:
-        image_base64 = await _get_public_image_base64(request, IMAGE_FILENAME)
-    except HTTPException as e:
-        return JSONResponse(status_code=e.status_code, content={"error": str(e.detail)})
-    image_data_url = f"data:image/png;base64,{image_base64}"
-
-    step3_agent = MultimodalConversableAgent(
+@_profile_phase("build_prompt")
+def _step3_agent():
+    return _VisionAgent(
         name="UIComponentAnalyzer",
         system_message=f'''
         Analyze **each UI component**, extracting both its **visual characteristics** and **functional characteristics**.
@@ -491,80 +2643,58 @@ async def step3(request: Request, request_body: Step3Request):
         llm_config=llm_config,
     )
 
+def _step3_analyzer(task: str, image: dict, app_ui: Optional[dict] = None):
+    """Per-section component analysis (memoized); ``app_ui`` enables section crops."""
+    step3_agent = _step3_agent()
 
-    step3_results = {}
-
-    if not app_ui_components or len(app_ui_components) == 0:
-        print("❌ app_ui_components가 비어있거나 None입니다!")
-        return {"result": {"error": "No UI components provided"}}
-
-    print(f"🔄 {len(app_ui_components)}개 섹션 처리 시작...")
-
-    for section_name, component_data in app_ui_components.items():
-        try:
-            print(f"▶ Evaluating detailed components in section: {section_name}...")
-            print(f"   Component data: {component_data}")
+    async def _analyze_section(section_name, component_data):
+        print(f"▶ Evaluating detailed components in section: {section_name}...")
+        print(f"   Component data: {component_data}")
 
-            message = f"""
+        image_line = await _section_image_prompt(image, app_ui, section_name)
+        message = f"""
             Provide a detailed analysis of the **visual characteristics** and **visible functional roles** of each UI component within the '{section_name}' section.
             - Task: {task}
-            - Image: <img {image_data_url}>
+            {image_line}
             - Component List from '{section_name}' section: {component_data}
             """
 
-            component_evaluation_res = user_proxy.initiate_chat(
-                step3_agent, 
-                message=message
-            )
-
-            step3_results.setdefault(section_name, {})
-
-            raw_response = component_evaluation_res.chat_history[1].get("content", "").strip()
-
-            if raw_response.startswith("```yaml"):
-                raw_response = raw_response.removeprefix("```yaml").removesuffix("```").strip()
-
-            try:
-                parsed_yaml = yaml.safe_load(raw_response)
-                step3_results[section_name] = parsed_yaml
-                print(f"✅ {section_name} 섹션 YAML 파싱 성공")
-            except yaml.YAMLError as e:
-                print(f"⚠️ YAML parsing error for {section_name}: {e}")
-                step3_results[section_name] = {"error": f"YAML parsing error: {e}"}
-                continue
-
-            print(f"✅ Detailed evaluation for {section_name} completed.")
+        try:
+            _, parsed_yaml = await _structured_reply(step3_agent, message)
+            print(f"✅ {section_name} 섹션 YAML 파싱 성공")
+        except yaml.YAMLError as e:
+            print(f"⚠️ YAML parsing error for {section_name}: {e}")
+            return {"error": f"YAML parsing error: {e}"}
+
+        print(f"✅ Detailed evaluation for {section_name} completed.")
+        return parsed_yaml
+
+    return _memoize_sections("step3", image["digest"], task, _analyze_section, app_ui=app_ui)
+
+def _step3_batch_analyzer(task: str, image: dict):
+    """All sections' component analysis in one request (single-context mode)."""
+    step3_agent = _step3_agent()
+
+    async def _analyze_sections(sections):
+        names = [section_name for section_name, _ in sections]
+        image_data_url = await asyncio.to_thread(_image_data_url, image)
+        message = f"""
+            Provide a detailed analysis of the **visual characteristics** and **visible functional roles** of each UI component within each of the sections below.
+            - Task: {task}
+            - Image: <img {image_data_url}>
+            - Component List per section:\n{_dump_yaml(dict(sections))}
+            {_batch_output_instructions(names)}
+            """
 
-        except Exception as e:
-            print(f"❌ Error evaluating section '{section_name}': {type(e).__name__}: {e}")
-            step3_results[section_name] = {"error": str(e)}
-                
-    # 로그 기록
-    log_step_result(
-        # user_id removed
-        step="step3",
-        task=task,
-        image_path=None,
-        result=step3_results,
-    )
-    return {"result": step3_results}
+        res = await _initiate_chat(step3_agent, message=message)
+        return _split_section_results(res.chat_history[-1]["content"], names)
 
-# --- Step 4 엔드포인트 수정 ---
+    return _analyze_sections
 
-@api.post("/step4")
-async def step4_endpoint(request: Request, request_body: Step4Request):
-    if user_proxy is None or not llm_config:
-        return JSONResponse(status_code=503, content={"error": "LLM config missing on server."})
-    task = request_body.task
-    app_ui = request_body.app_ui
-    step3_results = request_body.step3_results
-    try:
-        image_base64 = await _get_public_image_base64(request, IMAGE_FILENAME)
-    except HTTPException as e:
-        return JSONResponse(status_code=e.status_code, content={"error": str(e.detail)})
-    image_data_url = f"data:image/png;base64,{image_base64}"
 
-    step4_agent = MultimodalConversableAgent(
+@_profile_phase("build_prompt")
+def _step4_agent():
+    return _VisionAgent(
         name="UILayoutAnalyzer",
         system_message=f'''
         Analyze **each UI section**, focusing on its **overall visual structure** and **functional role** in the user interface.
@@ -606,74 +2736,61 @@ async def step4_endpoint(request: Request, request_body: Step4Request):
         llm_config=llm_config,
     )
 
-    step4_results = {}
+def _step4_analyzer(task: str, app_ui: dict, image: dict):
+    """Per-section layout analysis from that section's step3 output (memoized)."""
+    step4_agent = _step4_agent()
 
-    for section_name, component_analysis in step3_results.items():
-        try:
-            print(f"▶ Analyzing section level: {section_name}")
+    async def _analyze_section(section_name, component_analysis):
+        print(f"▶ Analyzing section level: {section_name}")
 
-            if section_name not in app_ui:
-                step4_results[section_name] = {"error": f"Section '{section_name}' not found in app_ui."}
-                continue
+        if section_name not in app_ui:
+            return {"error": f"Section '{section_name}' not found in app_ui."}
 
-            message = f"""
+        image_line = await _section_image_prompt(image, app_ui, section_name)
+        message = f"""
             Provide a detailed analysis of the **visual characteristics** and **visible functional roles** of the '{section_name}' section.
             - Task: {task}
-            - Image: <img {image_data_url}>
+            {image_line}
             - Section Structure: {app_ui.get(section_name, {})}
             - Visual and functional characteristics of each components within the '{section_name}' section: {component_analysis}
             """
 
-            section_analysis_res = user_proxy.initiate_chat(
-                step4_agent,
-                message=message,
-            )
+        _, parsed_yaml = await _structured_reply(step4_agent, message)
+        return parsed_yaml.get(section_name, parsed_yaml)
 
-            raw_response = section_analysis_res.chat_history[1].get("content", "").strip()
-            if raw_response.startswith("```yaml"):
-                raw_response = raw_response.removeprefix("```yaml").removesuffix("```").strip()
-            
-            parsed_yaml = yaml.safe_load(raw_response)
-            step4_results[section_name] = parsed_yaml.get(section_name, parsed_yaml)
+    return _memoize_sections("step4", image["digest"], task, _analyze_section, context=app_ui, app_ui=app_ui)
 
-        except Exception as e:
-            print(f"❌ Error evaluating section '{section_name}': {type(e).__name__}: {e}")
-            step4_results[section_name] = {"error": str(e)}
+def _step4_batch_analyzer(task: str, app_ui: dict, image: dict):
+    """Layout analysis of several sections in one request (batched mode)."""
+    step4_agent = _step4_agent()
 
-    # 로그 기록
-    log_step_result(
-        # user_id removed
-        step="step4",
-        task=task,
-        image_path=None,
-        result=step4_results,
-    )
-    return {"result": step4_results}
+    async def _analyze_sections(sections):
+        # Unknown sections are left out; the per-section fallback reports them
+        sections = [(section_name, data) for section_name, data in sections if section_name in app_ui]
+        names = [section_name for section_name, _ in sections]
+        if not names:
+            return {}
+        image_data_url = await asyncio.to_thread(_image_data_url, image)
+        message = f"""
+            Provide a detailed analysis of the **visual characteristics** and **visible functional roles** of each of the sections below.
+            - Task: {task}
+            - Image: <img {image_data_url}>
+            - Section Structure per section:\n{_dump_yaml({name: app_ui[name] for name in names})}
+            - Visual and functional characteristics of each components, per section:\n{_dump_yaml(dict(sections))}
+            {_batch_output_instructions(names)}
+            """
 
+        res = await _initiate_chat(step4_agent, message=message)
+        return _split_section_results(res.chat_history[-1]["content"], names)
 
-@api.post("/step5_6")
-async def step5_6_endpoint(
-    task: str = Form(...),
-    image_base64: str = Form(...),
-    step3_results_str: str = Form(...),
-    step4_results_str: str = Form(...),
-    guidelines_str: str = Form(...),
-):
-    """
-    Combined endpoint for Step 5 (Layout Evaluation) and Step 6 (Component Evaluation).
-    """
-    image_data_url = f"data:image/png;base64,{image_base64}"
-    step5_result = {}
-    step6_results = {}
+    return _analyze_sections
 
-    # --- Part 1: Step 5 Logic (Layout Evaluation) ---
-    try:
-        print("▶️ Starting Step 5: Layout Evaluation...")
-        step4_results = yaml.safe_load(step4_results_str)
-        
-        step5_agent = MultimodalConversableAgent(
-            name="UILayoutEvaluator",
-            system_message=f'''
+
+@_profile_phase("build_prompt")
+def _step5_agent(guidelines_str: str):
+    return _VisionAgent(
+        name="UILayoutEvaluator",
+        system_message=f'''
             Evaluate the **macro-level layout, spatial structure, and visual hierarchy** of the UI — without analyzing function, behavior, or meaning of components.  
             Apply the following evaluation guidelines, but apply them only in a **layout-centric** context: {guidelines_str}
             
@@ -723,39 +2840,35 @@ async def step5_6_endpoint(
                     identified_gap: "<Korean description with English technical terms kept as-is. Detailed explanation of the gap>"
             </formatting_example>
             ''',
-            llm_config=llm_config,
-        )
+        llm_config=llm_config,
+    )
 
+async def _run_step5(task: str, step4_results: dict, guidelines_str: str, image: dict):
+    """Screen-level layout evaluation over all step4 sections (memoized)."""
+    image_data_url = await asyncio.to_thread(_image_data_url, image)
+    step5_agent = _step5_agent(guidelines_str)
 
-        step5_res = user_proxy.initiate_chat(
+    async def _evaluate_layout():
+        _, parsed_5 = await _structured_reply(
             step5_agent,
-            message=f"""Evaluate the **macro-level layout, spatial structure, and visual hierarchy** of the UI.
+            f"""Evaluate the **macro-level layout, spatial structure, and visual hierarchy** of the UI.
             - Task: {task}.
             - Visual and functional characteristics of each sections: {step4_results}
             - Image: <img {image_data_url}>
             """,
         )
+        return parsed_5
 
-        raw_response_5 = step5_res.chat_history[1]['content'].strip()
-        if raw_response_5.startswith("```yaml"):
-            raw_response_5 = raw_response_5.removeprefix("```yaml").removesuffix("```").strip()
-        
-        step5_result = yaml.safe_load(raw_response_5)
-        print("✅ Step 5 completed.")
-
-    except Exception as e:
-        print(f"❌ Error in Step 5 part: {type(e).__name__}: {e}")
-        step5_result = {"error": f"Error in Step 5: {str(e)}"}
-
+    return await _memoized_call(
+        "step5", image["digest"], task, {"step4": step4_results, "guidelines": guidelines_str}, _evaluate_layout
+    )
 
-    # --- Part 2: Step 6 Logic (Component Evaluation) ---
-    try:
-        print("▶️ Starting Step 6: Detailed Component Evaluation...")
-        step3_results = yaml.safe_load(step3_results_str)
 
-        step6_agent = MultimodalConversableAgent(
-            name="UIComponentEvaluator",
-            system_message=f'''
+@_profile_phase("build_prompt")
+def _step6_agent(guidelines_str: str):
+    return _VisionAgent(
+        name="UIComponentEvaluator",
+        system_message=f'''
             Evaluate the **visual clarity, recognizability, and visual consistency** of UI components in each section of a static UI screen.
             Apply the following evaluation guidelines, but apply them strictly to **visual perception only**: {guidelines_str}
 
@@ -797,85 +2910,58 @@ async def step5_6_endpoint(
                     identified_gap: "<Korean description with English technical terms kept as-is. Detail how the issue affects recognizability/clarity/scanning>"
             </formatting_example>
             ''',
-            llm_config=llm_config,
-        )
+        llm_config=llm_config,
+    )
 
+def _step6_analyzer(task: str, guidelines_str: str, image: dict, app_ui: Optional[dict] = None):
+    """Per-section component evaluation from that section's step3 output (memoized); ``app_ui`` enables section crops."""
+    step6_agent = _step6_agent(guidelines_str)
 
-        for section_name, component_data in step3_results.items():
-            try:
-                print(f"Evaluating detailed components in section: {section_name}...")
+    async def _evaluate_section(section_name, component_data):
+        print(f"Evaluating detailed components in section: {section_name}...")
+        image_line = await _section_image_prompt(image, app_ui, section_name)
 
-                evaluation_message = f"""
+        evaluation_message = f"""
                 Evaluate the **visual clarity, recognizability, and visual consistency of UI COMPONENTS within the '{section_name}' section**, based on how they appear **collectively**.
                 Do not focus on interactivity or function. Identify only visual-related problems.
                 - Task: {task}.
-                - Visual and functional characteristics of components:\n{yaml.dump(component_data, allow_unicode=True, sort_keys=False)}
-                - Image: <img {image_data_url}>
+                - Visual and functional characteristics of components:\n{_dump_yaml(component_data)}
+                {image_line}
                 """
 
-                component_evaluation_res = user_proxy.initiate_chat(step6_agent, message=evaluation_message)
+        _, parsed_6 = await _structured_reply(step6_agent, evaluation_message)
+        print(f"Detailed evaluation for {section_name} completed.")
+        return parsed_6.get(section_name, parsed_6)
 
-                raw_6 = component_evaluation_res.chat_history[1]['content'].strip()
-                if raw_6.startswith("```yaml"):
-                    raw_6 = raw_6.removeprefix("```yaml").removesuffix("```").strip()
-                
-                parsed_6 = yaml.safe_load(raw_6)
+    return _memoize_sections("step6", image["digest"], task, _evaluate_section, context=guidelines_str, app_ui=app_ui)
 
-                step6_results[section_name] = parsed_6.get(section_name, parsed_6)
-                print(f"Detailed evaluation for {section_name} completed.")
-
-            except Exception as e:
-                print(f"Error evaluating detailed components in section {section_name}: {e}")
-                step6_results[section_name] = {"error": str(e)}
-        
-        print("✅ Step 6 completed.")
+def _step6_batch_analyzer(task: str, guidelines_str: str, image: dict):
+    """All sections' component evaluation in one request (single-context mode)."""
+    step6_agent = _step6_agent(guidelines_str)
 
-    except Exception as e:
-        print(f"❌ Error in Step 6 part: {type(e).__name__}: {e}")
-        step6_results = {"error": f"Error in Step 6: {str(e)}"}
+    async def _evaluate_sections(sections):
+        names = [section_name for section_name, _ in sections]
+        image_data_url = await asyncio.to_thread(_image_data_url, image)
+        evaluation_message = f"""
+                Evaluate the **visual clarity, recognizability, and visual consistency of UI COMPONENTS within each of the sections below**, based on how they appear **collectively** in each section.
+                Do not focus on interactivity or function. Identify only visual-related problems.
+                - Task: {task}.
+                - Visual and functional characteristics of components per section:\n{_dump_yaml(dict(sections))}
+                - Image: <img {image_data_url}>
+                {_batch_output_instructions(names)}
+                """
 
-    # 로그 기록
-    log_step_result(
-        # user_id removed
-        step="step5",
-        task=task,
-        image_path=None,
-        result=step5_result,
-    )
-    log_step_result(
-        # user_id removed
-        step="step6",
-        task=task,
-        image_path=None,
-        result=step6_results,
-    )
-    return {"step5_result": step5_result, "step6_result": step6_results}
+        res = await _initiate_chat(step6_agent, message=evaluation_message)
+        return _split_section_results(res.chat_history[-1]["content"], names)
 
+    return _evaluate_sections
 
-@api.post("/step7")
-async def step7_endpoint(
-    task: str = Form(...),
-    step3_results_str: str = Form(...),
-    step4_results_str: str = Form(...),
-    step5_results_str: str = Form(...),
-    step6_results_str: str = Form(...),
-    guidelines_str: str = Form(...),
-):
-    try:
-        print("▶️ Starting Step 7: Final Evaluation...")
-        step3_results = yaml.safe_load(step3_results_str)
-        step4_results = yaml.safe_load(step4_results_str)
-        step5_result = yaml.safe_load(step5_results_str)
-        step6_results = yaml.safe_load(step6_results_str)
-
-        analyzer_res = {
-            "section_analysis": step4_results,
-            "component_analysis": step3_results
-        }
 
-        step7 = MultimodalConversableAgent(
-            name="FinalEvaluator",
-            system_message=f'''
+@_profile_phase("build_prompt")
+def _step7_agent(guidelines_str: str):
+    return _VisionAgent(
+        name="FinalEvaluator",
+        system_message=f'''
             You are the Administrator of a Usability Evaluation Assistant system.
 
             Your goal is to 
@@ -929,10 +3015,18 @@ async def step7_endpoint(
                 - "<Korean description with English technical terms kept as-is. Execution-ready solution and UI-wide impact evaluation>"
             </formatting_example>
             ''',
-            llm_config=eval_config,
-        )
+        llm_config=eval_config,
+    )
 
+async def _run_step7(task: str, step3_results, step4_results, step5_result, step6_results, guidelines_str: str):
+    """Root-cause analysis (7-1) and solution development (7-2) (memoized)."""
+    analyzer_res = {
+        "section_analysis": step4_results,
+        "component_analysis": step3_results
+    }
+    step7 = _step7_agent(guidelines_str)
 
+    async def _final_evaluation():
         # Step 7-1: Categorization & Multi-Level Root Cause Analysis Using ReAct
         step7_1_message = f"""
         **Step 1: Categorization & Multi-Level Root Cause Analysis (Using ReAct)**
@@ -976,12 +3070,7 @@ async def step7_endpoint(
         </formatting_example>
         """
 
-        step7_1_res = user_proxy.initiate_chat(step7, message=step7_1_message)
-        categorized_issues_with_root_causes_raw = step7_1_res.chat_history[-1]['content']
-        if "```yaml" in categorized_issues_with_root_causes_raw:
-            categorized_issues_with_root_causes_raw = categorized_issues_with_root_causes_raw.split("```yaml")[1].split("```")[0].strip()
-        
-        categorized_issues_with_root_causes = yaml.safe_load(categorized_issues_with_root_causes_raw)
+        _, categorized_issues_with_root_causes = await _structured_reply(step7, step7_1_message)
         print("✅ Step 7-1 completed.")
 
         step7_2_message_template = f"""
@@ -1029,16 +3118,373 @@ async def step7_endpoint(
         """
 
         # Step 7-2 실행
-        step7_2_res = user_proxy.initiate_chat(
-            step7,
-            message=step7_2_message_template
+        _, solution_output = await _structured_reply(step7, step7_2_message_template)
+        print("✅ Step 7-2 completed.")
+        return solution_output
+
+    # Step 7 prompts are text-only, so the image is not part of the key
+    return await _memoized_call(
+        "step7",
+        "",
+        task,
+        {"step3": step3_results, "step4": step4_results, "step5": step5_result, "step6": step6_results, "guidelines": guidelines_str},
+        _final_evaluation,
+    )
+
+
+# --- 클라이언트 연결 끊김 감지 ---
+# A participant who reloads mid-step leaves the server running every remaining
+# section. Decorated endpoints run as a task and poll request.is_disconnected()
+# every DISCONNECT_POLL_SECONDS (0 = never cancel); once the client is gone the
+# task is cancelled, so sections not yet started never are. Sections already
+# under way finish in the background (_finish_detached) and land in the step
+# cache, so a retry after the reload picks them up instead of paying again.
+# Streaming endpoints stop the same way when their response is closed.
+DISCONNECT_POLL_SECONDS = float(os.getenv("DISCONNECT_POLL_SECONDS", "1.0"))
+
+class _KeepServerReceive:
+    """Outermost ASGI layer: keeps the server's own receive() in the scope.
+
+    The @app.middleware functions above wrap receive() in a way that never
+    reports http.disconnect to the endpoint, so the poll reads the server's
+    channel instead. By then FastAPI has read the whole body.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            scope["critique.receive"] = receive
+        await self.app(scope, receive, send)
+
+# Registered last, so it wraps every other middleware
+app.add_middleware(_KeepServerReceive)
+
+def _cancel_on_disconnect(endpoint):
+    @functools.wraps(endpoint)
+    async def _wrapper(*args, **kwargs):
+        request = kwargs.get("request") or next((a for a in args if isinstance(a, Request)), None)
+        if request is None or DISCONNECT_POLL_SECONDS <= 0:
+            return await endpoint(*args, **kwargs)
+        watcher = Request(request.scope, request.scope.get("critique.receive", request.receive))
+        task = asyncio.ensure_future(endpoint(*args, **kwargs))
+        try:
+            while True:
+                done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_SECONDS)
+                if done:
+                    return task.result()
+                if await watcher.is_disconnected():
+                    logger.info("Client left %s; cancelling its remaining work", request.url.path)
+                    _metrics.inc("critique_client_disconnects_total", {"path": request.url.path})
+                    return JSONResponse(status_code=499, content={"error": "Client disconnected"})
+        finally:
+            task.cancel()
+    return _wrapper
+
+# Add '/api/' prefix variants for all step endpoints to match frontend fetch paths and Vercel routing
+@api.post("/step1")
+@_cancel_on_disconnect
+async def step1(request: Request, task: str = Form(...), image_filename: str = Form("") ):
+    # Guard for missing LLM config
+    if user_proxy is None or not llm_config:
+        return JSONResponse(status_code=503, content={"error": "LLM config missing on server. Please configure OAI_CONFIG_LIST_JSON or environment for server deployment."})
+
+    effective_filename = image_filename or IMAGE_FILENAME
+    print(f"=== Using Image: /stores/{effective_filename}")
+    print(f"=== Task: {task}")
+
+    # 이미지 파일을 base64로 인코딩 (via HTTP from Next public)
+    try:
+        image_base64 = await _get_public_image_base64(request, effective_filename)
+    except HTTPException as e:
+        return JSONResponse(status_code=e.status_code, content={"error": str(e.detail)})
+
+    image = _image_ref(image_base64, effective_filename)
+    step1_output = await _run_step1(task, image)
+    if "error" in step1_output:
+        return JSONResponse(status_code=500, content=step1_output)
+    raw_content = step1_output["raw"]
+    parsed_yaml = step1_output["parsed"]
+
+    run_id = _runs.create(
+        task=task,
+        image_filename=effective_filename,
+        image_base64=image_base64,
+        image_digest=image["digest"],
+        app_ui=parsed_yaml.get("app_ui", {}),
+    )
+
+    return _with_usage({
+        "run_id": run_id,
+        "non_app_ui": parsed_yaml.get("non_app_ui", []),
+        "app_ui": parsed_yaml.get("app_ui", {}),
+        "raw": raw_content,
+        "task": task,
+        "image_path": f"/stores/{effective_filename}",
+        "image_url": f"/stores/{effective_filename}",
+        "image_base64": image_base64,
+        # 로그 기록
+        "_log": log_step_result(
+            # user_id removed
+            step="step1",
+            task=task,
+            image_path=f"/stores/{effective_filename}",
+            result=parsed_yaml,
         )
-        solution_output_raw = step7_2_res.chat_history[-1]['content']
-        if "```yaml" in solution_output_raw:
-            solution_output_raw = solution_output_raw.split("```yaml")[1].split("```")[0].strip()
+    }, run_id)
 
-        solution_output = yaml.safe_load(solution_output_raw)
-        print("✅ Step 7-2 completed.")
+
+@api.post("/step2")
+@_cancel_on_disconnect
+async def step2(request: Request, request_body: Step2Request):
+    if user_proxy is None or not llm_config:
+        return JSONResponse(status_code=503, content={"error": "LLM config missing on server."})
+    task = request_body.task
+    run_id = request_body.run_id
+    run = _runs.get(run_id) if run_id else None
+    if run_id and run is None:
+        return _unknown_run(run_id)
+    app_ui = _with_run_bboxes(request_body.app_ui, run)
+    try:
+        image = await _request_image(request, run)
+    except HTTPException as e:
+        return JSONResponse(status_code=e.status_code, content={"error": str(e.detail)})
+
+    # step2 실행 (섹션별 병렬)
+    step2_results = await _fan_out_sections(
+        app_ui.items(),
+        _step2_analyzer(task, app_ui, image),
+        step="step2",
+    )
+
+    # 로그 기록
+    log_step_result(
+        # user_id removed
+        step="step2",
+        task=task,
+        image_path=None,
+        result=step2_results,
+    )
+    if run:
+        _runs.update(run_id, app_ui=app_ui, step2=step2_results)
+    return _with_usage({"result": step2_results}, run_id)
+
+
+
+@api.post("/step3")
+@_cancel_on_disconnect
+async def step3(request: Request, request_body: Step3Request):
+    if user_proxy is None or not llm_config:
+        return JSONResponse(status_code=503, content={"error": "LLM config missing on server."})
+    task = request_body.task
+    app_ui_components = request_body.app_ui_components
+    run_id = request_body.run_id
+    run = _runs.get(run_id) if run_id else None
+    if run_id and run is None:
+        return _unknown_run(run_id)
+    app_ui = _with_run_bboxes(request_body.app_ui, run)
+    try:
+        image = await _request_image(request, run)
+    except HTTPException as e:
+        return JSONResponse(status_code=e.status_code, content={"error": str(e.detail)})
+
+    if not app_ui_components or len(app_ui_components) == 0:
+        print("❌ app_ui_components가 비어있거나 None입니다!")
+        return {"result": {"error": "No UI components provided"}}
+
+    print(f"🔄 {len(app_ui_components)}개 섹션 처리 시작...")
+
+    step3_results = await _fan_out_step(
+        "step3",
+        app_ui_components.items(),
+        _step3_analyzer(task, image, app_ui),
+        _step3_batch_analyzer(task, image),
+        image["digest"],
+        task,
+    )
+
+    # 로그 기록
+    log_step_result(
+        # user_id removed
+        step="step3",
+        task=task,
+        image_path=None,
+        result=step3_results,
+    )
+    if run:
+        _runs.update(run_id, app_ui_components=app_ui_components, step3=step3_results)
+    return _with_usage({"result": step3_results}, run_id)
+
+# --- Step 4 엔드포인트 수정 ---
+
+@api.post("/step4")
+@_cancel_on_disconnect
+async def step4_endpoint(request: Request, request_body: Step4Request):
+    if user_proxy is None or not llm_config:
+        return JSONResponse(status_code=503, content={"error": "LLM config missing on server."})
+    task = request_body.task
+    run_id = request_body.run_id
+    run = _runs.get(run_id) if run_id else None
+    if run_id and run is None:
+        return _unknown_run(run_id)
+    step3_results = request_body.step3_results
+    if step3_results is None:
+        step3_results = (run or {}).get("step3")
+    if step3_results is None:
+        return JSONResponse(status_code=400, content={"error": "Missing step3_results (send them or a valid run_id)."})
+    app_ui = _with_run_bboxes(request_body.app_ui, run)
+    try:
+        image = await _request_image(request, run)
+    except HTTPException as e:
+        return JSONResponse(status_code=e.status_code, content={"error": str(e.detail)})
+
+    step4_results = await _fan_out_step(
+        "step4",
+        step3_results.items(),
+        _step4_analyzer(task, app_ui, image),
+        _step4_batch_analyzer(task, app_ui, image),
+        image["digest"],
+        task,
+        context=app_ui,
+    )
+
+    # 로그 기록
+    log_step_result(
+        # user_id removed
+        step="step4",
+        task=task,
+        image_path=None,
+        result=step4_results,
+    )
+    if run:
+        _runs.update(run_id, step3=step3_results, step4=step4_results)
+    return _with_usage({"result": step4_results}, run_id)
+
+
+@api.post("/step5_6")
+@_cancel_on_disconnect
+async def step5_6_endpoint(
+    request: Request,
+    task: str = Form(None),
+    image_base64: str = Form(None),
+    step3_results_str: str = Form(None),
+    step4_results_str: str = Form(None),
+    guidelines_str: str = Form(None),
+    run_id: str = Form(None),
+):
+    """
+    Combined endpoint for Step 5 (Layout Evaluation) and Step 6 (Component Evaluation).
+
+    With ``run_id`` the image and step3/step4 results come from the server-side
+    run; any field posted explicitly still takes precedence.
+    """
+    run = _runs.get(run_id) if run_id else None
+    if run_id and run is None:
+        return _unknown_run(run_id)
+    task = task or (run or {}).get("task")
+    guidelines_str = guidelines_str or (run or {}).get("guidelines")
+    if image_base64:
+        image = _image_ref(image_base64, (run or {}).get("image_filename"))
+    else:
+        image = _run_image(run) if run else None
+    if not task or not image or not guidelines_str:
+        return JSONResponse(status_code=400, content={"error": "Missing task, image_base64 or guidelines_str (send them or a valid run_id)."})
+
+    step3_results = step4_results = None
+    step5_result = {}
+    step6_results = {}
+
+    # --- Part 1: Step 5 Logic (Layout Evaluation) ---
+    try:
+        print("▶️ Starting Step 5: Layout Evaluation...")
+        step4_results = _form_or_run(run, "step4", step4_results_str)
+        step5_result = await _run_step5(task, step4_results, guidelines_str, image)
+        print("✅ Step 5 completed.")
+        await _notify_section("step5", None, step5_result)
+
+    except Exception as e:
+        print(f"❌ Error in Step 5 part: {type(e).__name__}: {e}")
+        step5_result = {"error": f"Error in Step 5: {str(e)}"}
+
+
+    # --- Part 2: Step 6 Logic (Component Evaluation) ---
+    try:
+        print("▶️ Starting Step 6: Detailed Component Evaluation...")
+        step3_results = _form_or_run(run, "step3", step3_results_str)
+        step6_results = await _fan_out_step(
+            "step6",
+            step3_results.items(),
+            _step6_analyzer(task, guidelines_str, image, (run or {}).get("app_ui")),
+            _step6_batch_analyzer(task, guidelines_str, image),
+            image["digest"],
+            task,
+            context=guidelines_str,
+        )
+        
+        print("✅ Step 6 completed.")
+
+    except Exception as e:
+        print(f"❌ Error in Step 6 part: {type(e).__name__}: {e}")
+        step6_results = {"error": f"Error in Step 6: {str(e)}"}
+
+    # 로그 기록
+    log_step_result(
+        # user_id removed
+        step="step5",
+        task=task,
+        image_path=None,
+        result=step5_result,
+    )
+    log_step_result(
+        # user_id removed
+        step="step6",
+        task=task,
+        image_path=None,
+        result=step6_results,
+    )
+    if run:
+        _runs.update(
+            run_id,
+            guidelines=guidelines_str,
+            step3=step3_results if step3_results is not None else run.get("step3"),
+            step4=step4_results if step4_results is not None else run.get("step4"),
+            step5=step5_result,
+            step6=step6_results,
+        )
+    return _with_usage({"step5_result": step5_result, "step6_result": step6_results}, run_id)
+
+
+@api.post("/step7")
+@_cancel_on_disconnect
+async def step7_endpoint(
+    request: Request,
+    task: str = Form(None),
+    step3_results_str: str = Form(None),
+    step4_results_str: str = Form(None),
+    step5_results_str: str = Form(None),
+    step6_results_str: str = Form(None),
+    guidelines_str: str = Form(None),
+    run_id: str = Form(None),
+):
+    run = _runs.get(run_id) if run_id else None
+    if run_id and run is None:
+        return _unknown_run(run_id)
+    task = task or (run or {}).get("task")
+    guidelines_str = guidelines_str or (run or {}).get("guidelines")
+    if not task or not guidelines_str:
+        return JSONResponse(status_code=400, content={"error": "Missing task or guidelines_str (send them or a valid run_id)."})
+
+    try:
+        print("▶️ Starting Step 7: Final Evaluation...")
+        step3_results = _form_or_run(run, "step3", step3_results_str)
+        step4_results = _form_or_run(run, "step4", step4_results_str)
+        step5_result = _form_or_run(run, "step5", step5_results_str)
+        step6_results = _form_or_run(run, "step6", step6_results_str)
+
+        solution_output = await _run_step7(
+            task, step3_results, step4_results, step5_result, step6_results, guidelines_str
+        )
 
         # 로그 기록
         log_step_result(
@@ -1048,38 +3494,569 @@ async def step7_endpoint(
             image_path=None,
             result=solution_output,
         )
-        return {"solution": solution_output}
+        if run:
+            _runs.update(
+                run_id,
+                guidelines=guidelines_str,
+                step3=step3_results,
+                step4=step4_results,
+                step5=step5_result,
+                step6=step6_results,
+                step7=solution_output,
+            )
+        return _with_usage({"solution": solution_output}, run_id)
 
     except Exception as e:
         print(f"❌ Error in Step 7 part: {type(e).__name__}: {e}")
         return JSONResponse(status_code=500, content={"error": f"Error in Step 7: {str(e)}"})
 
 
+# --- 섹션 단위 DAG 파이프라인 ---
+# step4 and step6 for a section start as soon as that section's step3 is done;
+# only step5 (all step4) and step7 (everything) wait for a full fan-in.
+PIPELINE_CONCURRENCY = max(1, int(os.getenv("PIPELINE_CONCURRENCY", "8")))
+
+class PipelineRequest(BaseModel):
+    task: Optional[str] = None
+    app_ui: Optional[Dict[str, Any]] = None
+    app_ui_components: Optional[Dict[str, Any]] = None
+    guidelines_str: Optional[str] = None
+    run_id: Optional[str] = None
+
+def _is_error(result) -> bool:
+    return isinstance(result, dict) and "error" in result
+
+async def _run_dag(nodes: dict, concurrency: int = None) -> dict:
+    """Run ``{node: (deps, fn)}``, starting each node once its dependencies finish.
+
+    Nodes are ``(step, section)`` tuples and ``fn`` receives ``{dep: result}``.
+    A raising node yields ``{"error": ...}`` for itself only, and every
+    finished node is reported to the active streaming listener.
+    """
+    semaphore = asyncio.Semaphore(max(1, concurrency or PIPELINE_CONCURRENCY))
+    tasks: dict = {}
+    completed = 0
+
+    async def _run_node(node, deps, fn):
+        nonlocal completed
+        inputs = {dep: await tasks[dep] for dep in deps}
+        async with semaphore:
+            try:
+                result = await fn(inputs)
+            except Exception as e:
+                logger.error("Pipeline node %s failed: %s: %s", node, type(e).__name__, e)
+                result = {"error": str(e)}
+        completed += 1
+        await _notify_section(node[0], node[1], result, completed, len(nodes))
+        return result
+
+    # All tasks exist before any of them runs, so insertion order does not matter
+    for node, (deps, fn) in nodes.items():
+        tasks[node] = asyncio.ensure_future(_run_node(node, deps, fn))
+    try:
+        results = await asyncio.gather(*tasks.values())
+    finally:
+        for task in tasks.values():
+            task.cancel()
+    return dict(zip(tasks.keys(), results))
+
+async def _run_critique_pipeline(task: str, app_ui: dict, app_ui_components: dict, guidelines_str: str, image: dict) -> dict:
+    """Steps 3-7 as a per-section DAG. Returns ``{"step3": ..., ..., "step7": ...}``."""
+    analyze3 = _step3_analyzer(task, image, app_ui)
+    analyze4 = _step4_analyzer(task, app_ui, image)
+    analyze6 = _step6_analyzer(task, guidelines_str, image, app_ui)
+    sections = list(app_ui_components)
+
+    def _from_step3(analyze, section_name):
+        async def _fn(inputs):
+            step3_result = inputs[("step3", section_name)]
+            if _is_error(step3_result):
+                return {"error": f"Skipped: step3 failed for section '{section_name}'"}
+            return await analyze(section_name, step3_result)
+        return _fn
+
+    def _collect(results, step):
+        return {section_name: results[(step, section_name)] for section_name in sections}
+
+    nodes = {}
+    for section_name, component_data in app_ui_components.items():
+        nodes[("step3", section_name)] = ([], lambda _inputs, s=section_name, d=component_data: analyze3(s, d))
+        nodes[("step4", section_name)] = ([("step3", section_name)], _from_step3(analyze4, section_name))
+        nodes[("step6", section_name)] = ([("step3", section_name)], _from_step3(analyze6, section_name))
+
+    async def _step5(inputs):
+        return await _run_step5(task, _collect(inputs, "step4"), guidelines_str, image)
+
+    async def _step7(inputs):
+        return await _run_step7(
+            task,
+            _collect(inputs, "step3"),
+            _collect(inputs, "step4"),
+            inputs[("step5", None)],
+            _collect(inputs, "step6"),
+            guidelines_str,
+        )
+
+    nodes[("step5", None)] = ([("step4", s) for s in sections], _step5)
+    nodes[("step7", None)] = (
+        [(step, s) for step in ("step3", "step4", "step6") for s in sections] + [("step5", None)],
+        _step7,
+    )
+
+    results = await _run_dag(nodes)
+    return {
+        "step3": _collect(results, "step3"),
+        "step4": _collect(results, "step4"),
+        "step5": results[("step5", None)],
+        "step6": _collect(results, "step6"),
+        "step7": results[("step7", None)],
+    }
+
+@api.post("/pipeline")
+@_cancel_on_disconnect
+async def pipeline_endpoint(request: Request, request_body: PipelineRequest):
+    """Run steps 3-7 server-side in one request, scheduled per section."""
+    if user_proxy is None or not llm_config:
+        return JSONResponse(status_code=503, content={"error": "LLM config missing on server."})
+    run_id = request_body.run_id
+    run = _runs.get(run_id) if run_id else None
+    if run_id and run is None:
+        return _unknown_run(run_id)
+    task = request_body.task or (run or {}).get("task")
+    app_ui = request_body.app_ui or (run or {}).get("app_ui")
+    app_ui_components = request_body.app_ui_components or (run or {}).get("app_ui_components") or (run or {}).get("step2")
+    guidelines_str = request_body.guidelines_str or (run or {}).get("guidelines")
+    if not task or not app_ui or not app_ui_components or not guidelines_str:
+        return JSONResponse(status_code=400, content={"error": "Missing task, app_ui, app_ui_components or guidelines_str (send them or a valid run_id)."})
+    try:
+        image = await _request_image(request, run)
+    except HTTPException as e:
+        return JSONResponse(status_code=e.status_code, content={"error": str(e.detail)})
+
+    logger.info("Section pipeline started for %d sections", len(app_ui_components))
+    results = await _run_critique_pipeline(task, app_ui, app_ui_components, guidelines_str, image)
+    logger.info("Section pipeline completed")
+
+    # 로그 기록
+    for step in ("step3", "step4", "step5", "step6", "step7"):
+        log_step_result(
+            step=step,
+            task=task,
+            image_path=None,
+            result=results[step],
+        )
+    if run:
+        _runs.update(
+            run_id,
+            app_ui=app_ui,
+            app_ui_components=app_ui_components,
+            guidelines=guidelines_str,
+            **results,
+        )
+    return _with_usage({
+        "step3_result": results["step3"],
+        "step4_result": results["step4"],
+        "step5_result": results["step5"],
+        "step6_result": results["step6"],
+        "solution": results["step7"],
+    }, run_id)
+
+
+# --- SSE 스트리밍 엔드포인트 ---
+# Same handlers as above, but every finished section is pushed to the client
+# as a "section" event; the full response follows as a final "done" event.
+SSE_KEEPALIVE_SECONDS = float(os.getenv("SSE_KEEPALIVE_SECONDS", "15"))
+
+def _sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+def _stream_handler(handler, *args, **kwargs) -> StreamingResponse:
+    """Run a step handler and stream its section results as Server-Sent Events."""
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def _on_section(event: dict):
+        await queue.put(("section", event))
+
+    async def _run():
+        _section_listener.set(_on_section)
+        try:
+            result = await handler(*args, **kwargs)
+            if isinstance(result, JSONResponse):
+                body = json.loads(result.body)
+                if result.status_code >= 400:
+                    await queue.put(("error", {"status": result.status_code, **body}))
+                    return
+                result = body
+            await queue.put(("done", result))
+        except Exception as e:
+            logger.exception("Streaming handler failed: %s: %s", type(e).__name__, e)
+            await queue.put(("error", {"status": 500, "error": str(e)}))
+
+    async def _events():
+        task = asyncio.create_task(_run())
+        try:
+            while True:
+                try:
+                    event, data = await asyncio.wait_for(queue.get(), SSE_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield _sse(event, data)
+                if event in ("done", "error"):
+                    break
+        finally:
+            task.cancel()
+
+    return StreamingResponse(
+        _events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@api.post("/step2/stream")
+async def step2_stream(request: Request, request_body: Step2Request):
+    return _stream_handler(step2, request, request_body)
+
+@api.post("/step3/stream")
+async def step3_stream(request: Request, request_body: Step3Request):
+    return _stream_handler(step3, request, request_body)
+
+@api.post("/step4/stream")
+async def step4_stream(request: Request, request_body: Step4Request):
+    return _stream_handler(step4_endpoint, request, request_body)
+
+@api.post("/step5_6/stream")
+async def step5_6_stream(
+    request: Request,
+    task: str = Form(None),
+    image_base64: str = Form(None),
+    step3_results_str: str = Form(None),
+    step4_results_str: str = Form(None),
+    guidelines_str: str = Form(None),
+    run_id: str = Form(None),
+):
+    return _stream_handler(
+        step5_6_endpoint,
+        request=request,
+        task=task,
+        image_base64=image_base64,
+        step3_results_str=step3_results_str,
+        step4_results_str=step4_results_str,
+        guidelines_str=guidelines_str,
+        run_id=run_id,
+    )
+
+@api.post("/pipeline/stream")
+async def pipeline_stream(request: Request, request_body: PipelineRequest):
+    return _stream_handler(pipeline_endpoint, request, request_body)
+
+
+# --- 비동기 작업 큐 (step1~7 전체 실행) ---
+# A full critique is a dozen long requests; as a job it is one short POST that
+# returns a job_id, then cheap polling. Jobs live in SQLite so any uvicorn
+# worker can answer a poll, and every process with JOB_WORKERS > 0 pulls from
+# the same queue. Web processes are submit-only by default, so N uvicorn
+# workers do not each run full critiques; run job_worker.py next to them (the
+# Procfile's worker process) or set JOB_WORKERS on a single web process.
+JOB_WORKERS = max(0, int(os.getenv("JOB_WORKERS", "0")))
+JOB_DB_PATH = os.getenv("JOB_DB_PATH", os.path.join(os.getcwd(), ".cache", "jobs.sqlite"))
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "1.0"))
+JOB_STALE_SECONDS = float(os.getenv("JOB_STALE_SECONDS", "3600"))
+JOB_RETENTION_SECONDS = float(os.getenv("JOB_RETENTION_SECONDS", "86400"))
+
+class JobRequest(BaseModel):
+    task: str
+    guidelines_str: str
+    image_filename: Optional[str] = None
+
+class _JobQueue:
+    """SQLite-backed job table used as a FIFO queue.
+
+    Falls back to an in-memory database (this process only) when the file
+    cannot be opened.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            conn = sqlite3.connect(path, timeout=5.0, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+        except Exception as e:
+            logger.warning("Job queue using in-memory SQLite, cannot open %s: %s", path, e)
+            self.path = ":memory:"
+            conn = sqlite3.connect(":memory:", check_same_thread=False)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, status TEXT NOT NULL, request TEXT NOT NULL, "
+            "claim TEXT, progress TEXT, result TEXT, error TEXT, created REAL NOT NULL, started REAL, finished REAL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs(status, created)")
+        conn.commit()
+        self._conn = conn
+
+    def _execute(self, sql: str, params=()) -> list:
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+            self._conn.commit()
+            return rows
+
+    def submit(self, request: dict) -> str:
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        self._execute(
+            "DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished < ?",
+            (now - JOB_RETENTION_SECONDS,),
+        )
+        self._execute(
+            "INSERT INTO jobs (id, status, request, created) VALUES (?, 'queued', ?, ?)",
+            (job_id, json.dumps(request, ensure_ascii=False), now),
+        )
+        return job_id
+
+    def claim(self) -> Optional[tuple]:
+        """Atomically move the oldest queued job to running; returns ``(job_id, request)``."""
+        claim = uuid.uuid4().hex
+        self._execute(
+            "UPDATE jobs SET status = 'running', claim = ?, started = ? WHERE id = "
+            "(SELECT id FROM jobs WHERE status = 'queued' ORDER BY created LIMIT 1) AND status = 'queued'",
+            (claim, time.time()),
+        )
+        rows = self._execute("SELECT id, request FROM jobs WHERE claim = ? AND status = 'running'", (claim,))
+        if not rows:
+            return None
+        return rows[0][0], json.loads(rows[0][1])
+
+    def progress(self, job_id: str, progress: dict):
+        self._execute("UPDATE jobs SET progress = ? WHERE id = ?", (json.dumps(progress, ensure_ascii=False), job_id))
+
+    def finish(self, job_id: str, result: dict):
+        self._execute(
+            "UPDATE jobs SET status = 'done', result = ?, finished = ? WHERE id = ?",
+            (json.dumps(result, ensure_ascii=False, default=str), time.time(), job_id),
+        )
+
+    def fail(self, job_id: str, error: str):
+        self._execute(
+            "UPDATE jobs SET status = 'failed', error = ?, finished = ? WHERE id = ?",
+            (error, time.time(), job_id),
+        )
+
+    def requeue(self, job_id: str = None):
+        """Put one interrupted job back, or every job running for longer than JOB_STALE_SECONDS."""
+        if job_id is not None:
+            self._execute("UPDATE jobs SET status = 'queued', claim = NULL, started = NULL WHERE id = ?", (job_id,))
+        else:
+            self._execute(
+                "UPDATE jobs SET status = 'queued', claim = NULL, started = NULL WHERE status = 'running' AND started < ?",
+                (time.time() - JOB_STALE_SECONDS,),
+            )
+
+    def get(self, job_id: str) -> Optional[dict]:
+        rows = self._execute(
+            "SELECT status, progress, result, error, created, started, finished FROM jobs WHERE id = ?", (job_id,)
+        )
+        if not rows:
+            return None
+        status, progress, result, error, created, started, finished = rows[0]
+        return {
+            "job_id": job_id,
+            "status": status,
+            "progress": json.loads(progress) if progress else None,
+            "result": json.loads(result) if result else None,
+            "error": error,
+            "created": created,
+            "started": started,
+            "finished": finished,
+        }
+
+    def stats(self) -> dict:
+        counts = dict(self._execute("SELECT status, COUNT(*) FROM jobs GROUP BY status"))
+        return {"path": self.path, "workers": JOB_WORKERS, **{s: counts.get(s, 0) for s in ("queued", "running", "done", "failed")}}
+
+_jobs = _JobQueue(JOB_DB_PATH)
+# Local wake-up hints so a fresh job does not wait for the next poll
+_job_signal: Optional[asyncio.Queue] = None
+_job_worker_tasks: list = []
+
+async def _run_full_critique(task: str, guidelines_str: str, image: dict) -> dict:
+    """Steps 1-7 for one screen; raises RuntimeError if step1 fails."""
+    step1_output = await _run_step1(task, image)
+    if "error" in step1_output:
+        raise RuntimeError(f"step1: {step1_output['error']}")
+    parsed = step1_output["parsed"] or {}
+    app_ui = parsed.get("app_ui", {})
+    step2_results = await _fan_out_sections(app_ui.items(), _step2_analyzer(task, app_ui, image), step="step2")
+    results = await _run_critique_pipeline(task, app_ui, step2_results, guidelines_str, image)
+    return {"step1": parsed, "step2": step2_results, **results}
+
+async def _run_job(job_id: str, request: dict):
+    _request_usage.set(_UsageSummary())
+    _llm_user.set("jobs")
+    progress = {"step": "step1", "completed": 0, "total": 1}
+    await asyncio.to_thread(_jobs.progress, job_id, dict(progress))
+
+    async def _on_section(event: dict):
+        progress.update(step=event["step"], completed=event["completed"], total=event["total"])
+        await asyncio.to_thread(_jobs.progress, job_id, dict(progress))
+
+    _section_listener.set(_on_section)
+    task = request["task"]
+    filename = request.get("image_filename") or IMAGE_FILENAME
+    image = _image_ref(await _load_image_base64(filename, request.get("base_url")), filename)
+    results = await _run_full_critique(task, request["guidelines_str"], image)
+
+    # 로그 기록
+    for step in ("step1", "step2", "step3", "step4", "step5", "step6", "step7"):
+        log_step_result(
+            step=step,
+            task=task,
+            image_path=f"/stores/{filename}" if step == "step1" else None,
+            result=results[step],
+        )
+    run_id = _runs.create(
+        task=task,
+        image_filename=filename,
+        image_base64=image["base64"],
+        image_digest=image["digest"],
+        app_ui=results["step1"].get("app_ui", {}),
+        app_ui_components=results["step2"],
+        guidelines=request["guidelines_str"],
+        **{step: results[step] for step in ("step2", "step3", "step4", "step5", "step6", "step7")},
+    )
+    return _with_usage({
+        "run_id": run_id,
+        "task": task,
+        "image_url": f"/stores/{filename}",
+        "non_app_ui": results["step1"].get("non_app_ui", []),
+        "app_ui": results["step1"].get("app_ui", {}),
+        "app_ui_components": results["step2"],
+        "step3_result": results["step3"],
+        "step4_result": results["step4"],
+        "step5_result": results["step5"],
+        "step6_result": results["step6"],
+        "solution": results["step7"],
+    }, run_id)
+
+async def _job_worker(worker_id: int):
+    # Queue calls are synchronous SQLite with a busy timeout, so they run in a thread
+    while True:
+        try:
+            claimed = await asyncio.to_thread(_jobs.claim)
+            if claimed is None:
+                try:
+                    await asyncio.wait_for(_job_signal.get(), JOB_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            job_id, request = claimed
+            logger.info("Job worker %d started job %s", worker_id, job_id)
+            try:
+                result = await _run_job(job_id, request)
+            except asyncio.CancelledError:
+                # Shutting down: hand the job back, cached steps make the rerun cheap.
+                # Synchronous on purpose; the task is already being cancelled.
+                _jobs.requeue(job_id)
+                raise
+            except Exception as e:
+                logger.error("Job %s failed: %s: %s", job_id, type(e).__name__, e)
+                await asyncio.to_thread(_jobs.fail, job_id, f"{type(e).__name__}: {e}")
+                continue
+            await asyncio.to_thread(_jobs.finish, job_id, result)
+            logger.info("Job %s completed", job_id)
+        except Exception as e:
+            # e.g. the database is locked past its timeout; a dead worker would strand the queue
+            logger.error("Job worker %d error, retrying in %ss: %s: %s", worker_id, JOB_POLL_SECONDS, type(e).__name__, e)
+            await asyncio.sleep(JOB_POLL_SECONDS)
+
+@app.on_event("startup")
+async def _start_job_workers():
+    global _job_signal
+    _job_signal = asyncio.Queue()
+    await asyncio.to_thread(_jobs.requeue)
+    for worker_id in range(JOB_WORKERS):
+        _job_worker_tasks.append(asyncio.create_task(_job_worker(worker_id)))
+
+@app.on_event("shutdown")
+async def _stop_job_workers():
+    for task in _job_worker_tasks:
+        task.cancel()
+    await asyncio.gather(*_job_worker_tasks, return_exceptions=True)
+    _job_worker_tasks.clear()
+
+@api.post("/jobs")
+async def submit_job(request: Request, request_body: JobRequest):
+    """Enqueue a full step1-7 critique and return its job_id immediately."""
+    if user_proxy is None or not llm_config:
+        return JSONResponse(status_code=503, content={"error": "LLM config missing on server."})
+    job_id = await asyncio.to_thread(_jobs.submit, {
+        "task": request_body.task,
+        "guidelines_str": request_body.guidelines_str,
+        "image_filename": request_body.image_filename or IMAGE_FILENAME,
+        "base_url": str(request.base_url),
+    })
+    if _job_signal is not None:
+        _job_signal.put_nowait(job_id)
+    return JSONResponse(status_code=202, content={"job_id": job_id, "status": "queued"})
+
+@api.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    job = await asyncio.to_thread(_jobs.get, job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"error": f"Unknown or expired job_id: {job_id}"})
+    job.pop("result")
+    return job
+
+@api.get("/jobs/{job_id}/result")
+async def job_result(job_id: str):
+    job = await asyncio.to_thread(_jobs.get, job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"error": f"Unknown or expired job_id: {job_id}"})
+    if job["status"] == "failed":
+        return JSONResponse(status_code=500, content={"job_id": job_id, "status": "failed", "error": job["error"]})
+    if job["status"] != "done":
+        return JSONResponse(status_code=202, content={"job_id": job_id, "status": job["status"], "progress": job["progress"]})
+    return {"job_id": job_id, "status": "done", **job["result"]}
+
+
 @api.post("/update_guidelines")
 async def update_guidelines(
     user_update: str = Form(...), 
     default_guidelines: str = Form(...),
-    task: str = Form(...),
-    image_base64: str = Form(...),
-    step3_results_str: str = Form(...),
-    step4_results_str: str = Form(...),
+    task: str = Form(""),
+    image_base64: str = Form(""),
+    step3_results_str: str = Form(""),
+    step4_results_str: str = Form(""),
+    run_id: str = Form(None),
 ):
-    
-    # API-level cache key
-    cache_key = f"{user_update}:{default_guidelines}"
-    if cache_key in guideline_update_cache:
-        print(f"✅ Returning cached result for: {cache_key}")
-        cached_result = guideline_update_cache[cache_key].copy()
-        cached_result.update({
-            "task": task,
-            "image_base64": image_base64,
-            "step3_results_str": step3_results_str,
-            "step4_results_str": step4_results_str,
-        })
-        return cached_result
+    run = _runs.get(run_id) if run_id else None
+    if run_id and run is None:
+        return _unknown_run(run_id)
+
+    def _with_passthrough(result: dict) -> dict:
+        # With a run the pipeline state stays server-side; only legacy clients get the echo
+        response = result.copy()
+        if run:
+            _runs.update(run_id, guidelines=result["guidelines"])
+            response["run_id"] = run_id
+        else:
+            response.update({
+                "task": task,
+                "image_base64": image_base64,
+                "step3_results_str": step3_results_str,
+                "step4_results_str": step4_results_str,
+            })
+        return _with_usage(response, run_id)
+
+    # API-level cache key (normalized + hashed)
+    cache_key = _guideline_cache_key(user_update, default_guidelines)
+    cached_result = await asyncio.to_thread(_guideline_cache_get, cache_key)
+    if cached_result is not None:
+        print(f"✅ Returning cached guideline update: {cache_key[:12]}")
+        return _with_passthrough(cached_result)
         
-    print(f"▶️ No cache found for: {cache_key}. Generating new guideline...")
-    _editor = MultimodalConversableAgent(
+    print(f"▶️ No cache found for: {cache_key[:12]}. Generating new guideline...")
+    _editor = _VisionAgent(
         name="GLEditor",
         system_message="""
 You are an expert UX-guideline editor with deep understanding of various design frameworks and usability principles.
@@ -1155,21 +4132,17 @@ guidelines:
     )
 
     try:
-        _editor_res = user_proxy.initiate_chat(
+        # A partial guideline list would be cached as if it were complete, so
+        # entries still missing after the re-request fail the update.
+        _, edited_gl = await _structured_reply(
             _editor,
             message=f"user_update: {user_update}\ndefault_guidelines: {default_guidelines}",
+            strict=True,
             auto_reply=False,
             max_turns=1
         )
-
-        # Extract and parse the response
-        edited_gl_raw = _editor_res.chat_history[-1]['content']
-        if "```yaml" in edited_gl_raw:
-            edited_gl_str = edited_gl_raw.split("```yaml")[1].split("```")[0].strip()
-        else:
-            edited_gl_str = edited_gl_raw
-
-        edited_gl = yaml.safe_load(edited_gl_str)
+        if not isinstance(edited_gl, dict):
+            raise ValueError("Guideline editor reply is not a YAML mapping")
         
         _guideline_list = edited_gl.get('guidelines', [])
         _change_log_list = edited_gl.get('change_log', [])
@@ -1184,17 +4157,11 @@ guidelines:
         
         # Cache only the generated content
         result_to_cache = {"guidelines": _guideline, "change_log": _change_log}
-        guideline_update_cache[cache_key] = result_to_cache
-        print(f"✅ Result cached for: {cache_key}")
+        await asyncio.to_thread(_guideline_cache_set, cache_key, result_to_cache)
+        print(f"✅ Result cached for: {cache_key[:12]}")
 
         # Return the cached content plus the passthrough data for the next step
-        response = result_to_cache.copy()
-        response.update({
-            "task": task,
-            "image_base64": image_base64,
-            "step3_results_str": step3_results_str,
-            "step4_results_str": step4_results_str,
-        })
+        response = _with_passthrough(result_to_cache)
         # 가이드라인 수정 로그 기록
         log_guideline_edit_prompt(
             # user_id removed
@@ -1213,36 +4180,9 @@ guidelines:
         print(f"Error during guideline update: {e}")
         return JSONResponse(status_code=500, content={"error": str(e)})
 
-@api.get("/baseline")
-@api.post("/baseline")
-async def baseline_endpoint(request: Request, task: str = Form(None), rico_id: str = Form(None), guidelines_str: str = Form(None)):
-    from datetime import datetime
-    def log_baseline_update(user_id, before, after, note, initial=False):
-        log_dir = os.path.join(os.getcwd(), "logs", "_baseline")
-        os.makedirs(log_dir, exist_ok=True)
-        log_path = os.path.join(log_dir, f"{user_id}_baseline.log")
-        with open(log_path, "a", encoding="utf-8") as f:
-            if initial:
-                f.write(f"[{datetime.now().isoformat()}] initial_baseline\n---result---\n{after}\n\n")
-            else:
-                f.write(f"[{datetime.now().isoformat()}] user_update: {note}\n---before---\n{before}\n---after---\n{after}\n\n")
-    if user_proxy is None or not llm_config:
-        return JSONResponse(status_code=503, content={"error": "LLM config missing on server."})
-
-    # GET: health check
-    if request.method == "GET":
-        return {"status": "ok", "message": "Baseline endpoint is reachable.", "task": task, "rico_id": rico_id}
-
-    # POST: baseline or revision
-    form = await request.form()
-    user_update = form.get("user_update")
-    baseline_solution = form.get("baseline_solution")
-    guidelines_str_post = form.get("guidelines_str") or guidelines_str
-
-    image_base64 = await _get_public_image_base64(request, IMAGE_FILENAME)
-    image_data_url = f"data:image/png;base64,{image_base64}"
-
-    base = MultimodalConversableAgent(
+@_profile_phase("build_prompt")
+def _baseline_agent(guidelines_str: str):
+    return _VisionAgent(
         name="BaseEvaluator",
         system_message=f'''
         You are the Administrator of a Usability Evaluation Assistant system.
@@ -1251,7 +4191,7 @@ async def baseline_endpoint(request: Request, task: str = Form(None), rico_id: s
             (1) systematically analyze usability issues of the given UI
             (2) develop validated, execution-ready solutions
 
-        Apply the following evaluation guidelines: {guidelines_str_post}
+        Apply the following evaluation guidelines: {guidelines_str}
         Ensure solutions **adhere to given guidelines**.
 
         Language Requirements:
@@ -1277,6 +4217,65 @@ async def baseline_endpoint(request: Request, task: str = Form(None), rico_id: s
         llm_config=llm_config,
     )
 
+async def _run_baseline(task: str, guidelines_str: str, image: dict, base=None) -> dict:
+    """Single-shot critique of the whole screen. Returns ``{"raw", "parsed"}``."""
+    # First sight of an image decodes/resizes/re-encodes it; keep that off the loop
+    image_data_url = await asyncio.to_thread(_image_data_url, image)
+    message = f"""
+Propose usability solutions that optimize usability and interaction flow while maintaining design clarity.
+- Task: {task}.
+- Image: <img {image_data_url}>
+"""
+    try:
+        raw, solution_yaml = await _structured_reply(base or _baseline_agent(guidelines_str), message)
+    except yaml.YAMLError as e:
+        raw = getattr(e, "raw", "")
+        return {"raw": raw, "parsed": {"error": f"YAML parsing failed: {str(e)}", "raw": raw}}
+    return {"raw": _extract_yaml_block(raw)[0], "parsed": solution_yaml}
+
+
+@api.get("/baseline")
+@api.post("/baseline")
+@_cancel_on_disconnect
+async def baseline_endpoint(
+    request: Request,
+    task: str = Form(None),
+    rico_id: str = Form(None),
+    guidelines_str: str = Form(None),
+    image_filename: str = Form(None),
+):
+    from datetime import datetime
+    def log_baseline_update(user_id, before, after, note, initial=False):
+        log_dir = os.path.join(os.getcwd(), "logs", "_baseline")
+        os.makedirs(log_dir, exist_ok=True)
+        log_path = os.path.join(log_dir, f"{user_id}_baseline.log")
+        with open(log_path, "a", encoding="utf-8") as f:
+            if initial:
+                f.write(f"[{datetime.now().isoformat()}] initial_baseline\n---result---\n{after}\n\n")
+            else:
+                f.write(f"[{datetime.now().isoformat()}] user_update: {note}\n---before---\n{before}\n---after---\n{after}\n\n")
+    if user_proxy is None or not llm_config:
+        return JSONResponse(status_code=503, content={"error": "LLM config missing on server."})
+
+    # GET: health check
+    if request.method == "GET":
+        return {"status": "ok", "message": "Baseline endpoint is reachable.", "task": task, "rico_id": rico_id}
+
+    # POST: baseline or revision
+    form = await request.form()
+    user_update = form.get("user_update")
+    baseline_solution = form.get("baseline_solution")
+    guidelines_str_post = form.get("guidelines_str") or guidelines_str
+
+    effective_filename = image_filename or IMAGE_FILENAME
+    try:
+        image_base64 = await _get_public_image_base64(request, effective_filename)
+    except HTTPException as e:
+        return JSONResponse(status_code=e.status_code, content={"error": str(e.detail)})
+    image = _image_ref(image_base64, effective_filename)
+
+    base = _baseline_agent(guidelines_str_post)
+
 
     # 수정 요청이 있으면 _revise_base 실행
     if not user_update and baseline_solution:
@@ -1285,48 +4284,35 @@ async def baseline_endpoint(request: Request, task: str = Form(None), rico_id: s
     if user_update and baseline_solution:
         import yaml
         try:
-            parsed_yaml = yaml.safe_load(baseline_solution)
+            parsed_yaml = _load_yaml(baseline_solution)
         except Exception as e:
             return JSONResponse(status_code=400, content={"error": f"Invalid baseline_solution YAML: {e}", "raw": baseline_solution})
         try:
-            revised = _revise_base(base, parsed_yaml, user_update)
+            revised = await _revise_base(base, parsed_yaml, user_update)
             revised_yaml = yaml.dump(revised, allow_unicode=True, sort_keys=False)
             # 수정 로그 기록
             log_baseline_update("user_p01", baseline_solution, revised_yaml, user_update)
-            return {
+            return _with_usage({
                 "raw": revised_yaml,
                 "task": task,
                 "image_base64": image_base64,
                 "rico_id": rico_id,
-            }
+            })
         except Exception as e:
             return JSONResponse(status_code=500, content={"error": f"Revision failed: {e}"})
 
     # 최초 요청: 기존 방식대로 baseline 생성
-    baseline_res = user_proxy.initiate_chat(
-        base,
-        message=f"""
-Propose usability solutions that optimize usability and interaction flow while maintaining design clarity.
-- Task: {task}.
-- Image: <img {image_data_url}>
-"""
-    )
-    solution_output = baseline_res.chat_history[-1]['content'].strip().removeprefix("```yaml").removesuffix("```").strip()
-
-    try:
-        solution_yaml = yaml.safe_load(solution_output)
-    except Exception as e:
-        solution_yaml = {"error": f"YAML parsing failed: {str(e)}", "raw": solution_output}
+    baseline = await _run_baseline(task, guidelines_str_post, image, base)
 
-    return {
-        "raw": solution_output,
+    return _with_usage({
+        "raw": baseline["raw"],
         "task": task,
         "image_base64": image_base64,
         "rico_id": rico_id,
-    }
+    })
 
 # --- Baseline YAML 전체 수정 함수 ---
-def _revise_base(
+async def _revise_base(
     agent,               # any MultimodalConversableAgent instance
     step_res,            # result dict for that step
     revision_note        # user’s requested changes
@@ -1336,7 +4322,7 @@ def _revise_base(
     No key (section/component) is assumed. The whole YAML is regenerated.
     """
     # 1) Serialize entire YAML
-    original_yaml = yaml.dump(step_res, sort_keys=False, allow_unicode=True)
+    original_yaml = _dump_yaml(step_res)
 
     # 2) Build prompt
     prompt = f"""
@@ -1351,26 +4337,16 @@ Regenerate and modify any fields necessary to reflect the requested changes.
 The output must be a complete, well-formed YAML mapping.
 """
     # 3) LLM 응답
-    res = user_proxy.initiate_chat(agent, message=prompt)
-    raw = res.chat_history[-1]["content"].strip()
-
-    # Remove ``` fences
-    lines = raw.splitlines()
-    if lines and lines[0].startswith("```"): lines.pop(0)
-    if lines and lines[-1].startswith("```"): lines.pop()
-    cleaned = "\n".join(lines)
-
-    # Try parsing with safe_load_all
-    try:
-        docs = list(yaml.safe_load_all(cleaned))
-    except yaml.YAMLError as e:
-        raise RuntimeError(f"Failed to parse YAML:\n{cleaned}") from e
-
-    # 5) Parse YAML (dict or list)
-    try:
-        parsed = yaml.safe_load(cleaned)
-    except yaml.YAMLError as e:
-        raise RuntimeError(f"Failed to parse YAML:\n{cleaned}") from e
+    res = await _initiate_chat(agent, message=prompt)
+    raw = res.chat_history[-1]["content"]
+
+    # 4) Parse YAML (dict or list). The whole mapping is regenerated, so a
+    # partially salvaged reply is still a failure here.
+    result = _parse_structured(raw)
+    cleaned = _extract_yaml_block(raw)[0]
+    if result.data is None or result.lost:
+        raise RuntimeError(f"Failed to parse YAML:\n{cleaned}")
+    parsed = result.data
 
     if not isinstance(parsed, (dict, list)):
         raise RuntimeError(f"Invalid YAML root type: {type(parsed)}\n{cleaned}")
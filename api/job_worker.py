@@ -0,0 +1,71 @@
+"""Job worker: runs queued /api/jobs critiques without serving HTTP.
+
+Web processes are submit-only by default (JOB_WORKERS=0), so a deployment that
+uses /api/jobs runs this next to them, sharing the same JOB_DB_PATH (the SQLite
+queue has to be on a filesystem both can reach):
+
+    cd api
+    python job_worker.py --workers 2
+
+Interrupted jobs go back to the queue on shutdown and are picked up again by
+the next worker; steps already cached make the rerun cheap.
+"""
+import argparse
+import asyncio
+import os
+import signal
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description="Run queued full-critique jobs.")
+    parser.add_argument(
+        "--workers", type=int, default=int(os.getenv("JOB_WORKERS") or 2),
+        help="jobs run at once by this process (default: JOB_WORKERS, else 2)",
+    )
+    return parser.parse_args()
+
+
+def _configure_env(args):
+    # Must happen before index is imported; it reads its knobs at import time
+    os.environ["JOB_WORKERS"] = str(max(1, args.workers))
+    for path in (HERE, os.path.dirname(HERE)):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+
+
+async def _serve():
+    import index
+
+    if index.user_proxy is None or not index.llm_config:
+        raise SystemExit("❌ LLM config missing: set OPENAI_API_KEY or OAI_CONFIG_LIST_JSON")
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass  # e.g. Windows; Ctrl+C still ends asyncio.run
+    await index._start_job_workers()
+    print(f"🧵 {index.JOB_WORKERS} job worker(s) polling {index._jobs.path}", flush=True)
+    try:
+        await stop.wait()
+    finally:
+        await index._stop_job_workers()
+        await index._close_http_client()
+        index._shutdown_llm_executor()
+        index._drain_action_logs()
+    print("👋 Job workers stopped", flush=True)
+
+
+def main():
+    args = _parse_args()
+    _configure_env(args)
+    asyncio.run(_serve())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,6 +2,7 @@
 import React from 'react';
 import { BaselineTable } from '../../components/tables/Baseline/BaselineTable';
 import TargetPanelBaseline from '../../components/TargetPanelBaseline';
+import { llmUserHeaders } from '../../utils/logUserAction';
 
 const API_BASE =
   typeof window !== 'undefined' &&
@@ -33,6 +34,7 @@ export default function BaselinePage() {
         formData.append('rico_id', ricoId);
         const res = await fetch(`${API_BASE}/api/baseline/`, {
           method: 'POST',
+          headers: llmUserHeaders(),
           body: formData,
         });
         if (!res.ok) {
@@ -8,6 +8,7 @@ import Image from "next/image";
 
 import { useEffect } from "react";
 import { useAppContext } from "../contexts/AppContext";
+import { llmUserHeaders } from "../utils/logUserAction";
 
 
 export default function TargetPanel() {
@@ -80,6 +81,7 @@ export default function TargetPanel() {
             : process.env.NEXT_PUBLIC_API_BASE || "";
         const res = await fetch(`${API_BASE}/api/step1/`, {
           method: "POST",
+          headers: llmUserHeaders(),
           body: formData,
         });
 
@@ -114,6 +116,9 @@ export default function TargetPanel() {
         if (data.task) {
           store.setTask(data.task);
         }
+        if (data.run_id) {
+          store.setRunId(data.run_id);
+        }
       } catch (error) {
         console.error("[TargetPanel] Step 1 error:", error);
       }
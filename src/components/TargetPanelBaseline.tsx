@@ -4,6 +4,7 @@ import { useEffect, useState } from "react";
 import Image from "next/image";
 
 import { useAppContext } from "../contexts/AppContext";
+import { llmUserHeaders } from "../utils/logUserAction";
 
 
 // props 타입 선언 추가
@@ -39,6 +40,7 @@ export default function TargetPanelBaseline({ setTask, setRicoId, onBaselineFetc
           if (guidelinesStr) formData.append("guidelines_str", guidelinesStr);
           fetch(`${API_BASE}/api/baseline`, {
             method: "POST",
+            headers: llmUserHeaders(),
             body: formData,
           })
             .then(res => res.json())
@@ -2,6 +2,7 @@
 
 import React, { useState, useEffect } from 'react';
 import yaml from 'js-yaml';
+import { llmUserHeaders } from '../../../utils/logUserAction';
 
 interface FinalReviewItem {
   id: string;
@@ -80,6 +81,7 @@ export const BaselineTable: React.FC<BaselineTableProps> = (props) => {
           : process.env.NEXT_PUBLIC_API_BASE || '';
       const res = await fetch(`${API_BASE}/api/baseline`, {
         method: 'POST',
+        headers: llmUserHeaders(),
         body: formData,
       });
       if (!res.ok) {
@@ -1,6 +1,7 @@
 import React, { useState } from 'react';
 import { ProjectionHeuristicRow } from '../../../types/critique';
 import { useUICritiqueStore } from '../../../stores/useUICritiqueStore';
+import { llmUserHeaders } from '../../../utils/logUserAction';
 
 interface HeuristicTableProps {
   projectionHeuristicData: ProjectionHeuristicRow[];
@@ -40,6 +41,7 @@ export const ProjectionHeuristicTable: React.FC<HeuristicTableProps> = ({
     try {
       const res = await fetch('/api/update_guidelines/', {
         method: 'POST',
+        headers: llmUserHeaders(),
         body: formData,
       });
 
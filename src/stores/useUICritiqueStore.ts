@@ -6,6 +6,7 @@ import { create, getState } from "zustand";
 console.log('--- ZUSTAND STORE INITIALIZING ---');
 
 interface UICritiqueState {
+  runId: string | null;
   task: string | null;
   image_base64: string | null;
   appUI: Record<string, any> | null;
@@ -18,6 +19,7 @@ interface UICritiqueState {
   step7Result: Record<string, any> | null;
   guidelines: string | null;
   changeLog: string | null;
+  setRunId: (runId: string | null) => void;
   setTask: (task: string) => void;
   setImageBase64: (base64: string) => void;
   setAppUI: (appUI: Record<string, any>) => void;
@@ -42,6 +44,7 @@ interface UICritiqueState {
 }
 
 const initialState = {
+  runId: null, // server-side pipeline run (Step 1)
   task: null,
   image_base64: null,
   appUI: {}, // Step 1
@@ -64,6 +67,7 @@ console.log('STORE: Initial state on creation:', initialState);
 
 export const useUICritiqueStore = create<UICritiqueState>((set) => ({
   ...initialState,
+  setRunId: (runId) => set((state) => ({ ...state, runId })),
   setTask: (task) => set((state) => ({ ...state, task })),
   setImageBase64: (base64) => set((state) => ({ ...state, image_base64: base64 })),
   setAppUI: (appUI) => set((state) => ({ ...state, appUI })),
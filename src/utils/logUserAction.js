@@ -15,45 +15,156 @@ const API_BASE = (typeof window !== 'undefined' && !process.env.NEXT_PUBLIC_API_
 
 // API endpoint for logging
 const LOG_API_URL = `${API_BASE}/api/log-user-action/`;
+const LOG_BATCH_API_URL = `${API_BASE}/api/log-user-actions/`;
 
-export async function logUserAction({ action_type, content, details = {} }) {
+// Actions are buffered and sent in one request every FLUSH_INTERVAL_MS, as soon
+// as FLUSH_MAX_EVENTS are pending, and when the page is hidden or unloaded.
+const FLUSH_INTERVAL_MS = 5000;
+const FLUSH_MAX_EVENTS = 50;
+// Bodies above this are gzip-compressed when the browser supports it
+const GZIP_MIN_BYTES = 2048;
+
+let pendingEvents = [];
+let flushTimer = null;
+
+// Logs are sharded per participant and per browser tab session on the server.
+// The participant comes from ?user=..., is remembered in localStorage, and
+// falls back to NEXT_PUBLIC_USER_ID.
+function getUserId() {
+    if (typeof window === 'undefined') return process.env.NEXT_PUBLIC_USER_ID || undefined;
+    try {
+        const fromUrl = new URLSearchParams(window.location.search).get('user');
+        if (fromUrl) window.localStorage.setItem('critiqueUserId', fromUrl);
+        return fromUrl || window.localStorage.getItem('critiqueUserId') || process.env.NEXT_PUBLIC_USER_ID || undefined;
+    } catch {
+        return process.env.NEXT_PUBLIC_USER_ID || undefined;
+    }
+}
+
+function getSessionId() {
+    if (typeof window === 'undefined') return undefined;
+    try {
+        let sessionId = window.sessionStorage.getItem('critiqueSessionId');
+        if (!sessionId) {
+            sessionId = (window.crypto?.randomUUID?.() || `${Date.now()}-${Math.random().toString(36).slice(2)}`);
+            window.sessionStorage.setItem('critiqueSessionId', sessionId);
+        }
+        return sessionId;
+    } catch {
+        return undefined;
+    }
+}
+
+// The API's LLM admission control queues calls per X-User-Id and serves
+// participants round-robin; without the header every browser behind the same
+// proxy would share one queue. Falls back to the tab session when no
+// participant id is known.
+export function llmUserHeaders() {
+    const id = getUserId() || getSessionId();
+    return id ? { 'X-User-Id': id } : {};
+}
+
+async function gzipBody(text) {
+    const stream = new Blob([text]).stream().pipeThrough(new CompressionStream('gzip'));
+    return await new Response(stream).blob();
+}
+
+// Older servers without the batch endpoint still get every event, one by one
+async function sendIndividually(events) {
+    for (const logEntry of events) {
+        try {
+            let response = await fetch(LOG_API_URL, {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify(logEntry)
+            });
+            if (!response.ok && (response.status === 404 || response.status === 405)) {
+                // Try fallback without trailing slash once
+                response = await fetch(`${API_BASE}/api/log-user-action`, {
+                    method: 'POST',
+                    headers: { 'Content-Type': 'application/json' },
+                    body: JSON.stringify(logEntry)
+                });
+            }
+            if (!response.ok) {
+                const bodyText = await response.text().catch(() => '');
+                console.error('Failed to send user action log:', response.status, bodyText);
+            }
+        } catch (err) {
+            console.error('Failed to send user action log:', err);
+        }
+    }
+}
+
+export async function flushUserActions() {
+    if (flushTimer) {
+        clearTimeout(flushTimer);
+        flushTimer = null;
+    }
+    if (pendingEvents.length === 0) return;
+    const events = pendingEvents;
+    pendingEvents = [];
+    const body = JSON.stringify(events);
+    try {
+        const headers = { 'Content-Type': 'application/json' };
+        let payload = body;
+        if (body.length >= GZIP_MIN_BYTES && typeof CompressionStream !== 'undefined') {
+            payload = await gzipBody(body);
+            headers['Content-Encoding'] = 'gzip';
+        }
+        const response = await fetch(LOG_BATCH_API_URL, { method: 'POST', headers, body: payload });
+        if (response.status === 404 || response.status === 405) {
+            await sendIndividually(events);
+        } else if (!response.ok) {
+            const bodyText = await response.text().catch(() => '');
+            console.error('Failed to send user action logs:', response.status, bodyText);
+        }
+    } catch (err) {
+        console.error('Failed to send user action logs:', err);
+    }
+}
+
+// Page is going away: hand the buffer to the browser so it survives the unload
+function flushOnUnload() {
+    if (pendingEvents.length === 0) return;
+    const body = JSON.stringify(pendingEvents);
+    pendingEvents = [];
+    // text/plain keeps the beacon a simple CORS request; the server parses JSON regardless
+    const blob = new Blob([body], { type: 'text/plain' });
+    if (!(navigator.sendBeacon && navigator.sendBeacon(LOG_BATCH_API_URL, blob))) {
+        fetch(LOG_BATCH_API_URL, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body,
+            keepalive: true
+        }).catch(() => {});
+    }
+}
+
+if (typeof window !== 'undefined') {
+    window.addEventListener('pagehide', flushOnUnload);
+    document.addEventListener('visibilitychange', () => {
+        if (document.visibilityState === 'hidden') flushOnUnload();
+    });
+}
+
+export async function logUserAction({ userId, action_type, content, details = {} }) {
     const logEntry = {
         timestamp: new Date().toISOString(),
-        // userId,
+        userId: (userId && userId !== 'anonymous') ? userId : getUserId(),
+        sessionId: getSessionId(),
         action_type,
         content,
         details
     };
-    try {
-        let response = await fetch(LOG_API_URL, {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json'
-            },
-            body: JSON.stringify(logEntry)
-        });
-        if (!response.ok) {
-            // Try fallback without trailing slash once
-            const bodyText = await response.text().catch(() => '');
-            console.error('Failed to send user action log:', response.status, bodyText);
-            if (response.status === 404 || response.status === 405) {
-                try {
-                    response = await fetch(`${API_BASE}/api/log-user-action`, {
-                        method: 'POST',
-                        headers: { 'Content-Type': 'application/json' },
-                        body: JSON.stringify(logEntry)
-                    });
-                    if (!response.ok) {
-                        const retryText = await response.text().catch(() => '');
-                        console.error('Retry failed (no-slash):', response.status, retryText);
-                    }
-                } catch (e) {
-                    console.error('Retry error (no-slash):', e);
-                }
-            }
-        }
-    } catch (err) {
-        console.error('Failed to send user action log:', err);
+    pendingEvents.push(logEntry);
+    if (typeof window === 'undefined') {
+        // No page lifecycle outside the browser: send right away
+        await flushUserActions();
+    } else if (pendingEvents.length >= FLUSH_MAX_EVENTS) {
+        await flushUserActions();
+    } else if (!flushTimer) {
+        flushTimer = setTimeout(flushUserActions, FLUSH_INTERVAL_MS);
     }
 }
 
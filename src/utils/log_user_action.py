@@ -15,22 +15,347 @@ def log_step_result(step: str, task: str, image_path: str, result: str):
 
 import os
 import json
+import atexit
+import gzip
+import queue
+import re
+import shutil
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
 from fastapi import Request
 from fastapi.responses import JSONResponse
 from src.constants import USER_ID
 
-def log_user_action(action_type: str, step_info: str, details: dict = None):
+try:
+    import fcntl
+except ImportError:  # Windows: only run a single writer process there
+    fcntl = None
+
+# --- 버퍼링 로그 기록기 ---
+# Callers only enqueue; a background thread serialises entries, appends them in
+# batches (every LOG_FLUSH_INTERVAL seconds or LOG_BATCH_SIZE entries), rotates
+# files by size or day into gzip archives, and drains the queue on shutdown.
+# The queue holds at most LOG_QUEUE_MAX submissions; when the disk falls that
+# far behind, new entries are dropped and counted rather than held in memory.
+# Events are sharded as logs/user_<id>/<session>.log, and every line's byte
+# range is recorded in a SQLite index so queries read only matching lines of
+# live shards. gzip cannot seek, so lines in rotated archives are reached by
+# decompressing the archive from its start: archived queries are linear scans.
+# Several uvicorn workers may append to the same shard, so rotation, the append
+# and its index rows happen under an flock on a sidecar <shard>.lock file.
+LOG_DIR = os.path.join(os.path.dirname(__file__), '../../logs')
+LOG_INDEX_PATH = os.getenv("LOG_INDEX_PATH", os.path.join(LOG_DIR, 'index.sqlite'))
+DEFAULT_SESSION_ID = "default"
+LOG_ASYNC = os.getenv("LOG_ASYNC", "1") != "0"
+LOG_FLUSH_INTERVAL = float(os.getenv("LOG_FLUSH_INTERVAL", "1.0"))
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", "256"))
+LOG_QUEUE_MAX = int(os.getenv("LOG_QUEUE_MAX", "10000"))
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(50 * 1024 * 1024)))
+LOG_ROTATE_DAILY = os.getenv("LOG_ROTATE_DAILY", "1") != "0"
+
+
+def _shard_id(value, default: str) -> str:
+    value = re.sub(r'[^A-Za-z0-9_.-]', '_', str(value or '')).strip('._')[:64]
+    return value or default
+
+
+def _shard_path(user_id, session_id) -> str:
+    user_id = _shard_id(user_id, USER_ID)
+    return os.path.join(LOG_DIR, f'user_{user_id}', f'{_shard_id(session_id, DEFAULT_SESSION_ID)}.log')
+
+
+@contextmanager
+def _shard_lock(path: str):
+    """Exclusive lock on ``path`` shared by every process writing it."""
+    if fcntl is None:
+        yield
+        return
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _epoch(timestamp: str) -> float:
+    return datetime.fromisoformat(timestamp.rstrip('Z')).replace(tzinfo=timezone.utc).timestamp()
+
+
+class _LogIndex:
+    """(user, session, action_type, step, time) -> byte range of the line in its shard file."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            conn = sqlite3.connect(path, timeout=5.0, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS events (user_id TEXT, session_id TEXT, action_type TEXT, step TEXT, "
+                "ts REAL, file TEXT, offset INTEGER, length INTEGER)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS events_user ON events(user_id, session_id, ts)")
+            conn.execute("CREATE INDEX IF NOT EXISTS events_action ON events(action_type, ts)")
+            conn.execute("CREATE INDEX IF NOT EXISTS events_step ON events(step, ts)")
+            conn.execute("CREATE INDEX IF NOT EXISTS events_file ON events(file)")
+            conn.commit()
+            self._conn = conn
+        except Exception as e:
+            print(f"[WARN] Log index disabled, cannot open {path}: {e}")
+
+    @property
+    def enabled(self) -> bool:
+        return self._conn is not None
+
+    def add(self, rows: list):
+        if self._conn is None:
+            return
+        with self._lock:
+            self._conn.executemany("INSERT INTO events VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self._conn.commit()
+
+    def rename_file(self, old: str, new: str):
+        if self._conn is None:
+            return
+        with self._lock:
+            self._conn.execute("UPDATE events SET file = ? WHERE file = ?", (new, old))
+            self._conn.commit()
+
+    def query(self, filters: dict, since=None, until=None, limit: int = 100) -> list:
+        clauses, params = [], []
+        for column, value in filters.items():
+            if value is not None:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+        if since is not None:
+            clauses.append("ts >= ?")
+            params.append(since)
+        if until is not None:
+            clauses.append("ts <= ?")
+            params.append(until)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        with self._lock:
+            return self._conn.execute(
+                f"SELECT file, offset, length FROM events {where} ORDER BY ts, rowid LIMIT ?", (*params, limit)
+            ).fetchall()
+
+
+_index = _LogIndex(LOG_INDEX_PATH)
+
+
+class _LogWriter:
+    def __init__(self):
+        self._queue = queue.Queue(maxsize=max(1, LOG_QUEUE_MAX))
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._dropped = 0
+        self._dropped_warned = 0.0
+
+    def submit(self, path: str, entries: list):
+        if not LOG_ASYNC:
+            self._write({path: entries})
+            return
+        if self._thread is None:
+            self._start()
+        try:
+            self._queue.put_nowait((path, entries))
+        except queue.Full:
+            self._drop(len(entries))
+
+    def _drop(self, count: int):
+        with self._start_lock:
+            self._dropped += count
+            dropped = self._dropped
+            warn = time.monotonic() - self._dropped_warned >= 10
+            if warn:
+                self._dropped_warned = time.monotonic()
+        if warn:
+            print(f"[WARN] Log queue full ({LOG_QUEUE_MAX}), {dropped} entries dropped so far")
+
+    def stats(self) -> dict:
+        return {"queued": self._queue.qsize(), "max_queued": self._queue.maxsize, "dropped": self._dropped}
+
+    def _start(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch, stop = self._collect()
+            if batch:
+                try:
+                    self._write(batch)
+                except Exception as e:
+                    print(f"[WARN] Log write failed, {sum(map(len, batch.values()))} entries lost: {e}")
+            if stop:
+                return
+
+    def _collect(self):
+        """Block for the first entry, then gather until the batch is full or the interval ends."""
+        batch = {}
+        count = 0
+        deadline = None
+        while count < LOG_BATCH_SIZE:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            path, entries = item
+            batch.setdefault(path, []).extend(entries)
+            count += len(entries)
+            if deadline is None:
+                deadline = time.monotonic() + LOG_FLUSH_INTERVAL
+        return batch, False
+
+    def _write(self, batch: dict):
+        with self._write_lock:
+            for path, entries in batch.items():
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                relpath = os.path.relpath(path, LOG_DIR)
+                lines = [(json.dumps(e, ensure_ascii=False, default=str) + '\n').encode('utf-8') for e in entries]
+                with _shard_lock(path):
+                    self._rotate_if_needed(path)
+                    with open(path, 'ab') as f:
+                        # The end of file only stays put while the lock is held
+                        f.seek(0, os.SEEK_END)
+                        offset = f.tell()
+                        f.write(b''.join(lines))
+                    rows = []
+                    for e, line in zip(entries, lines):
+                        rows.append((e.get("user_id"), e.get("session_id"), e.get("action_type"), e.get("step"),
+                                     _epoch(e["timestamp"]), relpath, offset, len(line)))
+                        offset += len(line)
+                    # Indexed before unlocking, so a rotation elsewhere also renames these rows
+                    try:
+                        _index.add(rows)
+                    except sqlite3.Error as e:
+                        print(f"[WARN] Log index update failed: {e}")
+
+    def _rotate_if_needed(self, path: str):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return
+        started = datetime.fromtimestamp(stat.st_mtime)
+        new_day = LOG_ROTATE_DAILY and started.date() != datetime.now().date()
+        if stat.st_size < LOG_MAX_BYTES and not new_day:
+            return
+        rotated = f"{path}.{started.strftime('%Y%m%d-%H%M%S')}"
+        suffix = 1
+        while os.path.exists(rotated + '.gz'):
+            rotated = f"{path}.{started.strftime('%Y%m%d-%H%M%S')}-{suffix}"
+            suffix += 1
+        os.replace(path, rotated)
+        with open(rotated, 'rb') as src, gzip.open(rotated + '.gz', 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(rotated)
+        _index.rename_file(os.path.relpath(path, LOG_DIR), os.path.relpath(rotated + '.gz', LOG_DIR))
+
+    def shutdown(self, timeout: float = 10.0):
+        """Flush everything queued so far and stop the writer thread."""
+        if self._thread is None:
+            return
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            print("[WARN] Log writer did not drain in time; unwritten entries are lost")
+            return
+        self._thread.join(timeout)
+        self._thread = None
+
+
+_writer = _LogWriter()
+atexit.register(_writer.shutdown)
+
+
+def shutdown_log_writer():
+    _writer.shutdown()
+
+
+def log_writer_stats() -> dict:
+    """Submissions waiting for the writer thread and entries dropped because the queue was full."""
+    return _writer.stats()
+
+
+def log_user_action(action_type: str, step_info: str, details: dict = None, user_id: str = None, session_id: str = None):
+    user_id = _shard_id(user_id, USER_ID)
+    session_id = _shard_id(session_id, DEFAULT_SESSION_ID)
     log_entry = {
-        "timestamp": __import__('datetime').datetime.utcnow().isoformat() + 'Z',
+        "timestamp": datetime.utcnow().isoformat() + 'Z',
+        "user_id": user_id,
+        "session_id": session_id,
         "action_type": action_type,
         "step": step_info,
         "detail": details or {}
     }
-    log_dir = os.path.join(os.path.dirname(__file__), '../../logs')
-    os.makedirs(log_dir, exist_ok=True)
-    log_file = os.path.join(log_dir, f'user_{USER_ID}_actions.log')
-    with open(log_file, 'a') as f:
-        f.write(json.dumps(log_entry, ensure_ascii=False) + '\n')
+    _writer.submit(_shard_path(user_id, session_id), [log_entry])
+
+
+def log_user_actions(events: list, user_id: str = None, session_id: str = None):
+    """Append a batch of client events (action_type, content, details, timestamp) in one write per shard.
+
+    Each event may carry its own userId/sessionId; ``user_id``/``session_id`` are the fallback.
+    """
+    received = datetime.utcnow().isoformat() + 'Z'
+    shards = {}
+    for event in events:
+        event_user = _shard_id(event.get('userId') or user_id, USER_ID)
+        event_session = _shard_id(event.get('sessionId') or session_id, DEFAULT_SESSION_ID)
+        shards.setdefault((event_user, event_session), []).append({
+            "timestamp": received,
+            "client_timestamp": event.get('timestamp'),
+            "user_id": event_user,
+            "session_id": event_session,
+            "action_type": event.get('action_type'),
+            "step": event.get('content', ''),
+            "detail": event.get('details') or {}
+        })
+    for (event_user, event_session), entries in shards.items():
+        _writer.submit(_shard_path(event_user, event_session), entries)
+
+
+def query_user_actions(user_id: str = None, session_id: str = None, action_type: str = None, step: str = None,
+                       since: float = None, until: float = None, limit: int = 100) -> list:
+    """Events matching every given filter, oldest first, read by byte range from their shards.
+
+    ``since``/``until`` are epoch seconds. Events still queued in the writer are not visible yet.
+    Live shards are read by byte range; a rotated ``.gz`` archive is decompressed
+    from its start up to the last requested line, once per query.
+    """
+    if not _index.enabled:
+        raise RuntimeError(f"Log index unavailable at {LOG_INDEX_PATH}")
+    rows = _index.query(
+        {"user_id": user_id, "session_id": session_id, "action_type": action_type, "step": step},
+        since=since, until=until, limit=limit,
+    )
+    # Read each file once, in offset order, then restore time order
+    lines = {}
+    by_file = {}
+    for file, offset, length in rows:
+        by_file.setdefault(file, []).append((offset, length))
+    for file, ranges in by_file.items():
+        path = os.path.join(LOG_DIR, file)
+        opener = gzip.open if file.endswith('.gz') else open
+        try:
+            with opener(path, 'rb') as f:
+                for offset, length in sorted(ranges):
+                    f.seek(offset)
+                    lines[(file, offset)] = f.read(length)
+        except FileNotFoundError:
+            continue
+    return [json.loads(lines[(file, offset)]) for file, offset, _ in rows if (file, offset) in lines]
 
 
 # 테이블 수정 시작 (토글 켜기)
@@ -69,5 +394,5 @@ async def log_action(request: Request):
     action_type = data.get('action_type')
     step_info = data.get('step_info')
     details = data.get('details', {})
-    log_user_action(user_id, action_type, step_info, details)
+    log_user_action(action_type, step_info, details, user_id=user_id, session_id=data.get('sessionId'))
     return JSONResponse({"success": True})
@@ -14,7 +14,7 @@ const defaultGuidelines = `
 10. **Help and Documentation**: It's best if the system doesn't need any additional explanation. However, it may be necessary to provide documentation to help users understand how to complete their tasks.
 `;
 import { useUICritiqueStore } from '../stores/useUICritiqueStore';
-import { logUserAction } from './logUserAction';
+import { logUserAction, llmUserHeaders } from './logUserAction';
 
 type ProjectionStateType = "heuristic" | "results";
 type NavigationDirection = "prev" | "next";
@@ -55,6 +55,39 @@ interface NavigationResult {
   error?: any;
 }
 
+// Step results received from the server and not edited since. With a runId the
+// server already holds these, so they don't need to be uploaded again.
+const serverHeldResults = new WeakSet<object>();
+
+function markServerHeld(result: any) {
+  if (result && typeof result === 'object') serverHeldResults.add(result);
+}
+
+function serverHolds(runId: string | null, result: any): boolean {
+  return !!runId && !!result && typeof result === 'object' && serverHeldResults.has(result);
+}
+
+// Append a step result only when the server's copy may be stale (edited or no run)
+function appendResultIfNeeded(formData: FormData, field: string, result: any, runId: string | null) {
+  if (serverHolds(runId, result)) return;
+  formData.append(field, JSON.stringify(result ?? {}));
+}
+
+// Runs live in the memory of one server process, so after a restart (or on another
+// worker) the run_id is unknown and the server answers 404. Forget the run and
+// resend the full payload; later steps then keep sending it.
+async function postStep(url: string, runId: string | null, buildInit: (runId: string | null) => RequestInit): Promise<Response> {
+  const withUser = (init: RequestInit): RequestInit => ({
+    ...init,
+    headers: { ...llmUserHeaders(), ...(init.headers as Record<string, string> | undefined) },
+  });
+  const response = await fetch(url, withUser(buildInit(runId)));
+  if (!runId || response.status !== 404) return response;
+  console.warn(`Run ${runId} is unknown to the server; resending the full payload.`);
+  useUICritiqueStore.getState().setRunId(null);
+  return fetch(url, withUser(buildInit(null)));
+}
+
 // 네비게이션 처리 함수
 export async function handleNavigation({
   direction,
@@ -139,16 +172,17 @@ export async function handleNavigation({
         if (!state.task || !state.image_base64 || !state.appUI) {
           throw new Error('Missing data for Step 2. Complete Step 1.');
         }
-        const requestBody = {
-          task: state.task,
-          image_base64: state.image_base64.split(',')[1] || state.image_base64,
-          app_ui: state.appUI
-        };
-        const response = await fetch(`${API_BASE}/api/step2/`, {
+        const response = await postStep(`${API_BASE}/api/step2/`, state.runId, (runId) => ({
           method: 'POST',
           headers: { 'Content-Type': 'application/json' },
-          body: JSON.stringify(requestBody)
-        });
+          body: JSON.stringify({
+            task: state.task,
+            ...(runId
+              ? { run_id: runId }
+              : { image_base64: state.image_base64.split(',')[1] || state.image_base64 }),
+            app_ui: state.appUI
+          })
+        }));
         if (!response.ok) throw new Error(`Step 2 API failed: ${await response.text()}`);
         const data = await response.json();
         useUICritiqueStore.getState().setAppUIComponents(data.result);
@@ -162,22 +196,24 @@ export async function handleNavigation({
         if (!state.task || !state.image_base64 || !state.appUI || !appUIComponents) {
           throw new Error('Missing data for Step 3. Complete Step 2.');
         }
-        const requestBody = {
-          task: state.task,
-          image_base64: state.image_base64.split(',')[1] || state.image_base64,
-          app_ui: state.appUI,
-          app_ui_components: appUIComponents
-        };
-        const response = await fetch(`${API_BASE}/api/step3/`, {
+        const response = await postStep(`${API_BASE}/api/step3/`, state.runId, (runId) => ({
           method: 'POST',
           headers: { 'Content-Type': 'application/json' },
-          body: JSON.stringify(requestBody)
-        });
+          body: JSON.stringify({
+            task: state.task,
+            ...(runId
+              ? { run_id: runId }
+              : { image_base64: state.image_base64.split(',')[1] || state.image_base64 }),
+            app_ui: state.appUI,
+            app_ui_components: appUIComponents
+          })
+        }));
         if (!response.ok) throw new Error(`Step 3 API failed: ${await response.text()}`);
         const data = await response.json();
         console.log('DEBUG: Step 3 API response data:', data);
 
         // Await state update
+        markServerHeld(data.result);
         await useUICritiqueStore.getState().setStep3Results(data.result);
         console.log('DEBUG: Step 3 results set in Zustand store:', data.result);
 
@@ -201,19 +237,21 @@ export async function handleNavigation({
           console.error('DEBUG: Missing data for Step 4. Current state:', currentState);
           throw new Error('Missing data for Step 4. Step 3 results are not available.');
         }
-        const requestBody = {
-          task: currentState.task,
-          image_base64: currentState.image_base64.split(',')[1] || currentState.image_base64,
-          app_ui: currentState.appUI,
-          step3_results: currentState.step3Results
-        };
-        const response = await fetch(`${API_BASE}/api/step4/`, {
+        const response = await postStep(`${API_BASE}/api/step4/`, currentState.runId, (runId) => ({
           method: 'POST',
           headers: { 'Content-Type': 'application/json' },
-          body: JSON.stringify(requestBody)
-        });
+          body: JSON.stringify({
+            task: currentState.task,
+            ...(runId
+              ? { run_id: runId }
+              : { image_base64: currentState.image_base64.split(',')[1] || currentState.image_base64 }),
+            app_ui: currentState.appUI,
+            ...(serverHolds(runId, currentState.step3Results) ? {} : { step3_results: currentState.step3Results })
+          })
+        }));
         if (!response.ok) throw new Error(`Step 4 API failed: ${await response.text()}`);
         const data = await response.json();
+        markServerHeld(data.result);
         useUICritiqueStore.getState().setStep4Results(data.result);
         setComprehensionState("section");
         return { success: true, step: 'step4', data: { section_analysis: data.result } };
@@ -240,19 +278,25 @@ export async function handleNavigation({
           console.warn('Step 5 & 6: 필수 데이터가 부족합니다. 이전 단계를 완료해 주세요.');
           return { success: false, error: '필수 데이터가 부족합니다. 이전 단계를 완료해 주세요.' };
         }
-        const formData = new FormData();
-        formData.append('task', currentState.task ?? '');
-        formData.append('image_base64', (currentState.image_base64 ? (currentState.image_base64.split(',')[1] || currentState.image_base64) : ''));
-        formData.append('step3_results_str', JSON.stringify(currentState.step3Results ?? {}));
-        formData.append('step4_results_str', JSON.stringify(currentState.step4Results ?? {}));
-        // Always use the latest guidelines from Zustand store
-        formData.append('guidelines_str', currentState.guidelines ?? '');
-        const response = await fetch(`${API_BASE}/api/step5_6/`, {
-          method: 'POST',
-          body: formData,
-        });
+        const buildStep5_6 = (runId: string | null): RequestInit => {
+          const formData = new FormData();
+          formData.append('task', currentState.task ?? '');
+          if (runId) {
+            formData.append('run_id', runId);
+          } else {
+            formData.append('image_base64', (currentState.image_base64 ? (currentState.image_base64.split(',')[1] || currentState.image_base64) : ''));
+          }
+          appendResultIfNeeded(formData, 'step3_results_str', currentState.step3Results, runId);
+          appendResultIfNeeded(formData, 'step4_results_str', currentState.step4Results, runId);
+          // Always use the latest guidelines from Zustand store
+          formData.append('guidelines_str', currentState.guidelines ?? '');
+          return { method: 'POST', body: formData };
+        };
+        const response = await postStep(`${API_BASE}/api/step5_6/`, currentState.runId, buildStep5_6);
         if (!response.ok) throw new Error(`Step 5/6 API failed: ${await response.text()}`);
         const data = await response.json();
+        markServerHeld(data.step5_result);
+        markServerHeld(data.step6_result);
         useUICritiqueStore.getState().setStep5Result(data.step5_result);
         useUICritiqueStore.getState().setStep6Result(data.step6_result);
         setProjectionState("results");
@@ -295,18 +339,19 @@ export async function handleNavigation({
         if (!currentState.task || !currentState.step3Results || !currentState.step4Results || !step5Result || !step6Result || !currentState.guidelines) {
           throw new Error('Missing data for Step 7. Complete previous steps.');
         }
-        const formData = new FormData();
-        formData.append('task', currentState.task ?? '');
-        formData.append('step3_results_str', JSON.stringify(currentState.step3Results ?? {}));
-        formData.append('step4_results_str', JSON.stringify(currentState.step4Results ?? {}));
-        formData.append('step5_results_str', JSON.stringify(step5Result ?? {}));
-        formData.append('step6_results_str', JSON.stringify(step6Result ?? {}));
-        formData.append('projection_results_data_str', JSON.stringify(currentState.projectionResultsData ?? {}));
-        formData.append('guidelines_str', currentState.guidelines ?? '');
-        const response = await fetch(`${API_BASE}/api/step7/`, {
-          method: 'POST',
-          body: formData,
-        });
+        const buildStep7 = (runId: string | null): RequestInit => {
+          const formData = new FormData();
+          formData.append('task', currentState.task ?? '');
+          if (runId) formData.append('run_id', runId);
+          appendResultIfNeeded(formData, 'step3_results_str', currentState.step3Results, runId);
+          appendResultIfNeeded(formData, 'step4_results_str', currentState.step4Results, runId);
+          appendResultIfNeeded(formData, 'step5_results_str', step5Result, runId);
+          appendResultIfNeeded(formData, 'step6_results_str', step6Result, runId);
+          formData.append('projection_results_data_str', JSON.stringify(currentState.projectionResultsData ?? {}));
+          formData.append('guidelines_str', currentState.guidelines ?? '');
+          return { method: 'POST', body: formData };
+        };
+        const response = await postStep(`${API_BASE}/api/step7/`, currentState.runId, buildStep7);
         if (!response.ok) throw new Error(`Step 7 API failed: ${await response.text()}`);
         const data = await response.json();
         useUICritiqueStore.getState().setStep7Result(data.solution);
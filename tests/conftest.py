@@ -0,0 +1,123 @@
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from types import SimpleNamespace
+
+import pytest
+
+# index reads its knobs at import time: replay recorded replies, keep the
+# persistent caches and job queue out of the working tree, run no job workers
+_STATE_DIR = tempfile.mkdtemp(prefix="critique-tests-")
+os.environ["LLM_BACKEND"] = "fake"
+os.environ["FAKE_LLM_LATENCY_MS"] = "0"
+os.environ["FAKE_LLM_FAILURE_RATE"] = "0"
+os.environ["STEP_CACHE_ENABLED"] = "0"
+os.environ["JOB_WORKERS"] = "0"
+os.environ["JOB_DB_PATH"] = os.path.join(_STATE_DIR, "jobs.sqlite")
+os.environ["PROFILE_DIR"] = os.path.join(_STATE_DIR, "profiles")
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for _path in (os.path.join(_ROOT, "api"), _ROOT):
+    if _path not in sys.path:
+        sys.path.insert(0, _path)
+
+import index as _index  # noqa: E402
+
+
+@pytest.fixture
+def index():
+    return _index
+
+
+@pytest.fixture
+def agent():
+    """A step1 agent; the fake backend answers it from api/bench/responses.json."""
+    return SimpleNamespace(
+        name="UILayoutIdentifier",
+        system_message="",
+        llm_config={"config_list": [{"model": "gpt-4o"}]},
+    )
+
+
+@pytest.fixture
+def admission(index, monkeypatch):
+    """A fresh admission controller (2 slots, no TPM budget) for one test."""
+    controller = index._AdmissionController(2, 0)
+    monkeypatch.setattr(index, "_admission", controller)
+    return controller
+
+
+@pytest.fixture
+def call_policy(index, monkeypatch):
+    """Fast retries, hedging off and no latency history, whatever the environment says."""
+    monkeypatch.setattr(index, "LLM_RETRY_BASE_SECONDS", 0.01)
+    monkeypatch.setattr(index, "LLM_MAX_RETRIES", 2)
+    monkeypatch.setattr(index, "LLM_HEDGE", False)
+    monkeypatch.setattr(index, "LLM_STEP_DEADLINES", {})
+    monkeypatch.setattr(index, "_call_latencies", {})
+    return index
+
+
+@pytest.fixture
+def hedging(call_policy, monkeypatch):
+    """Hedge step1 calls still running after 0.1s."""
+    monkeypatch.setattr(call_policy, "LLM_HEDGE", True)
+    monkeypatch.setattr(call_policy, "LLM_HEDGE_MIN_SAMPLES", 1)
+    monkeypatch.setattr(call_policy, "LLM_HEDGE_MIN_SECONDS", 0.1)
+    monkeypatch.setattr(call_policy, "_call_latencies", {"step1": deque([0.1])})
+    return call_policy
+
+
+class _Script:
+    """Per-call behaviour of the fake backend: ``(delay_seconds, error_or_None)`` tuples."""
+
+    def __init__(self):
+        self.steps = []
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, *steps):
+        self.steps.extend(steps)
+        return self
+
+    def next_step(self):
+        with self.lock:
+            n = self.calls
+            self.calls += 1
+        return n, self.steps[n] if n < len(self.steps) else (0, None)
+
+
+@pytest.fixture
+def scripted(index, monkeypatch):
+    """Script the fake backend call by call.
+
+    The n-th conversation sleeps ``steps[n][0]`` seconds and then raises
+    ``steps[n][1]`` or returns the recorded reply tagged with ``.call = n``.
+    Calls beyond the script answer at once.
+    """
+    replay = index._FakeUserProxy.initiate_chat
+    script = _Script()
+
+    def initiate_chat(self, recipient, message="", **kwargs):
+        n, (delay, error) = script.next_step()
+        if delay:
+            time.sleep(delay)
+        if error is not None:
+            raise error
+        res = replay(self, recipient, message, **kwargs)
+        res.call = n
+        return res
+
+    monkeypatch.setattr(index._FakeUserProxy, "initiate_chat", initiate_chat)
+    return script
+
+
+@pytest.fixture
+def counter(index):
+    """Read a labelled counter from the in-process metrics registry."""
+    def _read(name: str, **labels) -> float:
+        return index._metrics._counters.get(index._Metrics._key(name, labels), 0.0)
+    return _read
@@ -0,0 +1,213 @@
+"""Deadline, retry, hedging and admission behaviour of ``_initiate_chat`` on the fake LLM backend."""
+import asyncio
+import time
+
+import pytest
+
+
+class _RateLimited(Exception):
+    status_code = 429
+
+
+class _BadRequest(Exception):
+    status_code = 400
+
+
+async def _settled(controller, timeout: float = 2.0):
+    """Wait until every admitted call, abandoned ones included, has released its slot."""
+    stop = time.monotonic() + timeout
+    while controller.stats()["in_flight"] and time.monotonic() < stop:
+        await asyncio.sleep(0.01)
+    return controller.stats()
+
+
+# --- hedging ---
+
+def test_hedge_wins_when_primary_is_slow(hedging, scripted, admission, agent, counter):
+    scripted((0.6, None), (0, None))
+    fired = counter("critique_llm_hedges_total", step="step1", outcome="fired")
+    won = counter("critique_llm_hedges_total", step="step1", outcome="won")
+
+    async def run():
+        started = time.monotonic()
+        res = await hedging._initiate_chat(agent, message="Identify the layout")
+        return res, time.monotonic() - started, await _settled(admission)
+
+    res, elapsed, stats = asyncio.run(run())
+    assert res.call == 1
+    assert elapsed < 0.5
+    assert counter("critique_llm_hedges_total", step="step1", outcome="fired") == fired + 1
+    assert counter("critique_llm_hedges_total", step="step1", outcome="won") == won + 1
+    # The losing primary keeps its slot until its worker thread returns, then frees it
+    assert stats["in_flight"] == 0
+
+
+def test_hedge_loses_when_primary_answers_first(hedging, scripted, admission, agent, counter):
+    scripted((0.2, None), (0.6, None))
+    fired = counter("critique_llm_hedges_total", step="step1", outcome="fired")
+    won = counter("critique_llm_hedges_total", step="step1", outcome="won")
+
+    async def run():
+        res = await hedging._initiate_chat(agent, message="Identify the layout")
+        return res, await _settled(admission)
+
+    res, stats = asyncio.run(run())
+    assert res.call == 0
+    assert scripted.calls == 2
+    assert counter("critique_llm_hedges_total", step="step1", outcome="fired") == fired + 1
+    assert counter("critique_llm_hedges_total", step="step1", outcome="won") == won
+    assert stats["in_flight"] == 0
+
+
+def test_no_hedge_without_latency_history(call_policy, scripted, admission, agent, monkeypatch):
+    monkeypatch.setattr(call_policy, "LLM_HEDGE", True)
+    scripted((0.2, None))
+    res = asyncio.run(call_policy._initiate_chat(agent, message="Identify the layout"))
+    assert res.call == 0
+    assert scripted.calls == 1
+
+
+# --- retries ---
+
+@pytest.mark.parametrize("error", [ConnectionError("reset"), TimeoutError("slow"), _RateLimited("429")])
+def test_transient_error_is_retried(call_policy, scripted, admission, agent, counter, error):
+    scripted((0, error))
+    reason = type(error).__name__
+    retries = counter("critique_llm_retries_total", step="step1", reason=reason)
+
+    res = asyncio.run(call_policy._initiate_chat(agent, message="Identify the layout"))
+    assert res.call == 1
+    assert counter("critique_llm_retries_total", step="step1", reason=reason) == retries + 1
+    assert admission.stats()["in_flight"] == 0
+
+
+@pytest.mark.parametrize("error", [ValueError("bad reply"), _BadRequest("400")])
+def test_permanent_error_fails_fast(call_policy, scripted, admission, agent, error):
+    scripted((0, error))
+    with pytest.raises(type(error)):
+        asyncio.run(call_policy._initiate_chat(agent, message="Identify the layout"))
+    assert scripted.calls == 1
+    assert admission.stats()["in_flight"] == 0
+
+
+def test_retries_stop_after_max_retries(call_policy, scripted, admission, agent):
+    scripted(*[(0, ConnectionError("reset"))] * 5)
+    with pytest.raises(ConnectionError):
+        asyncio.run(call_policy._initiate_chat(agent, message="Identify the layout"))
+    assert scripted.calls == call_policy.LLM_MAX_RETRIES + 1
+
+
+# --- deadline ---
+
+def test_deadline_cuts_off_a_slow_call(call_policy, scripted, admission, agent, monkeypatch):
+    monkeypatch.setattr(call_policy, "LLM_STEP_DEADLINES", {"step1": 0.2})
+    scripted((0.8, None))
+
+    async def run():
+        started = time.monotonic()
+        with pytest.raises(TimeoutError):
+            await call_policy._initiate_chat(agent, message="Identify the layout")
+        return time.monotonic() - started, await _settled(admission)
+
+    elapsed, stats = asyncio.run(run())
+    assert elapsed < 0.6
+    assert stats["in_flight"] == 0
+
+
+def test_no_retry_past_the_deadline(call_policy, scripted, admission, agent, monkeypatch):
+    monkeypatch.setattr(call_policy, "LLM_STEP_DEADLINES", {"step1": 0.5})
+    monkeypatch.setattr(call_policy, "LLM_RETRY_BASE_SECONDS", 5)
+    scripted((0, ConnectionError("reset")))
+    with pytest.raises(ConnectionError):
+        asyncio.run(call_policy._initiate_chat(agent, message="Identify the layout"))
+    assert scripted.calls == 1
+
+
+def test_deadline_bounds_admission_wait(call_policy, scripted, agent, index, monkeypatch):
+    controller = index._AdmissionController(1, 0)
+    monkeypatch.setattr(index, "_admission", controller)
+    monkeypatch.setattr(call_policy, "LLM_STEP_DEADLINES", {"step1": 0.2})
+    scripted((0.5, None))
+
+    async def run():
+        blocker = asyncio.ensure_future(call_policy._initiate_chat(agent, message="Identify the layout"))
+        await asyncio.sleep(0.05)
+        with pytest.raises(TimeoutError, match="not admitted"):
+            await call_policy._initiate_chat(agent, message="Identify the layout")
+        queued = controller.stats()["queued"]
+        with pytest.raises(TimeoutError):
+            await blocker
+        return queued, await _settled(controller)
+
+    queued, stats = asyncio.run(run())
+    assert queued == 0
+    assert stats["in_flight"] == 0
+
+
+# --- admission ---
+
+def test_cancel_while_queued_leaves_the_queue(call_policy, scripted, agent, index, monkeypatch):
+    controller = index._AdmissionController(1, 0)
+    monkeypatch.setattr(index, "_admission", controller)
+    scripted((0.3, None), (0, None))
+
+    async def run():
+        first = asyncio.ensure_future(call_policy._initiate_chat(agent, message="Identify the layout"))
+        await asyncio.sleep(0.05)
+        second = asyncio.ensure_future(call_policy._initiate_chat(agent, message="Identify the layout"))
+        await asyncio.sleep(0.05)
+        before = controller.stats()
+        second.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await second
+        after = controller.stats()
+        await first
+        return before, after, await _settled(controller)
+
+    before, after, settled = asyncio.run(run())
+    assert (before["in_flight"], before["queued"]) == (1, 1)
+    assert (after["in_flight"], after["queued"]) == (1, 0)
+    assert settled["in_flight"] == 0
+    assert scripted.calls == 1
+
+
+def test_cancel_in_flight_releases_once_the_worker_returns(call_policy, scripted, agent, index, monkeypatch):
+    controller = index._AdmissionController(1, 0)
+    monkeypatch.setattr(index, "_admission", controller)
+    scripted((0.3, None), (0, None))
+
+    async def run():
+        task = asyncio.ensure_future(call_policy._initiate_chat(agent, message="Identify the layout"))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        held = controller.stats()["in_flight"]
+        # The freed slot admits the next call
+        res = await asyncio.wait_for(call_policy._initiate_chat(agent, message="Identify the layout"), 2)
+        return held, res, await _settled(controller)
+
+    held, res, settled = asyncio.run(run())
+    assert held == 1
+    assert res.call == 1
+    assert settled["in_flight"] == 0
+
+
+def test_cancel_refunds_tokens_never_sent(index):
+    controller = index._AdmissionController(1, 1000)
+
+    async def run():
+        first = await controller.acquire("a", 600)
+        waiting = asyncio.ensure_future(controller.acquire("b", 600))
+        await asyncio.sleep(0.01)
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        queued = controller.stats()["queued"]
+        controller.release(first)
+        return queued, controller.stats()
+
+    queued, stats = asyncio.run(run())
+    assert queued == 0
+    assert stats["in_flight"] == 0
+    assert stats["tokens_available"] == 1000